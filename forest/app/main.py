@@ -1,50 +1,121 @@
 import bokeh.plotting
+import bokeh.models
 import argparse
-import yaml
+import concurrent.futures
+import cache
+from config import load_config
 import control
 import view
+import util
 import database as db
+import locate
+import shard
+import snapshot
+import stats
+
+
+# Seconds between checks for a newer catalogue generation
+LOCATOR_INTERVAL = 30.
+
+# Milliseconds between refreshes of the --stats table
+STATS_INTERVAL = 5000
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--database",
-        required=True,
         help="SQL database to optimise menu system")
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="catalogue snapshot published by main.py --snapshot, "
+             "served from memory instead of --database")
+    parser.add_argument(
+        "--shards", metavar="DIR",
+        help="directory of catalogues written by main.py --shard-by, "
+             "queried by attaching only the shards a menu needs")
     parser.add_argument(
         "--config-file",
         required=True, metavar="YAML_FILE",
         help="YAML file to configure application")
-    return parser.parse_args(args=argv)
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="time catalogue queries and show latencies and "
+             "slow query plans below the menus")
+    args = parser.parse_args(args=argv)
+    sources = [args.database, args.snapshot, args.shards]
+    if sources.count(None) != 2:
+        parser.error(
+            "exactly one of --database, --snapshot or --shards "
+            "must be given")
+    return args
+
+
+def open_catalogue(args):
+    """Database answering menus and locator answering fields"""
+    if args.shards is not None:
+        # Both are answered by the shards a query can match, one
+        # instance per process is shared by every session
+        federation = shard.shared(args.shards)
+        return federation, federation
+    # Fields are located from arrays rebuilt when ingest bumps the
+    # catalogue generation, checked at most every LOCATOR_INTERVAL,
+    # one copy of the arrays is shared by every session
+    if args.snapshot is None:
+        connection = db.ConnectionManager(args.database)
+        locator = locate.shared(
+            args.database, check_interval=LOCATOR_INTERVAL)
+    else:
+        # Sessions share one in-memory copy, swapped when ingest
+        # publishes a newer snapshot
+        connection = snapshot.shared(args.snapshot)
+        locator = locate.shared(
+            args.snapshot, memory=True, check_interval=LOCATOR_INTERVAL)
+    return db.Database(connection), locator
 
 
 def main():
     args = parse_args()
     with open(args.config_file) as stream:
         config = load_config(stream)
-    database = db.Database.connect(args.database)
-    controls = control.Controls(database, patterns=config.patterns)
+
+    # Queries run on a worker thread, so the document thread never
+    # waits for SQLite, each thread has its own read-only connection
+    document = bokeh.plotting.curdoc()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    document.on_session_destroyed(
+        lambda context: executor.shutdown(wait=False))
+
+    database, locator = open_catalogue(args)
+
+    controls = control.Controls(
+        database,
+        patterns=config.patterns,
+        cache=cache.MENUS,
+        background=util.Background(
+            executor, document.add_next_tick_callback))
     controls.subscribe(print)
 
-    locator = db.Locator.connect(args.database)
-    text = view.View(text="Hello, world!", locator=locator)
+    text = view.View(
+        text="Hello, world!",
+        locator=locator,
+        background=util.Background(
+            executor, document.add_next_tick_callback))
     controls.subscribe(text.on_state)
 
-    document = bokeh.plotting.curdoc()
     document.add_root(controls.layout)
     document.add_root(text.div)
 
+    if args.stats:
+        database.instrument(stats.STATS)
+        locator.instrument(stats.STATS)
+        table = bokeh.models.PreText(text=stats.STATS.format())
 
-class Namespace(object):
-    def __init__(self, **kwargs):
-        self.__dict__.update(**kwargs)
-
+        def on_interval():
+            table.text = stats.STATS.format()
 
-def load_config(stream):
-    data = yaml.load(stream)
-    patterns = [(m["name"], m["pattern"]) for m in data["models"]]
-    return Namespace(patterns=patterns)
+        document.add_periodic_callback(on_interval, STATS_INTERVAL)
+        document.add_root(table)
 
 
 if __name__.startswith('bk'):
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""Benchmark catalogue ingest
+
+Compares the per-point Database.insert_time/insert_pressure
+methods with the bulk Database.insert_times/insert_pressures
+helpers, e.g.
+
+    python benchmark.py insert --files 20 --variables 10
+
+Measures end-to-end main.ingest throughput on generated Unified
+Model-like files for each extractor and insert mode, writing a
+JSON report that can be compared between releases, e.g.
+
+    python benchmark.py ingest --files 50 --output report.json
+
+The generated files differ only in reference time, so template
+cloning is measured by its own mode and disabled in the others
+"""
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+import netCDF4
+import numpy as np
+import database as db
+import extract
+import main as ingest_main
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    insert = subparsers.add_parser(
+        "insert", help="rows/second of per-point vs bulk inserts")
+    insert.add_argument(
+        "--files", type=int, default=10,
+        help="number of file names to insert")
+    insert.add_argument(
+        "--variables", type=int, default=10,
+        help="variables per file")
+    insert.add_argument(
+        "--times", type=int, default=24,
+        help="time points per variable")
+    insert.add_argument(
+        "--pressures", type=int, default=20,
+        help="pressure levels per variable")
+    ingest = subparsers.add_parser(
+        "ingest", help="files/s, rows/s and peak RSS of main.ingest")
+    ingest.add_argument(
+        "--files", type=int, default=20,
+        help="number of netCDF files to generate")
+    ingest.add_argument(
+        "--variables", type=int, default=10,
+        help="variables per file")
+    ingest.add_argument(
+        "--times", type=int, default=12,
+        help="time points per variable")
+    ingest.add_argument(
+        "--pressures", type=int, default=10,
+        help="pressure levels per variable")
+    ingest.add_argument(
+        "--distinct-axes", action="store_true",
+        help="give each variable its own time axis, as UM files with "
+             "time, time_0, time_1, ... coordinates do")
+    ingest.add_argument(
+        "--extractor", dest="extractors", action="append",
+        choices=sorted(extract.EXTRACTORS),
+        help="extractor(s) to measure, default: all")
+    ingest.add_argument(
+        "--mode", dest="modes", action="append", choices=sorted(MODES),
+        help="insert mode(s) to measure, default: all")
+    ingest.add_argument(
+        "--workers", type=int, default=1,
+        help="extraction processes passed to main.ingest")
+    ingest.add_argument(
+        "--directory",
+        help="keep generated files in DIRECTORY, default: temporary")
+    ingest.add_argument(
+        "--output", metavar="FILE",
+        help="write JSON report to FILE, default: stdout")
+    return parser.parse_args(args=argv)
+
+
+def main(argv=None):
+    args = parse_args(argv=argv)
+    if args.command == "insert":
+        report = insert_rates(
+            files=args.files,
+            variables=args.variables,
+            times=args.times,
+            pressures=args.pressures)
+    elif args.command == "ingest":
+        report = ingest_rates(
+            files=args.files,
+            variables=args.variables,
+            times=args.times,
+            pressures=args.pressures,
+            shared_axes=not args.distinct_axes,
+            extractors=args.extractors,
+            modes=args.modes,
+            workers=args.workers,
+            directory=args.directory)
+    text = json.dumps(report, indent=2)
+    if getattr(args, "output", None) is None:
+        print(text)
+    else:
+        with open(args.output, "w") as stream:
+            stream.write(text + "\n")
+
+
+def insert_rates(files=10, variables=10, times=24, pressures=20):
+    """Rows per second inserted by each strategy"""
+    report = {}
+    for name, method in [
+            ("per_point", _insert_per_point),
+            ("bulk", _insert_bulk)]:
+        database = db.Database(sqlite3.connect(":memory:"))
+        start = time.perf_counter()
+        rows = 0
+        for path, variable, _times, _pressures in _coordinates(
+                files, variables, times, pressures):
+            method(database, path, variable, _times, _pressures)
+            rows += len(_times) + len(_pressures)
+        database.connection.commit()
+        seconds = time.perf_counter() - start
+        database.close()
+        report[name] = {
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_second": rows / seconds}
+    report["speedup"] = (
+        report["bulk"]["rows_per_second"] /
+        report["per_point"]["rows_per_second"])
+    return report
+
+
+def _coordinates(files, variables, times, pressures):
+    reference = dt.datetime(2019, 1, 1)
+    levels = [1000. - 50. * i for i in range(pressures)]
+    for i in range(files):
+        path = "file_{:04d}.nc".format(i)
+        initial = reference + dt.timedelta(hours=6 * i)
+        axis = [initial + dt.timedelta(hours=h) for h in range(times)]
+        for j in range(variables):
+            yield path, "variable_{}".format(j), axis, levels
+
+
+def _insert_per_point(database, path, variable, times, pressures):
+    for i, value in enumerate(times):
+        database.insert_time(path, variable, value, i)
+    for i, value in enumerate(pressures):
+        database.insert_pressure(path, variable, value, i)
+
+
+def _insert_bulk(database, path, variable, times, pressures):
+    database.insert_times(path, variable, times)
+    database.insert_pressures(path, variable, pressures)
+
+
+class BulkDatabase(db.Database):
+    """Database that extracts every file instead of cloning templates"""
+    def __init__(self, connection):
+        super().__init__(connection, templates=False)
+
+
+class PerPointDatabase(BulkDatabase):
+    """Database that writes coordinates one point at a time"""
+    def insert_times(self, path, variable, times):
+        for i, value in enumerate(times):
+            self.insert_time(path, variable, value, i)
+
+    def insert_pressures(self, path, variable, values):
+        for i, value in enumerate(values):
+            self.insert_pressure(path, variable, value, i)
+
+
+class PackedDatabase(db.Database):
+    """Database that stores each distinct axis once, packed"""
+    def __init__(self, connection):
+        super().__init__(connection, packed=True, templates=False)
+
+
+MODES = {
+    "bulk": BulkDatabase,
+    "packed": PackedDatabase,
+    "per_point": PerPointDatabase,
+    "template": db.Database
+}
+
+
+def ingest_rates(
+        files=20,
+        variables=10,
+        times=12,
+        pressures=10,
+        shared_axes=True,
+        extractors=None,
+        modes=None,
+        workers=1,
+        directory=None,
+        isolate=True):
+    """Throughput of main.ingest for each extractor and insert mode
+
+    :param isolate: measure each run in a fresh process so that peak
+                    RSS is not inflated by earlier runs
+    :returns: dict suitable for json.dump
+    """
+    if extractors is None:
+        extractors = sorted(extract.EXTRACTORS)
+    if modes is None:
+        modes = sorted(MODES)
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp()
+    try:
+        paths = generate(
+            directory,
+            files=files,
+            variables=variables,
+            times=times,
+            pressures=pressures,
+            shared_axes=shared_axes)
+        runs = []
+        for extractor in extractors:
+            for mode in modes:
+                args = (paths, extractor, mode, workers, directory)
+                if isolate:
+                    context = multiprocessing.get_context("spawn")
+                    with context.Pool(1) as pool:
+                        run = pool.apply(_ingest_run, args)
+                else:
+                    run = _ingest_run(*args)
+                runs.append(run)
+    finally:
+        if temporary:
+            shutil.rmtree(directory)
+    return {
+        "benchmark": "ingest",
+        "created": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "environment": _environment(),
+        "parameters": {
+            "files": files,
+            "variables": variables,
+            "times": times,
+            "pressures": pressures,
+            "shared_axes": shared_axes,
+            "workers": workers},
+        "runs": runs}
+
+
+def _ingest_run(paths, extractor, mode, workers, directory):
+    """Ingest paths into a new catalogue and measure it"""
+    path = os.path.join(directory, "benchmark-{}-{}.db".format(
+        extractor, mode))
+    if os.path.exists(path):
+        os.remove(path)
+    database = MODES[mode](sqlite3.connect(path))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Keep stdout clean for the JSON report
+        ingest_main.ingest(
+            database,
+            paths,
+            workers=workers,
+            extractor=extractor)
+    database.connection.commit()
+    seconds = time.perf_counter() - start
+    # Coordinate points catalogued, whether stored as rows or packed
+    database.cursor.execute("""
+        SELECT (SELECT COUNT(*) FROM variable_to_time) +
+               (SELECT COUNT(*) FROM variable_to_pressure) +
+               (SELECT COALESCE(SUM(axis.size), 0)
+                  FROM variable
+                  JOIN axis
+                    ON axis.id IN (
+                       variable.time_axis_id, variable.pressure_axis_id))
+    """)
+    rows, = database.cursor.fetchone()
+    database.close()
+    size = os.path.getsize(path)
+    os.remove(path)
+    return {
+        "extractor": extractor,
+        "mode": mode,
+        "files": len(paths),
+        "rows": rows,
+        "seconds": seconds,
+        "files_per_second": len(paths) / seconds,
+        "rows_per_second": rows / seconds,
+        "database_bytes": size,
+        "peak_rss_kb": _peak_rss_kb()}
+
+
+def _peak_rss_kb():
+    """High water mark of resident memory, kB on Linux, bytes on macOS"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        return usage // 1024
+    return usage
+
+
+def _environment():
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "netCDF4": netCDF4.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform()}
+
+
+def generate(
+        directory,
+        files=20,
+        variables=10,
+        times=12,
+        pressures=10,
+        shared_axes=True,
+        shape=(10, 10)):
+    """Write Unified Model-like netCDF files
+
+    Each file has a forecast_reference_time, pressure levels,
+    latitude/longitude grid and variables with um_stash_source
+    attributes on (time, pressure, latitude, longitude). With
+    shared_axes=False variable j uses its own time_j coordinate,
+    offset by j hours, like UM output with several time axes
+
+    :returns: list of paths
+    """
+    units = "hours since 1970-01-01 00:00:00"
+    levels = np.linspace(1000., 100., pressures)
+    reference = dt.datetime(2019, 1, 1)
+    paths = []
+    for i in range(files):
+        path = os.path.join(
+            directory, "benchmark_{:05d}.nc".format(i))
+        initial = reference + dt.timedelta(hours=6 * i)
+        with netCDF4.Dataset(path, "w") as dataset:
+            dataset.createDimension("pressure", pressures)
+            dataset.createDimension("latitude", shape[0])
+            dataset.createDimension("longitude", shape[1])
+            obj = dataset.createVariable(
+                "forecast_reference_time", "d", ())
+            obj.units = units
+            obj.standard_name = "forecast_reference_time"
+            obj[:] = netCDF4.date2num(initial, units)
+            obj = dataset.createVariable("pressure", "d", ("pressure",))
+            obj.units = "hPa"
+            obj.long_name = "pressure"
+            obj[:] = levels
+            for name, size in [("latitude", shape[0]),
+                               ("longitude", shape[1])]:
+                obj = dataset.createVariable(name, "f", (name,))
+                obj.standard_name = name
+                obj[:] = np.linspace(-90., 90., size)
+            axes = 1 if shared_axes else variables
+            for j in range(axes):
+                name = "time" if shared_axes else "time_{}".format(j)
+                dataset.createDimension(name, times)
+                obj = dataset.createVariable(name, "d", (name,))
+                obj.units = units
+                obj.standard_name = "time"
+                obj[:] = netCDF4.date2num([
+                    initial + dt.timedelta(hours=h + j)
+                    for h in range(times)], units)
+            for j in range(variables):
+                name = "time" if shared_axes else "time_{}".format(j)
+                obj = dataset.createVariable(
+                    "stash_{:05d}".format(j),
+                    "f",
+                    (name, "pressure", "latitude", "longitude"))
+                obj.um_stash_source = "m01s{:02d}i{:03d}".format(
+                    j // 1000, j % 1000)
+                obj.coordinates = "forecast_reference_time"
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    main()
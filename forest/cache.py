@@ -0,0 +1,75 @@
+"""Process-wide caches shared between bokeh sessions"""
+import collections
+import threading
+import time
+
+
+# Seconds between checks for a newer catalogue generation
+CHECK_INTERVAL = 10.
+
+
+class MenuCache(object):
+    """Thread-safe LRU cache invalidated by catalogue generation
+
+    Values computed for an older generation are discarded the first
+    time a newer generation is seen, see Database.generation(). The
+    generation is read at most every check_interval seconds, so that
+    cache hits do not touch the catalogue
+    """
+    def __init__(self, maxsize=1024, check_interval=CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.generation = None
+        self.checked = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, generation, key, compute):
+        """Cached value of compute() for key
+
+        :param generation: callable returning the catalogue generation
+        """
+        self._check(generation)
+        with self._lock:
+            current = self.generation
+            try:
+                value = self._entries[key]
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+        value = compute()
+        with self._lock:
+            if current == self.generation:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def _check(self, generation):
+        """Read the generation if check_interval has passed"""
+        now = time.monotonic()
+        with self._lock:
+            if (self.checked is not None) and (
+                    now - self.checked < self.check_interval):
+                return
+            self.checked = now
+        value = generation()
+        with self._lock:
+            if value != self.generation:
+                self._entries.clear()
+                self.generation = value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by every session served from this process
+MENUS = MenuCache()
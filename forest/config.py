@@ -0,0 +1,13 @@
+"""Application configuration shared by the bokeh app and ingest"""
+import yaml
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(**kwargs)
+
+
+def load_config(stream):
+    data = yaml.safe_load(stream)
+    patterns = [(m["name"], m["pattern"]) for m in data["models"]]
+    return Namespace(patterns=patterns)
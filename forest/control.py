@@ -1,4 +1,5 @@
 """Control navigation of FOREST data"""
+import functools
 import bokeh.models
 import bokeh.layouts
 import util
@@ -33,11 +34,18 @@ class Observable(object):
 
 
 class Controls(Observable):
-    def __init__(self, database, patterns=None):
+    def __init__(
+            self,
+            database,
+            patterns=None,
+            cache=None,
+            background=None):
         if patterns is None:
             patterns = []
         self.patterns = patterns
         self.database = database
+        self.cache = cache
+        self.background = background
         self.state = State()
         self.dropdowns = {
             "pattern": bokeh.models.Dropdown(
@@ -70,27 +78,31 @@ class Controls(Observable):
 
     def render(self, state):
         """Configure dropdown menus"""
-        variables = self.database.variables(pattern=state.pattern)
-        self.dropdowns["variable"].menu = self.menu(variables)
-
-        initial_times = self.database.initial_times(
-            pattern=state.pattern)
-        self.dropdowns["initial_time"].menu = self.menu(initial_times)
-
+        if self.background is None:
+            self.apply(state, self.menus(state))
+        else:
+            self.background.submit(
+                functools.partial(self.menus, state),
+                functools.partial(self.apply, state))
+
+    def apply(self, state, menus):
+        """Set dropdown choices from database.Menus"""
+        self.dropdowns["variable"].menu = self.menu(menus.variables)
+        self.dropdowns["initial_time"].menu = self.menu(menus.initial_times)
         if state.initial_time is not None:
-            pressures = self.database.pressures(
-                pattern=state.pattern,
-                variable=state.variable,
-                initial_time=state.initial_time)
-            pressures = reversed(pressures)
-            self.dropdowns["pressure"].menu = self.menu(pressures, self.hpa)
-
-            valid_times = self.database.valid_times(
-                pattern=state.pattern,
-                variable=state.variable,
-                initial_time=state.initial_time)
-            valid_times = sorted(set(valid_times))
-            self.dropdowns["valid_time"].menu = self.menu(valid_times)
+            self.dropdowns["pressure"].menu = self.menu(
+                reversed(menus.pressures), self.hpa)
+            self.dropdowns["valid_time"].menu = self.menu(menus.valid_times)
+
+    def menus(self, state):
+        """Menu choices related to state, shared via cache if present"""
+        if self.cache is None:
+            return self.database.menus(state)
+        key = (state.pattern, state.variable, state.initial_time)
+        return self.cache.get(
+            self.database.generation,
+            key,
+            lambda: self.database.menus(state))
 
     def on_click(self, key):
         """Wire up bokeh on_click callbacks to State changes"""
@@ -1,42 +1,641 @@
+import os
 import sqlite3
-import iris
+import calendar
+import contextlib
+import datetime as dt
+import functools
+import hashlib
+import itertools
+import numbers
+import threading
+import time
+import urllib.request
+from collections import namedtuple
 import netCDF4
-import jinja2
+import numpy as np
+import extract
+import schema
+
+
+Menus = namedtuple("Menus", (
+    "variables",
+    "initial_times",
+    "pressures",
+    "valid_times"))
+
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+def to_epoch(time):
+    """Integer seconds since 1970 as stored in time columns
+
+    Accepts datetime, numpy.datetime64 and ISO 8601 strings such as
+    the dropdown menu labels, naive values are treated as UTC, numbers
+    and None are returned unchanged
+    """
+    if (time is None) or isinstance(time, numbers.Number):
+        return time
+    if isinstance(time, np.datetime64):
+        return int(time.astype("datetime64[s]").astype(np.int64))
+    if isinstance(time, str):
+        time = dt.datetime.fromisoformat(time)
+    return calendar.timegm(time.utctimetuple())
+
+
+def from_epoch(seconds):
+    """Naive UTC datetime of a stored time, see :func:`to_epoch`"""
+    if isinstance(seconds, int):
+        return EPOCH + dt.timedelta(seconds=seconds)
+    return seconds
+
+
+# Packed axis element types, little-endian so catalogues are portable
+AXIS_DTYPES = {
+    "time": np.dtype("<i8"),
+    "pressure": np.dtype("<f8")}
+
+
+def pack_axis(kind, values):
+    """Content digest and bytes of a time or pressure axis
+
+    Times must already be epoch seconds, see :func:`to_epoch`
+    """
+    data = np.asarray(values, dtype=AXIS_DTYPES[kind]).tobytes()
+    digest = hashlib.blake2b(
+        kind.encode() + data, digest_size=16).digest()
+    return digest, data
+
+
+def unpack_axis(kind, data):
+    """Read-only array viewing the bytes of a packed axis"""
+    return np.frombuffer(data, dtype=AXIS_DTYPES[kind])
+
+
+def _merge(values, kind):
+    """Sorted distinct values of a query mixing points and packed axes
+
+    Per-point rows arrive sorted and distinct, so they are returned
+    unchanged unless a packed axis has to be merged in
+    """
+    points = [v for v in values if not isinstance(v, bytes)]
+    axes = [unpack_axis(kind, v) for v in values if isinstance(v, bytes)]
+    if len(axes) == 0:
+        return points
+    return sorted(set(points).union(np.unique(np.concatenate(axes)).tolist()))
+
+
+def _shiftable(metadata):
+    """True if every time can be shifted to another reference time"""
+    if metadata.reference_time is None:
+        return False
+    for variable in metadata.variables:
+        for time in variable.times or ():
+            if not isinstance(time, (dt.datetime, np.datetime64)):
+                return False
+    return True
+
+
+def compile_variants(build, conditions):
+    """Render SQL once for every combination of WHERE conditions
+
+    Query methods look up a static string by the set of filters in
+    use and bind values as :name parameters, so no SQL is generated
+    per call and sqlite3 can reuse its prepared statements
+
+    :param build: function mapping a list of conditions to SQL
+    :param conditions: dict of keyword to SQL condition
+    :returns: dict of frozenset(keywords) to SQL
+    """
+    queries = {}
+    for n in range(len(conditions) + 1):
+        for keys in itertools.combinations(conditions, n):
+            queries[frozenset(keys)] = build([conditions[k] for k in keys])
+    return queries
+
+
+def _filters(**kwargs):
+    """Key into a compile_variants() registry for non-None kwargs"""
+    return frozenset(k for k, v in kwargs.items() if v is not None)
+
+
+def _variables_sql(conditions):
+    if len(conditions) == 0:
+        return """
+            SELECT DISTINCT variable.name
+              FROM variable
+             ORDER BY variable.name
+        """
+    return """
+            SELECT DISTINCT variable.name
+              FROM variable
+              JOIN file
+                ON file.id = variable.file_id
+             WHERE {}
+             ORDER BY variable.name
+    """.format(" AND ".join(conditions))
+
+
+def _valid_times_sql(conditions):
+    if len(conditions) == 0:
+        return """
+            SELECT DISTINCT time.value
+              FROM time
+             ORDER BY time.value
+        """
+    return """
+            SELECT DISTINCT time.value
+              FROM time
+              JOIN variable_to_time AS vt
+                ON vt.time_id = time.id
+              JOIN variable AS v
+                ON vt.variable_id = v.id
+              JOIN file
+                ON v.file_id = file.id
+             WHERE {}
+             ORDER BY time.value
+    """.format(" AND ".join(conditions))
+
+
+def _pressures_sql(conditions):
+    if len(conditions) == 0:
+        return """
+            SELECT DISTINCT value
+              FROM pressure
+             ORDER BY value
+        """
+    return """
+            SELECT DISTINCT pressure.value
+              FROM pressure
+              JOIN variable_to_pressure AS vp
+                ON vp.pressure_id = pressure.id
+              JOIN variable AS v
+                ON v.id = vp.variable_id
+              JOIN file
+                ON v.file_id = file.id
+             WHERE {}
+             ORDER BY value
+    """.format(" AND ".join(conditions))
+
+
+def _axes_sql(kind, conditions):
+    """Distinct packed axes of kind 'time' or 'pressure'"""
+    if len(conditions) == 0:
+        return """
+            SELECT data
+              FROM axis
+             WHERE kind = '{}'
+        """.format(kind)
+    return """
+            SELECT DISTINCT axis.data
+              FROM axis
+              JOIN variable AS v
+                ON v.{}_axis_id = axis.id
+              JOIN file
+                ON v.file_id = file.id
+             WHERE {}
+    """.format(kind, " AND ".join(conditions))
+
+
+def _with_axes(build, kind):
+    """Append packed axis rows to a per-point query, see _merge"""
+    def wrapper(conditions):
+        return "SELECT value FROM ({})\n UNION ALL \n{}".format(
+            build(conditions), _axes_sql(kind, conditions))
+    return wrapper
+
+
+def _initial_times_sql(conditions):
+    return """
+            SELECT DISTINCT reference
+              FROM file
+             WHERE {}
+             ORDER BY reference
+    """.format(" AND ".join(["reference IS NOT NULL"] + conditions))
+
+
+def _menus_sql(conditions):
+    """UNION ALL of every menu query tagged by Menus field name"""
+    pattern = [c for c in conditions if c in (_PATTERN, _MODEL)]
+    parts = [
+        "SELECT 'variables', name FROM ({})".format(
+            _variables_sql(pattern)),
+        "SELECT 'initial_times', reference FROM ({})".format(
+            _initial_times_sql(pattern))
+    ]
+    if _INITIAL_TIME in conditions:
+        parts += [
+            "SELECT 'pressures', value FROM ({})".format(
+                _pressures_sql(conditions)),
+            "SELECT 'pressures', data FROM ({})".format(
+                _axes_sql("pressure", conditions)),
+            "SELECT 'valid_times', value FROM ({})".format(
+                _valid_times_sql(conditions)),
+            "SELECT 'valid_times', data FROM ({})".format(
+                _axes_sql("time", conditions))
+        ]
+    return "\n UNION ALL \n".join(parts) + "\n ORDER BY 1, 2"
+
+
+def _files_sql(conditions):
+    return """
+            SELECT name
+              FROM file
+             {}
+             ORDER BY name
+    """.format("WHERE " + " AND ".join(conditions) if conditions else "")
+
+
+def _path_points_sql(conditions):
+    # Time and pressure sharing an axis, e.g. dim0 files, only match
+    # where both coordinates refer to the same index along that axis,
+    # IS NOT treats two missing axes as equal. The nearest pressures
+    # above and below are found by two probes that walk the
+    # pressure_value index in order, Locator.nearest picks the closer
+    return """
+            SELECT file.name, v.time_axis, v.pressure_axis, t.i, p.i,
+                   ABS(p.value - :pressure) AS distance, v.id, p.value
+              FROM file
+              JOIN variable AS v
+                ON v.file_id = file.id
+              JOIN variable_to_time AS vt
+                ON vt.variable_id = v.id
+              JOIN time AS t
+                ON vt.time_id = t.id
+              JOIN pressure AS p
+                ON p.id IN ({}, {})
+             WHERE {}
+    """.format(
+        _nearest_pressure_sql(">=", "ASC"),
+        _nearest_pressure_sql("<=", "DESC"),
+        " AND ".join(conditions + [
+            "v.name = :variable",
+            "file.reference = :initial_time",
+            "t.value = :valid_time"]))
+
+
+def _nearest_pressure_sql(operator, order):
+    """First pressure of variable v on one side of :pressure
+
+    CROSS JOIN keeps pressure as the outer loop, so the search stops
+    at the first value in index order that belongs to v
+    """
+    return """(
+                SELECT q.id
+                  FROM pressure AS q
+                 CROSS JOIN variable_to_pressure AS vp
+                 WHERE vp.pressure_id = q.id
+                   AND vp.variable_id = v.id
+                   AND q.value {} :pressure
+                   AND (v.time_axis IS NOT v.pressure_axis OR q.i = t.i)
+                 ORDER BY q.value {}
+                 LIMIT 1)""".format(operator, order)
+
+
+def _packed_path_points_sql(conditions):
+    # Candidates are searched in Python, see _nearest_axes
+    return """
+            SELECT file.name, v.time_axis, v.pressure_axis, t.data, p.data
+              FROM file
+              JOIN variable AS v
+                ON v.file_id = file.id
+              JOIN axis AS t
+                ON t.id = v.time_axis_id
+              JOIN axis AS p
+                ON p.id = v.pressure_axis_id
+             WHERE {}
+    """.format(" AND ".join(conditions + [
+        "v.name = :variable",
+        "file.reference = :initial_time"]))
+
+
+def _nearest_axes(rows, valid_time, pressure):
+    """(distance, row) closest to pressure amongst packed candidates
+
+    Same rules as the per-point query, time and pressure sharing an
+    axis must refer to the same index along it
+    """
+    best = None
+    for path, ta, pa, times, pressures in rows:
+        matches = np.flatnonzero(unpack_axis("time", times) == valid_time)
+        pressures = unpack_axis("pressure", pressures)
+        if ta == pa:
+            matches = matches[matches < len(pressures)]
+            candidates = matches
+        else:
+            candidates = np.arange(len(pressures))
+        if (len(matches) == 0) or (len(candidates) == 0):
+            continue
+        distances = np.abs(pressures[candidates] - pressure)
+        k = np.argmin(distances)
+        if (best is None) or (distances[k] < best[0]):
+            ti = candidates[k] if ta == pa else matches[0]
+            best = (distances[k], (path, ta, pa, int(ti), int(candidates[k])))
+    return best
+
+
+def _points(path, ta, pa, ti, pi):
+    """Path and index tuple of a field given its axes"""
+    if ta == pa:
+        return path, (ti,)
+    elif ta is None:
+        return path, (pi,)
+    elif pa is None:
+        return path, (ti,)
+    else:
+        rank = max(ta, pa) + 1
+        pts = rank * [None]
+        pts[ta] = ti
+        pts[pa] = pi
+        return path, tuple(pts)
+
+
+# Patterns registered with Database.insert_model are replaced by an
+# indexed lookup of precomputed file_model rows, ad-hoc patterns fall
+# back to GLOB, see Connection._pattern_params
+_PATTERN = "file.name GLOB :pattern"
+_MODEL = "file.id IN (SELECT file_id FROM file_model WHERE model_id = :model)"
+_INITIAL_TIME = "file.reference = :initial_time"
+_VARIABLE = "v.name = :variable"
+
+FILES = compile_variants(_files_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL})
+INITIAL_TIMES = compile_variants(_initial_times_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL})
+MENUS = compile_variants(_menus_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL,
+    "variable": _VARIABLE,
+    "initial_time": _INITIAL_TIME})
+VARIABLES = compile_variants(_variables_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL})
+VALID_TIMES = compile_variants(_with_axes(_valid_times_sql, "time"), {
+    "initial_time": _INITIAL_TIME,
+    "pattern": _PATTERN,
+    "model": _MODEL,
+    "variable": _VARIABLE})
+PRESSURES = compile_variants(_with_axes(_pressures_sql, "pressure"), {
+    "variable": _VARIABLE,
+    "pattern": _PATTERN,
+    "model": _MODEL,
+    "initial_time": _INITIAL_TIME})
+PATH_POINTS = compile_variants(_path_points_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL})
+PACKED_PATH_POINTS = compile_variants(_packed_path_points_sql, {
+    "pattern": _PATTERN,
+    "model": _MODEL})
+
+
+# Rows orphaned when files are deleted, in the order they are swept
+# by Database.collect_garbage, each with the condition that marks a
+# row as unreferenced
+ORPHANS = [
+    ("variable", """NOT EXISTS (
+        SELECT 1 FROM file WHERE file.id = variable.file_id)"""),
+    ("variable_to_time", """NOT EXISTS (
+        SELECT 1 FROM variable AS v
+         WHERE v.id = variable_to_time.variable_id)"""),
+    ("variable_to_pressure", """NOT EXISTS (
+        SELECT 1 FROM variable AS v
+         WHERE v.id = variable_to_pressure.variable_id)"""),
+    ("file_model", """NOT EXISTS (
+        SELECT 1 FROM file WHERE file.id = file_model.file_id)"""),
+    ("template", """NOT EXISTS (
+        SELECT 1 FROM file WHERE file.id = template.file_id)"""),
+    ("time", """NOT EXISTS (
+        SELECT 1 FROM variable_to_time AS vt WHERE vt.time_id = time.id)"""),
+    ("pressure", """NOT EXISTS (
+        SELECT 1 FROM variable_to_pressure AS vp
+         WHERE vp.pressure_id = pressure.id)"""),
+    ("axis", """NOT EXISTS (
+        SELECT 1 FROM variable AS v WHERE v.time_axis_id = axis.id)
+        AND NOT EXISTS (
+        SELECT 1 FROM variable AS v WHERE v.pressure_axis_id = axis.id)"""),
+]
+
+# Rowids swept per transaction by Database.collect_garbage
+GC_BATCH_SIZE = 10000
+
+# Free pages returned per transaction by Database.incremental_vacuum
+VACUUM_PAGES = 1000
+
+# Seconds a connection waits for a lock held by another connection
+BUSY_TIMEOUT = 30.
+
+# Seconds between checks for models registered by another connection
+MODELS_INTERVAL = 10.
+
+
+class ConnectionManager(object):
+    """One SQLite connection per thread to a catalogue file
+
+    Behaves like a sqlite3.Connection, cursor(), commit() and close()
+    act on the calling thread's connection, which is opened on first
+    use. Readers are opened with mode=ro so that sessions in the bokeh
+    app can never write to a catalogue that ingest is updating
+
+    Connections are only used by the thread that opened them,
+    check_same_thread is disabled so that close() can be called
+    from any thread
+
+    .. note:: concurrent readers only avoid blocking behind a writer
+              if the catalogue uses WAL journaling, which
+              :meth:`Database.connect` enables
+    """
+    def __init__(self, path, read_only=True, timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.read_only = read_only
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Connection owned by the calling thread"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def open(self):
+        if self.read_only:
+            uri = "file:{}?mode=ro".format(
+                urllib.request.pathname2url(os.path.abspath(self.path)))
+            return sqlite3.connect(
+                uri,
+                uri=True,
+                timeout=self.timeout,
+                check_same_thread=False)
+        return sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False)
+
+    def cursor(self):
+        return self.get().cursor()
+
+    def commit(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.commit()
+
+    def rollback(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.rollback()
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+def attributed(method):
+    """Attribute statements executed by method to its name
+
+    Only the outermost attributed call counts, so helpers such as
+    Locator.nearest report towards the public method, see stats
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if (stats is None) or (stats.method() is not None):
+            return method(self, *args, **kwargs)
+        with stats.attribute(name):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Connection(object):
     def __init__(self, connection):
         self.connection = connection
-        self.cursor = self.connection.cursor()
+        self.cursors = threading.local()
+        self.models = None
+        self.models_checked = None
+        self.stats = None
+
+    @property
+    def cursor(self):
+        """Cursor owned by the calling thread"""
+        cursor = getattr(self.cursors, "cursor", None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            if self.stats is not None:
+                cursor = self.stats.wrap(cursor, self.connection)
+            self.cursors.cursor = cursor
+        return cursor
+
+    def instrument(self, stats):
+        """Report latency of every statement to stats
+
+        :param stats: stats.QueryStats or None to stop reporting
+        """
+        self.stats = stats
+        self.cursors = threading.local()
+        return self
+
+    def _attribute(self, method):
+        """Attribute statements to method if instrumented"""
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.attribute(method)
 
     @classmethod
-    def connect(cls, path):
-        """Create database instance from location on disk or :memory:"""
-        return cls(sqlite3.connect(path))
+    def connect(cls, path, **kwargs):
+        """Create database instance from location on disk or :memory:
+
+        Keyword arguments are passed to sqlite3.connect
+        """
+        kwargs.setdefault("timeout", BUSY_TIMEOUT)
+        return cls(cls.configure(sqlite3.connect(path, **kwargs)))
+
+    @staticmethod
+    def configure(connection):
+        """Prepare a connection opened by :meth:`connect`"""
+        return connection
+
+    @classmethod
+    def connect_shared(cls, path, read_only=True, timeout=BUSY_TIMEOUT):
+        """Instance safe to share between threads, see ConnectionManager"""
+        return cls(ConnectionManager(
+            path,
+            read_only=read_only,
+            timeout=timeout))
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Discard the unfinished batch, see main.ingest
+            self.connection.rollback()
         self.close()
 
     def close(self):
         self.connection.commit()
         self.connection.close()
 
+    def _pattern_params(self, pattern):
+        """Query parameters for a pattern, using model ids when known
+
+        Registered models are cached, the cache is dropped when the
+        catalogue generation has changed, which is checked at most
+        every MODELS_INTERVAL seconds. Catalogues that predate the
+        model table have no models
+        """
+        if pattern is None:
+            return dict(pattern=None, model=None)
+        models = self._models()
+        if pattern in models:
+            return dict(pattern=None, model=models[pattern])
+        return dict(pattern=pattern, model=None)
+
+    def _models(self):
+        if (self.models is not None) and (
+                time.monotonic() - self.models_checked < MODELS_INTERVAL):
+            return self.models[1]
+        with self._attribute("models"):
+            try:
+                self.cursor.execute(
+                    "SELECT value FROM generation WHERE id = 1")
+                generation = self.cursor.fetchone()
+                if (self.models is None) or (generation != self.models[0]):
+                    self.cursor.execute("SELECT pattern, id FROM model")
+                    self.models = (generation, dict(self.cursor.fetchall()))
+            except sqlite3.OperationalError:
+                # Locators do not migrate, see schema.MIGRATIONS
+                self.models = (None, {})
+        self.models_checked = time.monotonic()
+        return self.models[1]
+
 
 class CoordinateDB(Connection):
+    """Positions of coordinates along the dimensions of variables
+
+    Tables are created if they do not exist, so a file on disk can
+    be reopened and extended
+    """
     def __init__(self, connection):
-        self.connection = connection
-        self.cursor = self.connection.cursor()
+        super().__init__(connection)
         self.cursor.execute("""
-        CREATE TABLE file (
+        CREATE TABLE IF NOT EXISTS file (
                   id INTEGER PRIMARY KEY,
                 name TEXT,
                 UNIQUE(name))
         """)
         self.cursor.execute("""
-        CREATE TABLE axis (
+        CREATE TABLE IF NOT EXISTS axis (
                   id INTEGER PRIMARY KEY,
             variable TEXT,
                 name TEXT,
@@ -45,7 +644,7 @@ class CoordinateDB(Connection):
              FOREIGN KEY(file_id) REFERENCES file(id))
         """)
         self.cursor.execute("""
-        CREATE TABLE time (
+        CREATE TABLE IF NOT EXISTS time (
                   id INTEGER PRIMARY KEY,
             variable TEXT,
                    i INTEGER,
@@ -54,7 +653,7 @@ class CoordinateDB(Connection):
              FOREIGN KEY(file_id) REFERENCES file(id))
         """)
         self.cursor.execute("""
-        CREATE TABLE pressure (
+        CREATE TABLE IF NOT EXISTS pressure (
                   id INTEGER PRIMARY KEY,
             variable TEXT,
                    i INTEGER,
@@ -62,13 +661,101 @@ class CoordinateDB(Connection):
              file_id INTEGER,
              FOREIGN KEY(file_id) REFERENCES file(id))
         """)
+        for table in ("time", "pressure"):
+            self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS {0}_variable_value
+                ON {0}(variable, value)
+            """.format(table))
+        for table, columns in [
+                ("axis", "file_id, variable, name"),
+                ("time", "file_id, variable, i"),
+                ("pressure", "file_id, variable, i")]:
+            self._unique(table, columns)
+
+    def _unique(self, table, columns):
+        """Unique index on columns, so INSERT OR REPLACE replaces
 
+        Files written before the index existed may hold duplicates,
+        only the most recently inserted row of each is kept
+        """
+        name = "{}_unique".format(table)
+        self.cursor.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name
+        """, dict(name=name))
+        if self.cursor.fetchone() is not None:
+            return
+        self.cursor.execute("""
+            DELETE FROM {0}
+             WHERE id NOT IN (SELECT MAX(id) FROM {0} GROUP BY {1})
+        """.format(table, columns))
+        self.cursor.execute("""
+            CREATE UNIQUE INDEX {} ON {}({})
+        """.format(name, table, columns))
+
+    @attributed
+    def insert_metadata(self, metadata):
+        """Axes, times and pressures of every variable in a file
+
+        Rows of a file loaded before are replaced, each table is
+        written with a single executemany
+        """
+        path = metadata.path
+        axes, times, pressures = [], [], []
+        for variable in metadata.variables:
+            for coordinate, axis in [
+                    ("time", variable.time_axis),
+                    ("pressure", variable.pressure_axis)]:
+                if axis is not None:
+                    axes.append(dict(
+                        path=path,
+                        variable=variable.name,
+                        coordinate=coordinate,
+                        axis=axis))
+            times += [dict(
+                path=path,
+                variable=variable.name,
+                i=i,
+                value=str(value))
+                for i, value in enumerate(variable.times or ())]
+            pressures += [dict(
+                path=path,
+                variable=variable.name,
+                i=i,
+                value=float(value))
+                for i, value in enumerate(variable.pressures or ())]
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO file (name) VALUES (:path)
+        """, dict(path=path))
+        for table in ("axis", "time", "pressure"):
+            self.cursor.execute("""
+            DELETE FROM {}
+             WHERE file_id = (SELECT id FROM file WHERE name = :path)
+            """.format(table), dict(path=path))
+        self.cursor.executemany("""
+        INSERT OR REPLACE INTO axis (variable, name, value, file_id)
+             VALUES (
+                     :variable,
+                     :coordinate,
+                     :axis,
+                     (SELECT id FROM file WHERE name = :path))
+        """, axes)
+        for table, data in [("time", times), ("pressure", pressures)]:
+            self.cursor.executemany("""
+            INSERT OR REPLACE INTO {} (variable, i, value, file_id)
+                 VALUES (
+                     :variable,
+                     :i,
+                     :value,
+                     (SELECT id FROM file WHERE name = :path))
+            """.format(table), data)
+
+    @attributed
     def insert_pressures(self, path, variable, values):
         self.cursor.execute("""
             INSERT OR IGNORE INTO file (name) VALUES (:path)
         """, dict(path=path))
         query = """
-        INSERT INTO pressure (variable, i, value, file_id)
+        INSERT OR REPLACE INTO pressure (variable, i, value, file_id)
              VALUES (
                  :variable,
                  :i,
@@ -82,6 +769,7 @@ class CoordinateDB(Connection):
             value=value) for i, value in enumerate(values)]
         self.cursor.executemany(query, data)
 
+    @attributed
     def pressure_index(self, pattern, variable, value):
         self.cursor.execute("""
         SELECT pressure.i
@@ -98,6 +786,16 @@ class CoordinateDB(Connection):
         rows = self.cursor.fetchall()
         return [i for i, in rows]
 
+    @attributed
+    def pressure_indices(self, pattern, variable, values):
+        """Positions of many pressures, see pressure_index
+
+        :returns: list of index lists in the order of values
+        """
+        return self._indices(
+            "pressure", pattern, variable, [float(v) for v in values])
+
+    @attributed
     def insert_times(self, path, variable, values):
         self.cursor.execute("""
             INSERT OR IGNORE INTO file (name) VALUES (:path)
@@ -108,7 +806,7 @@ class CoordinateDB(Connection):
             i=i,
             value=value) for i, value in enumerate(values)]
         self.cursor.executemany("""
-            INSERT INTO time (variable, i, value, file_id)
+            INSERT OR REPLACE INTO time (variable, i, value, file_id)
                  VALUES (
                  :variable,
                  :i,
@@ -116,6 +814,7 @@ class CoordinateDB(Connection):
                  (SELECT id FROM file WHERE name = :path))
         """, data)
 
+    @attributed
     def time_index(self, pattern, variable, value):
         self.cursor.execute("""
         SELECT time.i
@@ -132,12 +831,56 @@ class CoordinateDB(Connection):
         rows = self.cursor.fetchall()
         return [i for i, in rows]
 
+    @attributed
+    def time_indices(self, pattern, variable, values):
+        """Positions of many times in one query, see time_index
+
+        :returns: list of index lists in the order of values
+        """
+        return self._indices(
+            "time", pattern, variable, [str(v) for v in values])
+
+    def _indices(self, table, pattern, variable, values):
+        """Join values written to a temp table against a coordinate
+
+        Temp tables are private to a connection, so the table is
+        created on first use by each connection, e.g. each thread of
+        a ConnectionManager
+        """
+        self.cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS {}_lookup (
+                    k INTEGER PRIMARY KEY,
+                value)
+        """.format(table))
+        self.cursor.execute("DELETE FROM temp.{}_lookup".format(table))
+        self.cursor.executemany("""
+            INSERT INTO temp.{}_lookup (k, value) VALUES (?, ?)
+        """.format(table), enumerate(values))
+        self.cursor.execute("""
+        SELECT lookup.k, {0}.i
+          FROM temp.{0}_lookup AS lookup
+          JOIN {0}
+            ON {0}.variable = :variable
+           AND {0}.value = lookup.value
+          JOIN file
+            ON file.id = {0}.file_id
+         WHERE file.name GLOB :pattern
+         ORDER BY lookup.k, {0}.id
+        """.format(table), dict(
+            pattern=pattern,
+            variable=variable))
+        result = [[] for _ in values]
+        for k, i in self.cursor.fetchall():
+            result[k].append(i)
+        return result
+
+    @attributed
     def insert_axis(self, path, variable, coordinate, axis):
         self.cursor.execute("""
         INSERT OR IGNORE INTO file (name) VALUES (:path)
         """, dict(path=path))
         self.cursor.execute("""
-        INSERT INTO axis (variable, name, value, file_id)
+        INSERT OR REPLACE INTO axis (variable, name, value, file_id)
              VALUES (
                      :variable,
                      :coordinate,
@@ -149,6 +892,7 @@ class CoordinateDB(Connection):
             coordinate=coordinate,
             axis=axis))
 
+    @attributed
     def axis(self, path, variable, coordinate):
         self.cursor.execute("""
         SELECT value FROM axis
@@ -164,6 +908,7 @@ class CoordinateDB(Connection):
         rows = self.cursor.fetchall()
         return rows[0][0]
 
+    @attributed
     def coordinates(self, path, variable):
         self.cursor.execute("""
         SELECT axis.name, axis.value FROM axis
@@ -171,6 +916,7 @@ class CoordinateDB(Connection):
             ON file.id = axis.file_id
          WHERE file.name = :path
            AND axis.variable = :variable
+         ORDER BY axis.id
         """, dict(
             path=path,
             variable=variable))
@@ -179,6 +925,7 @@ class CoordinateDB(Connection):
 
 class Locator(Connection):
     """Query database for path and index related to fields"""
+    @attributed
     def path_points(
             self,
             pattern,
@@ -186,211 +933,481 @@ class Locator(Connection):
             initial_time,
             valid_time,
             pressure):
-        query = """
-            SELECT f.name, v.time_axis, v.pressure_axis, t.i, p.i
-              FROM file AS f
-              JOIN variable AS v
-                ON v.file_id = f.id
-              JOIN variable_to_time AS vt
-                ON vt.variable_id = v.id
-              JOIN time AS t
-                ON vt.time_id = t.id
-              JOIN variable_to_pressure AS vp
-                ON vp.variable_id = v.id
-              JOIN pressure AS p
-                ON p.id = vp.pressure_id
-             WHERE f.name GLOB :pattern
-               AND v.name = :variable
-               AND f.reference = :initial_time
-               AND t.value = :valid_time
-             ORDER BY ABS(p.value - :pressure) ASC
+        best = self.nearest(
+            pattern, variable, initial_time, valid_time, pressure)
+        if best is None:
+            return None
+        return _points(*best[1])
+
+    @attributed
+    def nearest(
+            self,
+            pattern,
+            variable,
+            initial_time,
+            valid_time,
+            pressure):
+        """Closest field as (distance, (path, ta, pa, ti, pi))
+
+        Distance is measured in pressure, so that candidates from
+        several catalogues can be compared, see shard.Federation
+
+        :returns: tuple or None if no field matches
         """
-        self.cursor.execute(query, dict(
-            pattern=pattern,
+        params = dict(
             variable=variable,
-            initial_time=initial_time,
-            valid_time=valid_time,
-            pressure=pressure))
+            initial_time=to_epoch(initial_time),
+            valid_time=to_epoch(valid_time),
+            pressure=pressure,
+            **self._pattern_params(pattern))
+        key = _filters(pattern=params["pattern"], model=params["model"])
+        self.cursor.execute(PATH_POINTS[key], params)
         rows = self.cursor.fetchall()
-        print(rows)
-        for (path, ta, pa, ti, pi) in rows:
-            if ta == pa:
-                if ti != pi:
-                    continue
-                return path, (ti,)
-            elif ta is None:
-                return path, (pi,)
-            elif pa is None:
-                return path, (ti,)
-            else:
-                rank = max(ta, pa) + 1
-                pts = rank * [None]
-                pts[ta] = ti
-                pts[pa] = pi
-                return path, tuple(pts)
+        best = None
+        if len(rows) > 0:
+            # Ties go to the first variable inserted, then the lower
+            # pressure and time index, as in locate.ArrayLocator
+            row = min(rows, key=lambda r: (r[5], r[6], r[7], r[3]))
+            best = (row[5], row[:5])
+        self.cursor.execute(PACKED_PATH_POINTS[key], params)
+        packed = _nearest_axes(
+            self.cursor.fetchall(), params["valid_time"], pressure)
+        if (packed is not None) and ((best is None) or (packed[0] < best[0])):
+            best = packed
+        return best
 
 
 class Database(Connection):
-    """Stores index and paths of forecast diagnostics"""
-    def __init__(self, connection):
-        self.connection = connection
-        self.cursor = self.connection.cursor()
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS file (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    reference TEXT,
-                    UNIQUE(name))
-        """)
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS variable (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT,
-                    time_axis INTEGER,
-                    pressure_axis INTEGER,
-                    file_id INTEGER,
-                    FOREIGN KEY(file_id) REFERENCES file(id),
-                    UNIQUE(name, file_id))
-        """)
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS pressure (
-                    id INTEGER PRIMARY KEY,
-                    i INTEGER,
-                    value REAL,
-                    UNIQUE(i, value)
-            )
-        """)
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS variable_to_pressure (
-                    variable_id INTEGER,
-                    pressure_id INTEGER,
-                    PRIMARY KEY(variable_id, pressure_id),
-                    FOREIGN KEY(variable_id) REFERENCES variable(id),
-                    FOREIGN KEY(pressure_id) REFERENCES pressure(id))
-        """)
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS time (
-                    id INTEGER PRIMARY KEY,
-                    i INTEGER,
-                    value TEXT,
-                    UNIQUE(i, value))
-        """)
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS variable_to_time (
-                    variable_id INTEGER,
-                    time_id INTEGER,
-                    PRIMARY KEY(variable_id, time_id),
-                    FOREIGN KEY(variable_id) REFERENCES variable(id),
-                    FOREIGN KEY(time_id) REFERENCES time(id))
-        """)
+    """Stores index and paths of forecast diagnostics
+
+    :param packed: write each time and pressure axis as a single
+                   shared BLOB instead of a row per point, queries
+                   read both layouts, see :func:`pack_axis`
+    :param templates: clone files whose layout matches a catalogued
+                      file, see :meth:`clone_template`
+    """
+    def __init__(self, connection, packed=False, templates=True):
+        super().__init__(connection)
+        self.packed = packed
+        self.templates = templates
+        if getattr(self.connection, "read_only", False):
+            schema.check(self.connection)
+        else:
+            schema.migrate(self.connection)
 
-    def insert_netcdf(self, path):
-        """Coordinate and meta-data information taken from NetCDF file"""
+    @staticmethod
+    def configure(connection):
+        """Switch a catalogue opened for writing to WAL journaling
+
+        WAL lets readers carry on while ingest writes, the setting is
+        stored in the file so it is only changed once. New catalogues
+        use incremental auto-vacuum, which has to be chosen before
+        the first table is created, see :meth:`incremental_vacuum`
+        """
+        cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master")
+        tables, = cursor.fetchone()
+        if tables == 0:
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor = connection.execute("PRAGMA journal_mode")
+        mode, = cursor.fetchone()
+        if mode not in ("wal", "memory"):
+            connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    @attributed
+    def insert_netcdf(self, path, extractor="netcdf"):
+        """Coordinate and meta-data information taken from NetCDF file
+
+        With the netcdf extractor, files whose layout matches a
+        catalogued template are cloned without extracting variables
+
+        :param extractor: key of :data:`extract.EXTRACTORS`
+        """
+        if (extractor != "netcdf") or (not self.templates):
+            self.insert_metadata(extract.load(path, extractor=extractor))
+            return
         with netCDF4.Dataset(path) as dataset:
-            try:
-                obj = dataset.variables["forecast_reference_time"]
-                reference_time = netCDF4.num2date(obj[:], units=obj.units)
-            except KeyError:
-                reference_time = None
+            cache = {}
+            reference_time, fingerprint = extract.read_layout(
+                dataset, cache=cache)
+            if self.clone_template(path, reference_time, fingerprint):
+                return
+            metadata = extract.read_dataset(path, dataset, cache=cache)
+        self.insert_metadata(metadata)
 
-        self.insert_file_name(path, reference_time=reference_time)
+    @attributed
+    def insert_metadata(self, metadata):
+        """Insert meta-data extracted from a single file
 
-        cubes = iris.load(path)
-        for cube in cubes:
-            variable = cube.var_name
-            time_axis = self._axis(cube, 'time')
-            pressure_axis = self._axis(cube, 'pressure')
+        Unless templates=False, files with a known fingerprint are
+        cloned from their template, other files with datetime axes
+        become the template for their fingerprint
+        """
+        path = metadata.path
+        if self.clone_template(
+                path, metadata.reference_time, metadata.fingerprint):
+            if metadata.signature is not None:
+                self.update_signature(path, metadata.signature)
+            return
+        self.insert_file_name(path, reference_time=metadata.reference_time)
+        for variable in metadata.variables:
             self.insert_variable(
                 path,
-                variable,
-                time_axis=time_axis,
-                pressure_axis=pressure_axis)
-            try:
-                times = [cell.point for cell in cube.coord('time').cells()]
-                self.insert_times(path, variable, times)
-            except iris.exceptions.CoordinateNotFoundError:
-                pass
-            try:
-                pressures = [cell.point for cell in cube.coord('pressure').cells()]
-                self.insert_pressures(path, variable, pressures)
-            except iris.exceptions.CoordinateNotFoundError:
-                pass
+                variable.name,
+                time_axis=variable.time_axis,
+                pressure_axis=variable.pressure_axis)
+            if variable.times is not None:
+                self.insert_times(path, variable.name, variable.times)
+            if variable.pressures is not None:
+                self.insert_pressures(path, variable.name, variable.pressures)
+        if self.templates and (metadata.fingerprint is not None) and (
+                _shiftable(metadata)):
+            self.cursor.execute("""
+                INSERT OR IGNORE INTO template (fingerprint, file_id)
+                SELECT :fingerprint, id FROM file WHERE name = :path
+            """, dict(fingerprint=metadata.fingerprint, path=path))
+        # Written last, so a partially inserted file is never
+        # mistaken for an unchanged one by incremental ingest
+        if metadata.signature is not None:
+            self.update_signature(path, metadata.signature)
 
-    @staticmethod
-    def _axis(cube, coord):
-        try:
-            dims = cube.coord_dims(coord)
-            if len(dims) == 0:
-                return None
-            else:
-                return dims[0]
-        except iris.exceptions.CoordinateNotFoundError:
-            return None
+    @attributed
+    def clone_template(self, path, reference_time, fingerprint):
+        """Catalogue path as a copy of the template for fingerprint
+
+        Variables, pressures and packed pressure axes are shared with
+        the template file, times are shifted by the difference in
+        reference time, per-point times in SQL
 
+        :returns: True if a template was found and cloned
+        """
+        if (not self.templates) or (fingerprint is None):
+            return False
+        self.cursor.execute("""
+            SELECT file.id, file.reference
+              FROM template
+              JOIN file
+                ON file.id = template.file_id
+             WHERE template.fingerprint = :fingerprint
+        """, dict(fingerprint=fingerprint))
+        row = self.cursor.fetchone()
+        if row is None:
+            return False
+        template_id, template_reference = row
+        self.insert_file_name(path, reference_time=reference_time)
+        self.cursor.execute("""
+            SELECT id FROM file WHERE name = :path
+        """, dict(path=path))
+        file_id, = self.cursor.fetchone()
+        params = dict(
+            template=template_id,
+            file=file_id,
+            shift=to_epoch(reference_time) - template_reference)
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO variable (
+                   name, time_axis, pressure_axis, file_id,
+                   pressure_axis_id)
+            SELECT name, time_axis, pressure_axis, :file, pressure_axis_id
+              FROM variable
+             WHERE file_id = :template
+        """, params)
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO variable_to_pressure (
+                   variable_id, pressure_id)
+            SELECT clone.id, vp.pressure_id
+              FROM variable AS v
+              JOIN variable_to_pressure AS vp
+                ON vp.variable_id = v.id
+              JOIN variable AS clone
+                ON clone.file_id = :file AND clone.name = v.name
+             WHERE v.file_id = :template
+        """, params)
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO time (i, value)
+            SELECT DISTINCT t.i, t.value + :shift
+              FROM variable AS v
+              JOIN variable_to_time AS vt
+                ON vt.variable_id = v.id
+              JOIN time AS t
+                ON t.id = vt.time_id
+             WHERE v.file_id = :template
+        """, params)
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO variable_to_time (variable_id, time_id)
+            SELECT clone.id, shifted.id
+              FROM variable AS v
+              JOIN variable_to_time AS vt
+                ON vt.variable_id = v.id
+              JOIN time AS t
+                ON t.id = vt.time_id
+              JOIN time AS shifted
+                ON shifted.i = t.i AND shifted.value = t.value + :shift
+              JOIN variable AS clone
+                ON clone.file_id = :file AND clone.name = v.name
+             WHERE v.file_id = :template
+        """, params)
+        self.cursor.execute("""
+            SELECT DISTINCT axis.id, axis.data
+              FROM axis
+              JOIN variable AS v
+                ON v.time_axis_id = axis.id
+             WHERE v.file_id = :template
+        """, params)
+        for axis_id, data in self.cursor.fetchall():
+            digest, data = pack_axis(
+                "time", unpack_axis("time", data) + params["shift"])
+            self.cursor.execute("""
+                INSERT OR IGNORE INTO axis (kind, digest, size, data)
+                VALUES ('time', :digest, :size, :data)
+            """, dict(
+                digest=digest,
+                size=len(data) // AXIS_DTYPES["time"].itemsize,
+                data=data))
+            self.cursor.execute("""
+                UPDATE variable
+                   SET time_axis_id = (
+                       SELECT id FROM axis WHERE digest = :digest)
+                 WHERE file_id = :file
+                   AND name IN (
+                       SELECT name FROM variable
+                        WHERE file_id = :template
+                          AND time_axis_id = :axis)
+            """, dict(params, digest=digest, axis=axis_id))
+        return True
+
+    @attributed
     def initial_times(self, pattern=None):
         """Distinct initialisation times"""
-        if pattern is None:
-            query = """
-                SELECT DISTINCT reference
-                  FROM file
-                 WHERE reference IS NOT NULL
-                 ORDER BY reference
-            """
-        else:
-            query = """
-                SELECT DISTINCT reference
-                  FROM file
-                 WHERE reference IS NOT NULL
-                   AND name GLOB :pattern
-                 ORDER BY reference;
-            """
-        self.cursor.execute(query, dict(pattern=pattern))
+        params = self._pattern_params(pattern)
+        self.cursor.execute(INITIAL_TIMES[_filters(**params)], params)
         rows = self.cursor.fetchall()
-        return [r for r, in rows]
+        return [from_epoch(r) for r, in rows]
 
+    @attributed
+    def menus(self, state):
+        """Choices for every dropdown related to state in one query
+
+        Pressures and valid times are only searched once
+        state.initial_time is known
+
+        :param state: object with pattern, variable and initial_time
+        :returns: Menus with sorted, distinct values
+        """
+        params = dict(
+            variable=state.variable,
+            initial_time=to_epoch(state.initial_time),
+            **self._pattern_params(state.pattern))
+        self.cursor.execute(MENUS[_filters(**params)], params)
+        groups = {key: [] for key in Menus._fields}
+        for key, value in self.cursor.fetchall():
+            groups[key].append(value)
+        groups["pressures"] = _merge(groups["pressures"], "pressure")
+        groups["valid_times"] = _merge(groups["valid_times"], "time")
+        for key in ("initial_times", "valid_times"):
+            groups[key] = [from_epoch(value) for value in groups[key]]
+        if state.initial_time is None:
+            groups["pressures"] = None
+            groups["valid_times"] = None
+        return Menus(**groups)
+
+    @attributed
     def files(self, pattern=None):
         """File names"""
-        if pattern is None:
-            query = """
-                SELECT name
-                  FROM file
-                 ORDER BY name;
-            """
-        else:
-            query = """
-                SELECT name
-                  FROM file
-                 WHERE name GLOB :pattern
-                 ORDER BY name;
-            """
-        self.cursor.execute(query, dict(pattern=pattern))
+        params = self._pattern_params(pattern)
+        self.cursor.execute(FILES[_filters(**params)], params)
         rows = self.cursor.fetchall()
         return [r for r, in rows]
 
+    @attributed
     def variables(self, pattern=None):
-        # Note: SQL injection possible if not properly escaped
-        #       use ? and :name syntax in template
-        environment = jinja2.Environment(extensions=['jinja2.ext.do'])
-        query = environment.from_string("""
-            SELECT DISTINCT variable.name
-              FROM variable
-              {% if pattern is not none %}
-              JOIN file
-                ON file.id = variable.file_id
-             WHERE file.name GLOB :pattern
-              {% endif %}
-             ORDER BY variable.name;
-        """).render(pattern=pattern)
-        self.cursor.execute(query, dict(pattern=pattern))
+        params = self._pattern_params(pattern)
+        self.cursor.execute(VARIABLES[_filters(**params)], params)
         rows = self.cursor.fetchall()
         return [r for r, in rows]
 
+    @attributed
     def insert_file_name(self, path, reference_time=None):
         self.cursor.execute("""
             INSERT OR IGNORE INTO file (name, reference)
             VALUES (:path, :reference)
-        """, dict(path=path, reference=reference_time))
+        """, dict(path=path, reference=to_epoch(reference_time)))
+        if self.cursor.rowcount > 0:
+            # New file, record which models it belongs to
+            self.cursor.execute("""
+                INSERT OR IGNORE INTO file_model (model_id, file_id)
+                SELECT model.id, file.id
+                  FROM model
+                  JOIN file
+                    ON file.name GLOB model.pattern
+                 WHERE file.name = :path
+            """, dict(path=path))
+
+    @attributed
+    def insert_model(self, name, pattern):
+        """Register a model pattern, e.g. from config.yaml
 
+        Membership of existing files is computed immediately, files
+        inserted later are classified by :meth:`insert_file_name`
+        """
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO model (name, pattern)
+            VALUES (:name, :pattern)
+        """, dict(name=name, pattern=pattern))
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO file_model (model_id, file_id)
+            SELECT model.id, file.id
+              FROM model
+              JOIN file
+                ON file.name GLOB model.pattern
+             WHERE model.pattern = :pattern
+        """, dict(pattern=pattern))
+        self.models = None
+
+    @attributed
+    def generation(self):
+        """Counter that changes whenever ingest modifies the catalogue"""
+        self.cursor.execute("SELECT value FROM generation WHERE id = 1")
+        value, = self.cursor.fetchone()
+        return value
+
+    @attributed
+    def bump_generation(self):
+        self.cursor.execute("""
+            UPDATE generation SET value = value + 1 WHERE id = 1
+        """)
+
+    @attributed
+    def signature(self, path):
+        """Size, mtime and checksum recorded when path was inserted
+
+        :returns: extract.Signature or None if path is not catalogued
+        """
+        self.cursor.execute("""
+            SELECT size, mtime, checksum FROM file WHERE name = :path
+        """, dict(path=path))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return extract.Signature(*row)
+
+    @attributed
+    def update_signature(self, path, signature):
+        self.cursor.execute("""
+            UPDATE file
+               SET size = :size, mtime = :mtime, checksum = :checksum
+             WHERE name = :path
+        """, dict(path=path, **signature._asdict()))
+
+    @attributed
+    def delete_file(self, path):
+        """Remove a file and its variables from the catalogue
+
+        Time, pressure and packed axis rows are shared between files
+        and are left in place, see :meth:`collect_garbage`
+        """
+        self.cursor.execute("""
+            DELETE FROM variable_to_time
+             WHERE variable_id IN (
+                   SELECT variable.id FROM variable
+                     JOIN file ON file.id = variable.file_id
+                    WHERE file.name = :path)
+        """, dict(path=path))
+        self.cursor.execute("""
+            DELETE FROM variable_to_pressure
+             WHERE variable_id IN (
+                   SELECT variable.id FROM variable
+                     JOIN file ON file.id = variable.file_id
+                    WHERE file.name = :path)
+        """, dict(path=path))
+        self.cursor.execute("""
+            DELETE FROM variable
+             WHERE file_id IN (SELECT id FROM file WHERE name = :path)
+        """, dict(path=path))
+        self.cursor.execute("""
+            DELETE FROM file_model
+             WHERE file_id IN (SELECT id FROM file WHERE name = :path)
+        """, dict(path=path))
+        self.cursor.execute("""
+            DELETE FROM template
+             WHERE file_id IN (SELECT id FROM file WHERE name = :path)
+        """, dict(path=path))
+        self.cursor.execute("""
+            DELETE FROM file WHERE name = :path
+        """, dict(path=path))
+
+    @attributed
+    def files_before(self, reference_time):
+        """Files of runs initialised before reference_time"""
+        self.cursor.execute("""
+            SELECT name FROM file
+             WHERE reference < :reference
+             ORDER BY reference, name
+        """, dict(reference=to_epoch(reference_time)))
+        return [name for name, in self.cursor.fetchall()]
+
+    @attributed
+    def collect_garbage(self, batch_size=GC_BATCH_SIZE):
+        """Delete rows no longer referenced by any file, see ORPHANS
+
+        Each table is swept in windows of batch_size rowids that are
+        committed separately, so ingest and readers are never locked
+        out for long
+
+        :returns: dict of table name to number of rows deleted
+        """
+        self.connection.commit()
+        removed = {}
+        for table, condition in ORPHANS:
+            self.cursor.execute("SELECT MAX(rowid) FROM {}".format(table))
+            last, = self.cursor.fetchone()
+            removed[table] = 0
+            for start in range(0, last or 0, batch_size):
+                self.cursor.execute("""
+                    DELETE FROM {}
+                     WHERE rowid > :start AND rowid <= :stop AND {}
+                """.format(table, condition), dict(
+                    start=start,
+                    stop=start + batch_size))
+                removed[table] += self.cursor.rowcount
+                self.connection.commit()
+        return removed
+
+    @attributed
+    def incremental_vacuum(self, pages=VACUUM_PAGES, convert=False):
+        """Return free pages to the file system a few at a time
+
+        Catalogues created without incremental auto-vacuum keep free
+        pages for reuse and release none, unless convert=True, which
+        runs a one-off VACUUM that locks the catalogue until the whole
+        file has been rewritten
+
+        :returns: number of pages released
+        """
+        self.connection.commit()
+        self.cursor.execute("PRAGMA freelist_count")
+        free, = self.cursor.fetchone()
+        self.cursor.execute("PRAGMA auto_vacuum")
+        mode, = self.cursor.fetchone()
+        if mode != 2:
+            if not convert:
+                return 0
+            self.cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.cursor.execute("VACUUM")
+            return free
+        released = 0
+        while free > 0:
+            # execute() would step the pragma once, releasing one page
+            self.connection.executescript(
+                "PRAGMA incremental_vacuum({:d})".format(pages))
+            self.cursor.execute("PRAGMA freelist_count")
+            remaining, = self.cursor.fetchone()
+            if remaining >= free:
+                break
+            released += free - remaining
+            free = remaining
+        return released
+
+    @attributed
     def insert_variable(
             self,
             path,
@@ -412,11 +1429,55 @@ class Database(Connection):
             time_axis=time_axis,
             pressure_axis=pressure_axis))
 
+    @attributed
     def insert_pressures(self, path, variable, values):
-        """Helper method to insert a coordinate related to a variable"""
-        for i, value in enumerate(values):
-            self.insert_pressure(path, variable, value, i)
+        """Helper method to insert a coordinate related to a variable
 
+        File and variable ids are resolved once, pressure and
+        junction rows are then written with executemany
+        """
+        if self.packed:
+            self.insert_axis(path, variable, "pressure", values)
+            return
+        variable_id = self._variable_id(path, variable)
+        data = [dict(i=i, value=value) for i, value in enumerate(values)]
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO pressure (i, value) VALUES (:i, :value)
+        """, data)
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO variable_to_pressure (variable_id, pressure_id)
+            SELECT :variable_id, id FROM pressure WHERE i = :i AND value = :value
+        """, [dict(variable_id=variable_id, **row) for row in data])
+
+    @attributed
+    def insert_axis(self, path, variable, kind, values):
+        """Point a variable at a packed axis, stored once per content
+
+        :param kind: 'time' (epoch seconds) or 'pressure'
+        """
+        variable_id = self._variable_id(path, variable)
+        digest, data = pack_axis(kind, values)
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO axis (kind, digest, size, data)
+            VALUES (:kind, :digest, :size, :data)
+        """, dict(kind=kind, digest=digest, size=len(values), data=data))
+        self.cursor.execute("""
+            UPDATE variable
+               SET {}_axis_id = (SELECT id FROM axis WHERE digest = :digest)
+             WHERE id = :variable_id
+        """.format(kind), dict(digest=digest, variable_id=variable_id))
+
+    def _variable_id(self, path, variable):
+        """Insert (path, variable) if needed and return variable.id"""
+        self.insert_variable(path, variable)
+        self.cursor.execute("""
+            SELECT variable.id FROM variable
+              JOIN file ON variable.file_id = file.id
+             WHERE file.name = :path AND variable.name = :variable
+        """, dict(path=path, variable=variable))
+        return self.cursor.fetchone()[0]
+
+    @attributed
     def insert_pressure(self, path, variable, pressure, i):
         self.insert_variable(path, variable)
         self.cursor.execute("""
@@ -431,107 +1492,75 @@ class Database(Connection):
                 (SELECT id FROM pressure WHERE value=:pressure AND i=:i))
         """, dict(path=path, variable=variable, pressure=pressure, i=i))
 
+    @attributed
     def valid_times(self,
                     variable=None,
                     pattern=None,
                     initial_time=None):
-        """Valid times associated with search criteria"""
-        # Note: SQL injection possible if not properly escaped
-        #       use ? and :name syntax in template
-        environment = jinja2.Environment(extensions=['jinja2.ext.do'])
-        query = environment.from_string("""
-            {% set EQNS = [] %}
-            {% if initial_time is not none %}
-               {% do EQNS.append('file.reference = :initial_time') %}
-            {% endif %}
-            {% if pattern is not none %}
-               {% do EQNS.append('file.name GLOB :pattern') %}
-            {% endif %}
-            {% if variable is not none %}
-               {% do EQNS.append('v.name = :variable') %}
-            {% endif %}
-            SELECT time.value
-              FROM time
-             {% if EQNS %}
-              JOIN variable_to_time AS vt
-                ON vt.time_id = time.id
-              JOIN variable AS v
-                ON vt.variable_id = v.id
-              JOIN file
-                ON v.file_id = file.id
-             WHERE {{ EQNS | join(' AND ') }}
-             {% endif %}
-        """).render(
-            initial_time=initial_time,
+        """Distinct valid times associated with search criteria"""
+        params = dict(
             variable=variable,
-            pattern=pattern)
-        self.cursor.execute(query, dict(
-            variable=variable,
-            pattern=pattern,
-            initial_time=initial_time))
+            initial_time=to_epoch(initial_time),
+            **self._pattern_params(pattern))
+        self.cursor.execute(VALID_TIMES[_filters(**params)], params)
         rows = self.cursor.fetchall()
-        return [time for time, in rows]
+        times = _merge([r for r, in rows], "time")
+        return [from_epoch(time) for time in times]
 
+    @attributed
     def pressures(self, variable=None, pattern=None, initial_time=None):
         """Select pressures from database"""
-        # Note: SQL injection possible if not properly escaped
-        #       use ? and :name syntax in template
-        environment = jinja2.Environment(extensions=['jinja2.ext.do'])
-        query = environment.from_string("""
-            {% set EQNS = [] %}
-            {% if variable is not none %}
-               {% do EQNS.append('v.name = :variable') %}
-            {% endif %}
-            {% if pattern is not none %}
-               {% do EQNS.append('file.name GLOB :pattern') %}
-            {% endif %}
-            {% if initial_time is not none %}
-               {% do EQNS.append('file.reference = :initial_time') %}
-            {% endif %}
-            {% if EQNS %}
-            SELECT DISTINCT pressure.value
-              FROM pressure
-              JOIN variable_to_pressure AS vp
-                ON vp.pressure_id = pressure.id
-              JOIN variable AS v
-                ON v.id = vp.variable_id
-              JOIN file
-                ON v.file_id = file.id
-             WHERE {{ EQNS | join(' AND ') }}
-             ORDER BY value
-             {% else %}
-            SELECT DISTINCT value
-              FROM pressure
-             ORDER BY value
-             {% endif %}
-        """).render(
-            variable=variable,
-            pattern=pattern,
-            initial_time=initial_time)
-        self.cursor.execute(query, dict(
+        params = dict(
             variable=variable,
-            pattern=pattern,
-            initial_time=initial_time))
+            initial_time=to_epoch(initial_time),
+            **self._pattern_params(pattern))
+        self.cursor.execute(PRESSURES[_filters(**params)], params)
         rows = self.cursor.fetchall()
-        return [time for time, in rows]
+        return _merge([r for r, in rows], "pressure")
 
+    @attributed
     def fetch_times(self, path, variable):
         """Helper method to find times related to a variable"""
         self.cursor.execute("""
             SELECT value FROM time
+             UNION ALL
+            SELECT data FROM axis WHERE kind = 'time'
         """)
-        return [time for time, in self.cursor.fetchall()]
+        times = []
+        for value, in self.cursor.fetchall():
+            if isinstance(value, bytes):
+                times += unpack_axis("time", value).tolist()
+            else:
+                times.append(value)
+        return [from_epoch(time) for time in times]
 
+    @attributed
     def insert_times(self, path, variable, times):
-        """Helper method to insert a time coordinate related to a variable"""
-        for i, time in enumerate(times):
-            self.insert_time(path, variable, time, i)
+        """Helper method to insert a time coordinate related to a variable
+
+        Same strategy as :meth:`insert_pressures`, one id lookup and
+        two executemany statements for the whole axis
+        """
+        if self.packed:
+            self.insert_axis(
+                path, variable, "time", [to_epoch(time) for time in times])
+            return
+        variable_id = self._variable_id(path, variable)
+        data = [dict(i=i, value=to_epoch(time)) for i, time in enumerate(times)]
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO time (i, value) VALUES (:i, :value)
+        """, data)
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO variable_to_time (variable_id, time_id)
+            SELECT :variable_id, id FROM time WHERE i = :i AND value = :value
+        """, [dict(variable_id=variable_id, **row) for row in data])
 
+    @attributed
     def insert_time(self, path, variable, time, i):
         self.insert_variable(path, variable)
         self.cursor.execute("""
             INSERT OR IGNORE INTO time (i, value) VALUES (:i,:value)
-        """, dict(i=i, value=str(time)))
+        """, dict(i=i, value=to_epoch(time)))
         self.cursor.execute("""
             INSERT OR IGNORE INTO variable_to_time (variable_id, time_id)
             VALUES(
@@ -539,8 +1568,9 @@ class Database(Connection):
                    JOIN file ON variable.file_id = file.id
                   WHERE file.name=:path AND variable.name=:variable),
                 (SELECT id FROM time WHERE value=:value AND i=:i))
-        """, dict(path=path, variable=variable, value=str(time), i=i))
+        """, dict(path=path, variable=variable, value=to_epoch(time), i=i))
 
+    @attributed
     def find_time(self, variable, time):
         self.cursor.execute("""
             SELECT file.name, time.i FROM file
@@ -548,12 +1578,14 @@ class Database(Connection):
               JOIN variable_to_time AS junction ON variable.id = junction.variable_id
               JOIN time ON time.id = junction.time_id
              WHERE variable.name = :variable AND time.value = :time
-        """, dict(variable=variable, time=time))
+        """, dict(variable=variable, time=to_epoch(time)))
         return self.cursor.fetchall()
 
+    @attributed
     def find_pressure(self, variable, pressure):
         return self.find(variable, pressure)
 
+    @attributed
     def find(self, variable, pressure):
         self.cursor.execute("""
             SELECT file.name, pressure.i FROM file
@@ -564,13 +1596,18 @@ class Database(Connection):
         """, dict(variable=variable, pressure=pressure))
         return self.cursor.fetchall()
 
+    @attributed
     def file_names(self):
         self.cursor.execute("SELECT name FROM file")
         return [row[0] for row in self.cursor.fetchall()]
 
+    @attributed
     def fetch_dates(self, pattern=None):
         self.cursor.execute("""
             SELECT DISTINCT value FROM time
+             UNION ALL
+            SELECT data FROM axis WHERE kind = 'time'
         """)
         rows = self.cursor.fetchall()
-        return [row[0] for row in rows]
+        return [from_epoch(time) for time in _merge(
+            [row[0] for row in rows], "time")]
@@ -0,0 +1,343 @@
+"""Extract catalogue meta-data from NetCDF files
+
+Extraction is kept separate from :class:`database.Database` so that
+the expensive part of ingest can run in worker processes, the
+returned :class:`Metadata` is a plain picklable structure that a
+single writer inserts into the catalogue
+"""
+import datetime as dt
+import hashlib
+import os
+from collections import namedtuple
+import iris
+import netCDF4
+import numpy as np
+
+
+Metadata = namedtuple("Metadata", (
+    "path",
+    "reference_time",
+    "variables",
+    "signature",
+    "fingerprint"))
+Metadata.__new__.__defaults__ = (None, None)
+
+Variable = namedtuple("Variable", (
+    "name",
+    "time_axis",
+    "pressure_axis",
+    "times",
+    "pressures"))
+
+
+Signature = namedtuple("Signature", (
+    "size",
+    "mtime",
+    "checksum"))
+Signature.__new__.__defaults__ = (None,)
+
+
+def signature(path, checksum=False):
+    """Size and modification time, plus content hash if checksum=True"""
+    stat = os.stat(path)
+    value = None
+    if checksum:
+        value = file_checksum(path)
+    return Signature(size=stat.st_size, mtime=stat.st_mtime, checksum=value)
+
+
+def unchanged(stored, signature):
+    """True if a catalogued signature matches size and mtime"""
+    return (stored is not None) and (signature is not None) and (
+        stored[:2] == signature[:2])
+
+
+def file_checksum(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load(path, extractor="netcdf"):
+    """Meta-data taken from NetCDF file using a named extractor"""
+    return EXTRACTORS[extractor](path)
+
+
+def load_iris(path):
+    """Meta-data taken from NetCDF file using iris cubes
+
+    .. note:: iris builds full cubes to answer coord_dims and
+              cells(), :func:`load_netcdf` is much cheaper
+    """
+    reference_time = load_reference_time(path)
+    variables = []
+    for cube in iris.load(path):
+        variables.append(Variable(
+            name=cube.var_name,
+            time_axis=_axis(cube, 'time'),
+            pressure_axis=_axis(cube, 'pressure'),
+            times=_points(cube, 'time', to_datetime),
+            pressures=_points(cube, 'pressure', float)))
+    return Metadata(
+        path=path,
+        reference_time=reference_time,
+        variables=variables)
+
+
+def load_netcdf(path):
+    """Meta-data taken from NetCDF file in a single netCDF4 open
+
+    Mirrors the subset of iris CF rules needed to catalogue a file
+    without building cubes, see :func:`load_iris`
+    """
+    with netCDF4.Dataset(path) as dataset:
+        return read_dataset(path, dataset)
+
+
+def read_dataset(path, dataset, cache=None):
+    """Meta-data from an open netCDF4.Dataset-like object
+
+    Only ``dataset.variables``, ``obj.dimensions``, ``obj.ncattrs()``,
+    ``obj.getncattr(name)`` and ``obj[:]`` are used
+
+    :param cache: dict of coordinate values already read by
+                  :func:`read_layout`, each coordinate is read once
+    """
+    if cache is None:
+        cache = {}
+    reference_time, digest = read_layout(dataset, cache=cache)
+    variables = dataset.variables
+    auxiliary = _referenced_names(variables)
+    result = []
+    for name, obj in variables.items():
+        if _is_dimension_coordinate(name, obj) or (name in auxiliary):
+            continue
+        coords = _coordinates(obj, variables)
+        time_axis, times = _coordinate(obj, coords, 'time')
+        pressure_axis, pressures = _coordinate(obj, coords, 'pressure')
+        result.append(Variable(
+            name=name,
+            time_axis=time_axis,
+            pressure_axis=pressure_axis,
+            times=None if times is None else _times(times, cache),
+            pressures=None if pressures is None else _values(
+                pressures, float, cache)))
+    return Metadata(
+        path=path,
+        reference_time=reference_time,
+        variables=result,
+        fingerprint=digest)
+
+
+def read_layout(dataset, cache=None):
+    """Reference time and structural fingerprint of a dataset
+
+    The fingerprint covers everything :func:`read_dataset` catalogues
+    except the run itself: variable names, dimensions, the attributes
+    that select variables and coordinates, pressure values and time
+    values relative to the reference time. Files from different runs
+    of one model configuration share a fingerprint, see
+    database.Database.clone_template
+
+    :param cache: dict that coordinate values are read into, pass
+                  it on to :func:`read_dataset` to avoid reading them
+                  twice
+    :returns: (reference_time, fingerprint), fingerprint is None
+              if there is no reference time
+    """
+    reference_time = _dataset_reference_time(dataset)
+    if reference_time is None:
+        return None, None
+    digest = hashlib.blake2b(digest_size=16)
+    for name, obj in sorted(dataset.variables.items()):
+        attrs = obj.ncattrs()
+        layout = [
+            (attr, str(obj.getncattr(attr)))
+            for attr in _LAYOUT_ATTRS if attr in attrs]
+        digest.update(repr((name, tuple(obj.dimensions), layout)).encode())
+        if _name(obj) in ("time", "pressure"):
+            digest.update(_relative_values(obj, reference_time, cache))
+    return reference_time, digest.digest()
+
+
+def _relative_values(obj, reference_time, cache):
+    """Coordinate values as bytes, times as offsets from reference"""
+    values = np.asarray(_data(obj, cache), dtype=np.float64)
+    units = ""
+    if "units" in obj.ncattrs():
+        units = str(obj.getncattr("units"))
+    if " since " in units:
+        calendar = "standard"
+        if "calendar" in obj.ncattrs():
+            calendar = obj.getncattr("calendar")
+        values = values - netCDF4.date2num(
+            reference_time, units=units, calendar=calendar)
+        units = units.split(" since ")[0]
+    return repr(units).encode() + values.astype("<f8").tobytes()
+
+
+def load_reference_time(path):
+    with netCDF4.Dataset(path) as dataset:
+        return _dataset_reference_time(dataset)
+
+
+def _dataset_reference_time(dataset):
+    try:
+        return _reference_time(
+            dataset.variables["forecast_reference_time"])
+    except KeyError:
+        return None
+
+
+def _reference_time(obj):
+    return to_datetime(netCDF4.num2date(
+        obj[:],
+        units=obj.units,
+        only_use_cftime_datetimes=False))
+
+
+# Attributes that mark a variable as part of another variable's
+# description rather than a data variable in its own right
+_REFERENCE_ATTRS = (
+    "coordinates",
+    "bounds",
+    "climatology",
+    "grid_mapping",
+    "ancillary_variables")
+
+
+# Attributes that decide how a variable is catalogued, the units of
+# time coordinates are compared relative to the reference time
+_LAYOUT_ATTRS = (
+    "standard_name",
+    "long_name",
+    "calendar",
+    "cell_measures",
+    "formula_terms") + _REFERENCE_ATTRS
+
+
+def _referenced_names(variables):
+    names = set()
+    for obj in variables.values():
+        attrs = obj.ncattrs()
+        for attr in _REFERENCE_ATTRS:
+            if attr in attrs:
+                names.update(str(obj.getncattr(attr)).split())
+        if "cell_measures" in attrs:
+            # e.g. "area: cell_area volume: cell_volume"
+            words = str(obj.getncattr("cell_measures")).split()
+            names.update(w for w in words if not w.endswith(":"))
+        if "formula_terms" in attrs:
+            # e.g. "a: var_a b: var_b"
+            words = str(obj.getncattr("formula_terms")).split()
+            names.update(w for w in words if not w.endswith(":"))
+    return names
+
+
+def _is_dimension_coordinate(name, obj):
+    return tuple(obj.dimensions) == (name,)
+
+
+def _coordinates(obj, variables):
+    """Dimension and auxiliary coordinates of a data variable"""
+    coords = []
+    for dim in obj.dimensions:
+        if (dim in variables) and _is_dimension_coordinate(
+                dim, variables[dim]):
+            coords.append(variables[dim])
+    if "coordinates" in obj.ncattrs():
+        for name in str(obj.getncattr("coordinates")).split():
+            if name in variables:
+                coords.append(variables[name])
+    return coords
+
+
+def _coordinate(obj, coords, name):
+    """Axis and coordinate variable matching iris cube.coord(name)"""
+    for coord in coords:
+        if _name(coord) == name:
+            dims = [obj.dimensions.index(d) for d in coord.dimensions
+                    if d in obj.dimensions]
+            axis = dims[0] if len(dims) > 0 else None
+            return axis, coord
+    return None, None
+
+
+def _name(obj):
+    """Equivalent of iris CFVariableMixin.name()"""
+    attrs = obj.ncattrs()
+    for attr in ("standard_name", "long_name"):
+        if attr in attrs:
+            return obj.getncattr(attr)
+    return obj.name
+
+
+def _times(obj, cache=None):
+    if "units" not in obj.ncattrs():
+        return _values(obj, float, cache)
+    calendar = "standard"
+    if "calendar" in obj.ncattrs():
+        calendar = obj.getncattr("calendar")
+    points = netCDF4.num2date(
+        _data(obj, cache),
+        units=obj.getncattr("units"),
+        calendar=calendar,
+        only_use_cftime_datetimes=False)
+    return [to_datetime(point) for point in points]
+
+
+def _values(obj, convert, cache=None):
+    return [convert(x) for x in _data(obj, cache)]
+
+
+def _data(obj, cache):
+    """Flat values of a coordinate, read at most once into cache"""
+    if cache is None:
+        return np.ma.getdata(obj[:]).ravel()
+    if obj.name not in cache:
+        cache[obj.name] = np.ma.getdata(obj[:]).ravel()
+    return cache[obj.name]
+
+
+def to_datetime(time):
+    """Convert cftime datetimes to datetime.datetime
+
+    Values without calendar information, e.g. time coordinates
+    missing a units attribute, are returned unchanged
+    """
+    if (type(time) is dt.datetime) or (not hasattr(time, "year")):
+        return time
+    return dt.datetime(
+        time.year,
+        time.month,
+        time.day,
+        time.hour,
+        time.minute,
+        time.second,
+        time.microsecond)
+
+
+def _axis(cube, coord):
+    try:
+        dims = cube.coord_dims(coord)
+        if len(dims) == 0:
+            return None
+        else:
+            return dims[0]
+    except iris.exceptions.CoordinateNotFoundError:
+        return None
+
+
+def _points(cube, coord, convert):
+    try:
+        return [convert(cell.point) for cell in cube.coord(coord).cells()]
+    except iris.exceptions.CoordinateNotFoundError:
+        return None
+
+
+EXTRACTORS = {
+    "iris": load_iris,
+    "netcdf": load_netcdf
+}
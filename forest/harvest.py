@@ -0,0 +1,555 @@
+"""Concurrent meta-data harvesting from local or remote NetCDF files
+
+Object storage answers each request slowly but serves many in
+parallel, so files are harvested concurrently by asyncio tasks that
+fetch byte ranges through a :class:`Fetcher`. For netCDF classic
+files only the header and the bytes of the time, pressure and
+reference time coordinates are fetched, records of a coordinate
+along the unlimited dimension are read in as few ranges as
+:data:`RANGE_GAP` allows. Either way the resulting
+:class:`extract.Metadata` matches :func:`extract.load_netcdf`
+
+.. note:: netCDF4/HDF5 files, e.g. most UM output, have no header
+          that can be parsed from leading bytes, so they are fetched
+          whole and opened in memory. Harvest them from a local disk
+          with main.py, which lets HDF5 read only what it needs
+"""
+import abc
+import asyncio
+import concurrent.futures
+import email.utils
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, namedtuple
+import netCDF4
+import numpy as np
+import extract
+
+
+# Files harvested at the same time
+CONCURRENCY = 16
+
+# Bytes fetched to parse a classic header, doubled until it fits
+HEADER_SIZE = 2**16
+
+# Unwanted bytes read rather than making a separate range request
+RANGE_GAP = 2**20
+
+
+class Fetcher(abc.ABC):
+    """Interface to read byte ranges of files"""
+    @abc.abstractmethod
+    async def read(self, url, start=0, stop=None):
+        """Bytes start:stop of url, shorter if the file ends first
+
+        :param stop: exclusive end offset, None reads to end of file
+        """
+
+    async def signature(self, url):
+        """extract.Signature of url, None if it can not be told"""
+        return None
+
+    def close(self):
+        """Release threads or connections held by the fetcher"""
+
+
+class LocalFetcher(Fetcher):
+    """Read paths or file:// URLs on a worker thread"""
+    async def read(self, url, start=0, stop=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._read, _local_path(url), start, stop)
+
+    async def signature(self, url):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, extract.signature, _local_path(url))
+
+    @staticmethod
+    def _read(path, start, stop):
+        with open(path, "rb") as stream:
+            stream.seek(start)
+            if stop is None:
+                return stream.read()
+            return stream.read(max(stop - start, 0))
+
+
+class HTTPFetcher(Fetcher):
+    """HTTP Range requests made with urllib on a thread pool
+
+    Servers that ignore the Range header are supported, the
+    requested bytes are sliced out of the full response
+    """
+    def __init__(self, max_workers=CONCURRENCY, timeout=30.):
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+    async def read(self, url, start=0, stop=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self._read, url, start, stop)
+
+    async def signature(self, url):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self._signature, url)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _signature(self, url):
+        """Content-Length and Last-Modified of a HEAD request"""
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            size = response.headers.get("Content-Length")
+            modified = response.headers.get("Last-Modified")
+        if (size is None) or (modified is None):
+            return None
+        mtime = email.utils.parsedate_to_datetime(modified).timestamp()
+        return extract.Signature(size=int(size), mtime=mtime)
+
+    def _read(self, url, start, stop):
+        if stop is None:
+            value = "bytes={}-".format(start)
+        elif stop <= start:
+            return b""
+        else:
+            value = "bytes={}-{}".format(start, stop - 1)
+        request = urllib.request.Request(url, headers={"Range": value})
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=self.timeout) as response:
+                content = response.read()
+                if response.status == 206:
+                    return content
+                return content[start:stop]
+        except urllib.error.HTTPError as error:
+            if error.code == 416:
+                # Range Not Satisfiable, start is beyond end of file
+                return b""
+            raise
+
+
+class SchemeFetcher(Fetcher):
+    """Dispatch to a fetcher by URL scheme, paths are local files
+
+    :param concurrency: threads making HTTP requests, if fetchers
+                        is None
+    """
+    def __init__(self, fetchers=None, concurrency=CONCURRENCY):
+        if fetchers is None:
+            local, http = LocalFetcher(), HTTPFetcher(max_workers=concurrency)
+            fetchers = {
+                "": local,
+                "file": local,
+                "http": http,
+                "https": http}
+        self.fetchers = fetchers
+
+    async def read(self, url, start=0, stop=None):
+        scheme = urllib.parse.urlparse(url).scheme
+        try:
+            fetcher = self.fetchers[scheme]
+        except KeyError:
+            raise ValueError("no fetcher for URL: {}".format(url))
+        return await fetcher.read(url, start, stop)
+
+    async def signature(self, url):
+        scheme = urllib.parse.urlparse(url).scheme
+        if scheme not in self.fetchers:
+            raise ValueError("no fetcher for URL: {}".format(url))
+        return await self.fetchers[scheme].signature(url)
+
+    def close(self):
+        for fetcher in set(self.fetchers.values()):
+            fetcher.close()
+
+
+def _local_path(url):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    return url
+
+
+def ingest(
+        database,
+        urls,
+        fetcher=None,
+        concurrency=CONCURRENCY,
+        batch_size=None,
+        incremental=False):
+    """Harvest urls and insert their meta-data into database
+
+    Like main.ingest, each batch of batch_size files bumps the
+    catalogue generation and is committed, in incremental mode
+    files whose size and mtime match the catalogue are skipped
+    """
+    stored = database.signature if incremental else None
+
+    async def run():
+        count = 0
+        async for metadata in harvest(
+                urls, fetcher, concurrency, stored=stored):
+            print("reading: {}".format(metadata.path))
+            if incremental:
+                database.delete_file(metadata.path)
+            database.insert_metadata(metadata)
+            count += 1
+            if (batch_size is not None) and (count % batch_size == 0):
+                database.bump_generation()
+                database.connection.commit()
+        if (count > 0) and ((batch_size is None) or (count % batch_size)):
+            database.bump_generation()
+            if batch_size is not None:
+                database.connection.commit()
+    asyncio.run(run())
+
+
+_DONE = object()
+
+
+async def harvest(urls, fetcher=None, concurrency=CONCURRENCY, stored=None):
+    """Meta-data of urls in completion order
+
+    At most concurrency files are harvested at once, urls are
+    consumed lazily so any iterable, e.g. a manifest, can be used.
+    A file that can not be read is reported on stderr and skipped
+
+    :param stored: callable returning the catalogued signature of a
+                   url, unchanged files are skipped, see
+                   extract.unchanged
+    """
+    owned = fetcher is None
+    if owned:
+        fetcher = SchemeFetcher(concurrency=concurrency)
+    urls = iter(urls)
+    queue = asyncio.Queue(maxsize=concurrency)
+
+    async def worker():
+        for url in urls:
+            try:
+                signature = await fetcher.signature(url)
+                if (stored is not None) and extract.unchanged(
+                        stored(url), signature):
+                    print("unchanged: {}".format(url))
+                    continue
+                metadata = await load(url, fetcher)
+            except Exception as error:
+                print("failed: {}: {!r}".format(url, error),
+                      file=sys.stderr)
+                continue
+            await queue.put(metadata._replace(signature=signature))
+
+    async def run(workers):
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            await queue.put(_DONE)
+
+    task = asyncio.ensure_future(run([
+        asyncio.ensure_future(worker()) for _ in range(concurrency)]))
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            yield item
+        await task
+    finally:
+        task.cancel()
+        if owned:
+            fetcher.close()
+
+
+async def load(url, fetcher, header_size=HEADER_SIZE):
+    """Meta-data of a single file read through fetcher"""
+    head = await fetcher.read(url, 0, header_size)
+    if head[:3] != b"CDF":
+        return await _load_full(url, fetcher, head)
+    while True:
+        try:
+            header = parse_header(head)
+            break
+        except Truncated:
+            if len(head) < header_size:
+                raise ValueError("truncated netCDF header: {}".format(url))
+            header_size *= 2
+            head += await fetcher.read(url, len(head), header_size)
+    if header.numrecs is None:
+        return await _load_full(url, fetcher, head)
+    dataset = Dataset(header)
+    await asyncio.gather(*[
+        _fetch(url, fetcher, header, name, dataset.variables[name])
+        for name in _required(dataset)])
+    return extract.read_dataset(url, dataset)
+
+
+async def _load_full(url, fetcher, head):
+    """Fall back to reading the whole file, e.g. netCDF4/HDF5
+
+    HDF5 headers are spread through the file, so there is no prefix
+    that could be fetched instead, see the module docstring
+    """
+    content = head + await fetcher.read(url, len(head))
+    with netCDF4.Dataset("inmemory.nc", memory=content) as dataset:
+        return extract.read_dataset(url, dataset)
+
+
+def _required(dataset):
+    """Variables whose values extract.read_dataset needs"""
+    names = []
+    for name, obj in dataset.variables.items():
+        if ((name == "forecast_reference_time") or
+                (extract._name(obj) in ("time", "pressure"))):
+            names.append(name)
+    return names
+
+
+async def _fetch(url, fetcher, header, name, obj):
+    """Set obj.data from the bytes of a single variable"""
+    variable = header.variables[name]
+    nbytes = _nbytes(variable)
+    if variable.record:
+        starts = [
+            variable.begin + r * header.recsize
+            for r in range(header.numrecs)]
+        ranges = _coalesce(starts, nbytes)
+        chunks = await asyncio.gather(*[
+            fetcher.read(url, first, stop) for first, stop, _ in ranges])
+        content = b"".join(
+            chunk[start - first:start - first + nbytes]
+            for (first, _, members), chunk in zip(ranges, chunks)
+            for start in members)
+        shape = (header.numrecs,) + variable.shape
+    else:
+        content = await fetcher.read(
+            url, variable.begin, variable.begin + nbytes)
+        shape = variable.shape
+    obj.data = _scale(obj, np.frombuffer(
+        content, dtype=variable.dtype).reshape(shape))
+
+
+def _coalesce(starts, nbytes, gap=RANGE_GAP):
+    """Merge reads of nbytes at sorted starts into fewer ranges
+
+    Reads separated by at most gap bytes share a range, so a
+    coordinate along the record dimension usually costs one request
+
+    :returns: list of (start, stop, starts covered) tuples
+    """
+    ranges = []
+    for start in starts:
+        if (len(ranges) > 0) and (start - ranges[-1][1] <= gap):
+            ranges[-1][1] = start + nbytes
+            ranges[-1][2].append(start)
+        else:
+            ranges.append([start, start + nbytes, [start]])
+    return [tuple(item) for item in ranges]
+
+
+def _scale(obj, values):
+    """Apply scale_factor and add_offset as netCDF4 does"""
+    attrs = obj.ncattrs()
+    if "scale_factor" in attrs:
+        values = values * obj.getncattr("scale_factor")
+    if "add_offset" in attrs:
+        values = values + obj.getncattr("add_offset")
+    return values
+
+
+# netCDF classic file format, see the NetCDF User Guide
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_TYPES = {
+    1: np.dtype("i1"),
+    2: np.dtype("S1"),
+    3: np.dtype(">i2"),
+    4: np.dtype(">i4"),
+    5: np.dtype(">f4"),
+    6: np.dtype(">f8"),
+    7: np.dtype("u1"),
+    8: np.dtype(">u2"),
+    9: np.dtype(">u4"),
+    10: np.dtype(">i8"),
+    11: np.dtype(">u8")}
+
+
+class Truncated(Exception):
+    """Header continues beyond the bytes fetched so far"""
+
+
+Header = namedtuple("Header", (
+    "numrecs",
+    "recsize",
+    "dimensions",
+    "variables"))
+
+HeaderVariable = namedtuple("HeaderVariable", (
+    "dimensions",
+    "attributes",
+    "dtype",
+    "shape",
+    "record",
+    "begin"))
+
+
+def parse_header(data):
+    """Dimensions, attributes and data offsets of a classic file
+
+    :param data: leading bytes of the file
+    :raises Truncated: if data ends before the header does
+    :returns: Header, numrecs is None for streaming files
+    """
+    if data[:3] != b"CDF":
+        raise ValueError("not a netCDF classic file")
+    version = data[3]
+    if version not in (1, 2, 5):
+        raise ValueError("unknown netCDF classic version {}".format(version))
+    reader = _Reader(data, version)
+    reader.take(4)
+    numrecs = reader.count()
+    if numrecs == (1 << (8 * reader.size)) - 1:
+        # STREAMING, number of records is not recorded
+        numrecs = None
+    dimensions = OrderedDict()
+    for _ in range(reader.list(NC_DIMENSION)):
+        name = reader.name()
+        dimensions[name] = reader.count()
+    reader.attributes()
+    variables = OrderedDict()
+    for _ in range(reader.list(NC_VARIABLE)):
+        name = reader.name()
+        dimids = [reader.count() for _ in range(reader.count())]
+        attributes = reader.attributes()
+        dtype = NC_TYPES[reader.int(4)]
+        reader.count()  # vsize, recomputed below for files > 4GiB
+        begin = reader.int(reader.offset)
+        names = tuple(list(dimensions)[i] for i in dimids)
+        record = (len(names) > 0) and (dimensions[names[0]] == 0)
+        variables[name] = HeaderVariable(
+            dimensions=names,
+            attributes=attributes,
+            dtype=dtype,
+            shape=tuple(dimensions[n] for n in names[int(record):]),
+            record=record,
+            begin=begin)
+    return Header(
+        numrecs=numrecs,
+        recsize=_recsize(variables),
+        dimensions=dimensions,
+        variables=variables)
+
+
+def _nbytes(variable):
+    """Size of a variable, or of one record of a record variable"""
+    size = int(np.prod(variable.shape, dtype=np.int64))
+    return size * variable.dtype.itemsize
+
+
+def _recsize(variables):
+    """Bytes per record, unpadded if there is one record variable"""
+    sizes = [_nbytes(v) for v in variables.values() if v.record]
+    if len(sizes) == 1:
+        return sizes[0]
+    return sum(size + (-size % 4) for size in sizes)
+
+
+class _Reader(object):
+    def __init__(self, data, version):
+        self.data = data
+        self.position = 0
+        self.size = 8 if version == 5 else 4
+        self.offset = 4 if version == 1 else 8
+
+    def take(self, n):
+        if self.position + n > len(self.data):
+            raise Truncated()
+        chunk = self.data[self.position:self.position + n]
+        self.position += n
+        return chunk
+
+    def int(self, n):
+        return int.from_bytes(self.take(n), "big")
+
+    def count(self):
+        return self.int(self.size)
+
+    def padded(self, n):
+        chunk = self.take(n)
+        self.take(-n % 4)
+        return chunk
+
+    def name(self):
+        return self.padded(self.count()).decode("utf-8")
+
+    def list(self, tag):
+        """Number of items in a tagged list, 0 if ABSENT"""
+        value, n = self.int(4), self.count()
+        if value not in (0, tag):
+            raise ValueError("unexpected netCDF header tag {}".format(value))
+        return n
+
+    def attributes(self):
+        attributes = OrderedDict()
+        for _ in range(self.list(NC_ATTRIBUTE)):
+            name = self.name()
+            dtype = NC_TYPES[self.int(4)]
+            n = self.count()
+            content = self.padded(n * dtype.itemsize)
+            if dtype.kind == "S":
+                value = content.decode("utf-8").rstrip("\x00")
+            else:
+                value = np.frombuffer(content, dtype=dtype).astype(
+                    dtype.newbyteorder("="))
+                if len(value) == 1:
+                    value = value[0]
+            attributes[name] = value
+        return attributes
+
+
+class Dataset(object):
+    """Subset of netCDF4.Dataset used by extract.read_dataset"""
+    def __init__(self, header):
+        self.dimensions = header.dimensions
+        self.variables = OrderedDict(
+            (name, Variable(name, variable.dimensions, variable.attributes))
+            for name, variable in header.variables.items())
+
+
+class Variable(object):
+    """Subset of netCDF4.Variable, values are set once harvested"""
+    def __init__(self, name, dimensions, attributes):
+        self.name = name
+        self.dimensions = dimensions
+        self.attributes = attributes
+        self.data = None
+
+    def ncattrs(self):
+        return list(self.attributes)
+
+    def getncattr(self, name):
+        return self.attributes[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["attributes"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if self.data is None:
+            raise ValueError("values of {} were not harvested".format(
+                self.name))
+        if self.data.ndim == 0:
+            # netCDF4 allows [:] on scalar variables
+            return self.data[()]
+        return self.data[key]
@@ -0,0 +1,295 @@
+"""In-memory alternative to database.Locator
+
+The variable/time/pressure mapping, per-point or packed, is read
+from the catalogue once and held in NumPy arrays grouped by (model,
+variable, reference time), so that :meth:`ArrayLocator.path_points`
+runs without SQL
+"""
+import threading
+import time
+from collections import defaultdict, namedtuple
+import numpy as np
+import snapshot
+from database import (
+    Connection, ConnectionManager, _points, to_epoch, unpack_axis)
+
+
+# Axes of variables without a time or pressure dimension
+NO_AXIS = -1
+
+
+Group = namedtuple("Group", (
+    "paths",
+    "time_axis",
+    "pressure_axis",
+    "time_offsets",
+    "times",
+    "time_i",
+    "pressure_offsets",
+    "pressures",
+    "pressure_i"))
+
+
+class ArrayLocator(Connection):
+    """Locate fields using arrays loaded from the catalogue
+
+    Answers path_points with the same (path, pts) tuples as
+    database.Locator. The arrays are rebuilt by :meth:`refresh`
+    whenever Database.generation() has moved on, with
+    check_interval=SECONDS path_points calls refresh at most that
+    often, by default only the first call loads the catalogue
+    """
+    def __init__(self, connection, check_interval=None):
+        super().__init__(connection)
+        self.check_interval = check_interval
+        self.generation = None
+        self.checked = None
+        self.groups = {}
+        self.matches = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Reload arrays if ingest has changed the catalogue
+
+        :returns: True if the arrays were rebuilt
+        """
+        with self.lock, self._attribute("refresh"):
+            self.checked = time.monotonic()
+            self.cursor.execute("SELECT value FROM generation WHERE id = 1")
+            generation, = self.cursor.fetchone()
+            if generation == self.generation:
+                return False
+            self.groups = self._load()
+            self.matches = {}
+            self.generation = generation
+            return True
+
+    def path_points(
+            self,
+            pattern,
+            variable,
+            initial_time,
+            valid_time,
+            pressure):
+        """Closest field, timed as path_points if instrumented"""
+        if self.stats is None:
+            return self._path_points(
+                pattern, variable, initial_time, valid_time, pressure)
+        return self.stats.timed("path_points", lambda: self._path_points(
+            pattern, variable, initial_time, valid_time, pressure))
+
+    def _path_points(
+            self,
+            pattern,
+            variable,
+            initial_time,
+            valid_time,
+            pressure):
+        if self._due():
+            self.refresh()
+        groups = self.groups
+        if pattern in groups:
+            group, registered = groups[pattern], True
+        else:
+            group, registered = groups[None], False
+        try:
+            entries = group[(variable, to_epoch(initial_time))]
+        except KeyError:
+            return None
+        paths = None if registered else self._glob(pattern)
+        return _nearest(entries, to_epoch(valid_time), pressure, paths)
+
+    def _glob(self, pattern):
+        """Paths matching an unregistered pattern
+
+        Matched by SQLite GLOB, like database.Locator, and cached
+        until the arrays are next rebuilt
+        """
+        matches = self.matches
+        if pattern not in matches:
+            with self._attribute("glob"):
+                self.cursor.execute("""
+                    SELECT name FROM file WHERE name GLOB :pattern
+                """, dict(pattern=pattern))
+                matches[pattern] = frozenset(
+                    name for name, in self.cursor.fetchall())
+        return matches[pattern]
+
+    def _due(self):
+        if self.generation is None:
+            return True
+        if self.check_interval is None:
+            return False
+        return (time.monotonic() - self.checked) >= self.check_interval
+
+    def _load(self):
+        """Arrays keyed by model pattern, None holds every file"""
+        self.cursor.execute("""
+            SELECT v.id, file.id, file.name, file.reference,
+                   v.name, v.time_axis, v.pressure_axis
+              FROM variable AS v
+              JOIN file
+                ON file.id = v.file_id
+             ORDER BY v.id
+        """)
+        rows = self.cursor.fetchall()
+        self.cursor.execute("""
+            SELECT vt.variable_id, t.i, t.value
+              FROM variable_to_time AS vt
+              JOIN time AS t
+                ON t.id = vt.time_id
+        """)
+        times = defaultdict(list)
+        for variable_id, i, value in self.cursor.fetchall():
+            times[variable_id].append((i, value))
+        self.cursor.execute("""
+            SELECT vp.variable_id, p.i, p.value
+              FROM variable_to_pressure AS vp
+              JOIN pressure AS p
+                ON p.id = vp.pressure_id
+        """)
+        pressures = defaultdict(list)
+        for variable_id, i, value in self.cursor.fetchall():
+            pressures[variable_id].append((value, i))
+        self.cursor.execute("""
+            SELECT v.id, t.data, p.data
+              FROM variable AS v
+              LEFT JOIN axis AS t
+                ON t.id = v.time_axis_id
+              LEFT JOIN axis AS p
+                ON p.id = v.pressure_axis_id
+             WHERE v.time_axis_id IS NOT NULL
+                OR v.pressure_axis_id IS NOT NULL
+        """)
+        for variable_id, time_data, pressure_data in self.cursor.fetchall():
+            if time_data is not None:
+                values = unpack_axis("time", time_data).tolist()
+                times[variable_id] += list(enumerate(values))
+            if pressure_data is not None:
+                values = unpack_axis("pressure", pressure_data).tolist()
+                pressures[variable_id] += [
+                    (value, i) for i, value in enumerate(values)]
+        self.cursor.execute("""
+            SELECT m.pattern, fm.file_id
+              FROM file_model AS fm
+              JOIN model AS m
+                ON m.id = fm.model_id
+        """)
+        models = defaultdict(list)
+        for pattern, file_id in self.cursor.fetchall():
+            models[file_id].append(pattern)
+
+        rows_by_key = defaultdict(list)
+        for row in rows:
+            variable_id, file_id, path, reference, name, ta, pa = row
+            key = (name, reference)
+            rows_by_key[(None,) + key].append(row)
+            for pattern in models[file_id]:
+                rows_by_key[(pattern,) + key].append(row)
+
+        groups = defaultdict(dict)
+        groups[None] = {}
+        for (pattern, name, reference), group_rows in rows_by_key.items():
+            groups[pattern][(name, reference)] = _group(
+                group_rows, times, pressures)
+        return dict(groups)
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared(path, memory=False, check_interval=None):
+    """Process-wide ArrayLocator shared by every bokeh session
+
+    The catalogue at path is read through a ConnectionManager, with
+    memory=True from the in-memory copy of snapshot.shared(path), so
+    its arrays are loaded once per process rather than per session
+
+    :param check_interval: see ArrayLocator, used by the first call
+    """
+    with _SHARED_LOCK:
+        key = (path, memory)
+        if key not in _SHARED:
+            if memory:
+                connection = snapshot.shared(path)
+            else:
+                connection = ConnectionManager(path)
+            _SHARED[key] = ArrayLocator(
+                connection, check_interval=check_interval)
+        return _SHARED[key]
+
+
+def _group(rows, times, pressures):
+    """Concatenate per-variable axes into a single Group"""
+    paths, time_axis, pressure_axis = [], [], []
+    time_offsets, pressure_offsets = [0], [0]
+    t_values, t_i, p_values, p_i = [], [], [], []
+    for variable_id, _, path, _, _, ta, pa in rows:
+        paths.append(path)
+        time_axis.append(NO_AXIS if ta is None else ta)
+        pressure_axis.append(NO_AXIS if pa is None else pa)
+        for i, value in times[variable_id]:
+            t_i.append(i)
+            t_values.append(value)
+        time_offsets.append(len(t_i))
+        for value, i in sorted(pressures[variable_id]):
+            p_i.append(i)
+            p_values.append(value)
+        pressure_offsets.append(len(p_i))
+    return Group(
+        paths=paths,
+        time_axis=np.array(time_axis, dtype=np.int32),
+        pressure_axis=np.array(pressure_axis, dtype=np.int32),
+        time_offsets=np.array(time_offsets, dtype=np.int64),
+        times=np.array(t_values, dtype=np.int64),
+        time_i=np.array(t_i, dtype=np.int32),
+        pressure_offsets=np.array(pressure_offsets, dtype=np.int64),
+        pressures=np.array(p_values, dtype=np.float64),
+        pressure_i=np.array(p_i, dtype=np.int32))
+
+
+def _nearest(group, valid_time, pressure, paths=None):
+    """Path and indices of the level closest to pressure
+
+    Applies the same rules as database.Locator, time and pressure
+    sharing an axis must refer to the same index along it
+
+    :param paths: set of paths to consider, None for every path
+    """
+    best, best_distance = None, None
+    for k, path in enumerate(group.paths):
+        if (paths is not None) and (path not in paths):
+            continue
+        t0, t1 = group.time_offsets[k], group.time_offsets[k + 1]
+        matches = group.time_i[t0:t1][group.times[t0:t1] == valid_time]
+        if len(matches) == 0:
+            continue
+        p0, p1 = group.pressure_offsets[k], group.pressure_offsets[k + 1]
+        values = group.pressures[p0:p1]
+        indices = group.pressure_i[p0:p1]
+        ta, pa = group.time_axis[k], group.pressure_axis[k]
+        if ta == pa:
+            shared = np.isin(indices, matches)
+            values, indices = values[shared], indices[shared]
+        if len(values) == 0:
+            continue
+        if ta == pa:
+            candidates = np.arange(len(values))
+        else:
+            j = np.searchsorted(values, pressure)
+            candidates = np.unique(np.clip([j - 1, j], 0, len(values) - 1))
+        distances = np.abs(values[candidates] - pressure)
+        c = candidates[np.argmin(distances)]
+        distance = distances.min()
+        if (best_distance is None) or (distance < best_distance):
+            best_distance = distance
+            ti = indices[c] if ta == pa else matches[0]
+            best = _points(
+                path, _axis(ta), _axis(pa), int(ti), int(indices[c]))
+    return best
+
+
+def _axis(value):
+    """Axis as stored in the catalogue, None instead of NO_AXIS"""
+    return None if value == NO_AXIS else int(value)
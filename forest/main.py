@@ -1,25 +1,479 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime as dt
+import itertools
+import multiprocessing
+import os
+import sys
 import database as db
+import extract
+import harvest
+import shard
+import snapshot
+import watch
+from config import load_config
+
+
+# Files written per transaction, a crash loses at most one batch
+BATCH_SIZE = 100
 
 
 def parse_args(argv=None):
     parser = argparse.ArgumentParser()
+    add_ingest_arguments(parser)
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="skip files whose size/mtime match the catalogue and "
+             "re-index files that changed")
+    parser.add_argument(
+        "--manifest", metavar="FILE",
+        help="read paths one per line from FILE, or stdin if FILE is -")
+    parser.add_argument(
+        "paths", nargs="*", metavar="FILE",
+        help="unified model netcdf files")
+    args = parser.parse_args(args=argv)
+    if (len(args.paths) == 0) and (args.manifest is None):
+        parser.error("either FILE or --manifest must be given")
+    check_shard_args(parser, args)
+    return args
+
+
+def parse_watch_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py watch",
+        description="continuously catalogue files arriving in DIR")
+    add_ingest_arguments(parser)
+    parser.add_argument(
+        "directory", metavar="DIR",
+        help="directory to poll for new or updated files")
+    parser.add_argument(
+        "--pattern", default="*.nc",
+        help="glob pattern of file names to catalogue, default: *.nc")
+    parser.add_argument(
+        "--interval", type=float, default=2., metavar="SECONDS",
+        help="time between directory polls, default: 2")
+    parser.add_argument(
+        "--polls", type=int, metavar="N",
+        help="stop after N polls, default: run forever")
+    parser.add_argument(
+        "--retry-delay", type=float, default=watch.RETRY_DELAY,
+        metavar="SECONDS",
+        help="time before a file that failed is retried, doubled after "
+             "every further failure, default: {:g}".format(
+                 watch.RETRY_DELAY))
+    args = parser.parse_args(args=argv)
+    check_shard_args(parser, args)
+    return args
+
+
+def parse_harvest_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py harvest",
+        description="catalogue local or http(s) netCDF files by "
+                    "fetching headers concurrently")
     parser.add_argument(
         "--database", required=True,
         help="database file to write/extend")
     parser.add_argument(
-        "paths", nargs="+", metavar="FILE",
-        help="unified model netcdf files")
-    return parser.parse_args(args=argv)
+        "--incremental", action="store_true",
+        help="skip files whose size and modification time, taken from "
+             "HTTP Content-Length and Last-Modified, are unchanged")
+    parser.add_argument(
+        "--concurrency", type=int, default=harvest.CONCURRENCY,
+        metavar="N",
+        help="files fetched at the same time, "
+             "default: {}".format(harvest.CONCURRENCY))
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE, metavar="N",
+        help="commit the catalogue after every N files, "
+             "default: {}".format(BATCH_SIZE))
+    parser.add_argument(
+        "--config-file", metavar="YAML_FILE",
+        help="register model patterns so that queries can use the "
+             "precomputed file_model table")
+    parser.add_argument(
+        "--manifest", metavar="FILE",
+        help="read URLs one per line from FILE, or stdin if FILE is -")
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="publish an analysed read-only copy of the catalogue "
+             "to FILE for the app, see snapshot.py")
+    parser.add_argument(
+        "--packed-axes", action="store_true",
+        help="store each distinct time/pressure axis once as a packed "
+             "array instead of a row per point")
+    parser.add_argument(
+        "--shard-by", choices=sorted(shard.SHARD_KEYS), metavar="KEY",
+        help="treat --database as a directory of catalogues split by "
+             "month or model, see shard.py")
+    parser.add_argument(
+        "urls", nargs="*", metavar="URL",
+        help="paths, file:// or http(s):// URLs of netcdf files")
+    args = parser.parse_args(args=argv)
+    if (len(args.urls) == 0) and (args.manifest is None):
+        parser.error("either URL or --manifest must be given")
+    check_shard_args(parser, args)
+    return args
+
+
+def parse_prune_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="main.py prune",
+        description="delete runs older than a number of days and "
+                    "reclaim the space they used")
+    parser.add_argument(
+        "--database", required=True,
+        help="database file to prune")
+    parser.add_argument(
+        "--older-than", type=float, required=True, metavar="DAYS",
+        help="delete files whose reference time is more than DAYS "
+             "days ago")
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE, metavar="N",
+        help="commit the catalogue after every N files deleted, "
+             "default: {}".format(BATCH_SIZE))
+    parser.add_argument(
+        "--convert", action="store_true",
+        help="switch a catalogue created without incremental "
+             "auto-vacuum to it with a one-off VACUUM, which locks the "
+             "catalogue while the file is rewritten")
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="publish an analysed read-only copy of the catalogue "
+             "to FILE for the app, see snapshot.py")
+    args = parser.parse_args(args=argv)
+    if os.path.isdir(args.database):
+        parser.error("pruning --shard-by catalogues is not supported")
+    return args
+
+
+def add_ingest_arguments(parser):
+    parser.add_argument(
+        "--database", required=True,
+        help="database file to write/extend")
+    parser.add_argument(
+        "--workers", type=int, default=1, metavar="N",
+        help="number of processes used to extract meta-data")
+    parser.add_argument(
+        "--extractor", choices=sorted(extract.EXTRACTORS), default="netcdf",
+        help="library used to read meta-data, default: netcdf")
+    parser.add_argument(
+        "--checksum", action="store_true",
+        help="also compare a content hash of files with a new size/mtime")
+    parser.add_argument(
+        "--config-file", metavar="YAML_FILE",
+        help="register model patterns so that queries can use the "
+             "precomputed file_model table")
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE, metavar="N",
+        help="commit the catalogue after every N files, "
+             "default: {}".format(BATCH_SIZE))
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="publish an analysed read-only copy of the catalogue "
+             "to FILE for the app, see snapshot.py")
+    parser.add_argument(
+        "--packed-axes", action="store_true",
+        help="store each distinct time/pressure axis once as a packed "
+             "array instead of a row per point")
+    parser.add_argument(
+        "--shard-by", choices=sorted(shard.SHARD_KEYS), metavar="KEY",
+        help="treat --database as a directory of catalogues split by "
+             "month or model, see shard.py")
+
+
+def check_shard_args(parser, args):
+    if (args.shard_by is not None) and (args.snapshot is not None):
+        parser.error("--snapshot can not be combined with --shard-by")
+
+
+def open_database(args):
+    """Catalogue named by --database, a directory with --shard-by"""
+    if args.shard_by is not None:
+        return shard.ShardedDatabase(
+            args.database, by=args.shard_by, packed=args.packed_axes)
+    database = db.Database.connect(args.database)
+    database.packed = args.packed_axes
+    return database
 
 
 def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if (len(argv) > 0) and (argv[0] == "watch"):
+        return main_watch(argv[1:])
+    if (len(argv) > 0) and (argv[0] == "harvest"):
+        return main_harvest(argv[1:])
+    if (len(argv) > 0) and (argv[0] == "prune"):
+        return main_prune(argv[1:])
     args = parse_args(argv=argv)
+    with open_database(args) as database, \
+            open_manifest(args.manifest) as manifest:
+        insert_models(database, args.config_file)
+        ingest(
+            database,
+            itertools.chain(args.paths, read_manifest(manifest)),
+            incremental=args.incremental,
+            checksum=args.checksum,
+            workers=args.workers,
+            extractor=args.extractor,
+            batch_size=args.batch_size)
+        publish(database, args.snapshot)
+
+
+def main_watch(argv=None):
+    """Poll a directory and ingest completed files in batches"""
+    args = parse_watch_args(argv=argv)
+    watcher = watch.Watcher(
+        args.directory,
+        pattern=args.pattern,
+        retry_delay=args.retry_delay)
+    with open_database(args) as database:
+        insert_models(database, args.config_file)
+        for paths in watcher.batches(args.interval, polls=args.polls):
+            failed = ingest_each(
+                database,
+                paths,
+                incremental=True,
+                checksum=args.checksum,
+                workers=args.workers,
+                extractor=args.extractor,
+                batch_size=args.batch_size)
+            for path in failed:
+                watcher.retry(path)
+            database.connection.commit()
+            publish(database, args.snapshot)
+
+
+def ingest_each(database, paths, **kwargs):
+    """Like ingest, but files that can not be read are skipped
+
+    A batch that fails is rolled back and retried one file at a
+    time, files that still fail, e.g. deleted or truncated since
+    the poll, are reported on stderr so that the watcher keeps
+    running
+
+    :returns: paths that failed, see watch.Watcher.retry
+    """
+    try:
+        ingest(database, paths, **kwargs)
+        return []
+    except Exception:
+        database.connection.rollback()
+    failed = []
+    for path in paths:
+        try:
+            ingest(database, [path], **kwargs)
+        except Exception as error:
+            database.connection.rollback()
+            print("failed: {}: {!r}".format(path, error), file=sys.stderr)
+            failed.append(path)
+    return failed
+
+
+def main_harvest(argv=None):
+    """Catalogue many, possibly remote, files concurrently"""
+    args = parse_harvest_args(argv=argv)
+    with open_database(args) as database, \
+            open_manifest(args.manifest) as manifest:
+        insert_models(database, args.config_file)
+        harvest.ingest(
+            database,
+            itertools.chain(args.urls, read_manifest(manifest)),
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            incremental=args.incremental)
+        publish(database, args.snapshot)
+
+
+def main_prune(argv=None):
+    """Apply a retention policy to the catalogue"""
+    args = parse_prune_args(argv=argv)
+    before = dt.datetime.now(dt.timezone.utc) - dt.timedelta(
+        days=args.older_than)
     with db.Database.connect(args.database) as database:
-        for path in args.paths:
-            print("reading: {}".format(path))
-            database.insert_netcdf(path)
+        prune(
+            database,
+            before,
+            batch_size=args.batch_size,
+            convert=args.convert)
+        publish(database, args.snapshot)
+
+
+def prune(database, before, batch_size=None, convert=False):
+    """Delete runs initialised before a time and reclaim space
+
+    Files are deleted in committed batches that bump the catalogue
+    generation, orphaned rows are then swept and free pages released
+    in small transactions, see Database.collect_garbage and
+    Database.incremental_vacuum
+    """
+    for batch in batches(database.files_before(before), batch_size):
+        for path in batch:
+            print("deleting: {}".format(path))
+            database.delete_file(path)
+        database.bump_generation()
+        database.connection.commit()
+    for table, count in database.collect_garbage().items():
+        if count > 0:
+            print("removed: {} orphaned {} rows".format(count, table))
+    pages = database.incremental_vacuum(convert=convert)
+    print("released: {} pages".format(pages))
+
+
+def publish(database, path):
+    if path is None:
+        return
+    print("publishing: {}".format(path))
+    snapshot.publish(database.connection, path)
+
+
+def insert_models(database, config_file):
+    if config_file is None:
+        return
+    with open(config_file) as stream:
+        config = load_config(stream)
+    for name, pattern in config.patterns:
+        database.insert_model(name, pattern)
+
+
+def open_manifest(path):
+    """Stream of paths named by --manifest, empty if path is None"""
+    if path is None:
+        return contextlib.nullcontext(())
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(path)
+
+
+def read_manifest(lines):
+    """Paths listed one per line, blank lines and # comments skipped"""
+    for line in lines:
+        path = line.strip()
+        if (path == "") or path.startswith("#"):
+            continue
+        yield path
+
+
+def ingest(
+        database,
+        paths,
+        incremental=False,
+        checksum=False,
+        workers=1,
+        extractor="netcdf",
+        batch_size=None):
+    """Extract meta-data from paths and insert into database
+
+    Paths are consumed lazily, so a manifest of any length is
+    processed in constant memory: stale files are extracted
+    ahead of the writer through a bounded queue and written in
+    batches of batch_size files. Each batch bumps the catalogue
+    generation and is committed, batch_size=None writes a single
+    batch and leaves the commit to the caller
+    """
+    # load() yields in input order, so signatures pair up with results
+    signatures = collections.deque()
+
+    def candidates():
+        for path, signature in stale(
+                database,
+                paths,
+                incremental=incremental,
+                checksum=checksum):
+            signatures.append(signature)
+            yield path
+
+    for batch in batches(
+            load(candidates(), workers=workers, extractor=extractor),
+            batch_size):
+        for metadata in batch:
+            print("reading: {}".format(metadata.path))
+            if incremental:
+                database.delete_file(metadata.path)
+            database.insert_metadata(metadata._replace(
+                signature=signatures.popleft()))
+        database.bump_generation()
+        if batch_size is not None:
+            database.connection.commit()
+
+
+def batches(iterable, size=None):
+    """Lists of up to size items, size=None yields one list"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def stale(database, paths, incremental=False, checksum=False):
+    """Files that need to be (re-)indexed along with their signature
+
+    In incremental mode a file is skipped if its size and mtime match
+    the catalogue, or, with checksum=True, if its content hash does
+    """
+    for path in paths:
+        signature = extract.signature(path)
+        stored = database.signature(path) if incremental else None
+        if extract.unchanged(stored, signature):
+            print("unchanged: {}".format(path))
+            continue
+        if checksum:
+            signature = signature._replace(
+                checksum=extract.file_checksum(path))
+            if (stored is not None) and (stored.checksum == signature.checksum):
+                print("unchanged: {}".format(path))
+                database.update_signature(path, signature)
+                continue
+        yield path, signature
+
+
+def load(paths, workers=1, extractor="netcdf", queue_size=None):
+    """Extract meta-data from files, in parallel if workers > 1
+
+    Only the extraction step is distributed, results are yielded
+    in order so that a single process writes to the database. At
+    most queue_size files, default 2 * workers, are extracted
+    ahead of the consumer
+
+    .. note:: workers are spawned rather than forked, the HDF5
+              library behind netCDF4 is not safe to use in a child
+              forked from a process that has already opened files
+    """
+    if workers <= 1:
+        for path in paths:
+            yield extract.load(path, extractor=extractor)
+    else:
+        context = multiprocessing.get_context("spawn")
+        if queue_size is None:
+            queue_size = 2 * workers
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=context) as executor:
+            yield from bounded_map(
+                executor,
+                extract.EXTRACTORS[extractor],
+                paths,
+                queue_size)
+
+
+def bounded_map(executor, fn, iterable, size):
+    """Like executor.map but with at most size pending calls
+
+    executor.map submits every item up front, which for a long
+    manifest holds all of its paths and results in memory
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= size:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,330 @@
+"""Catalogue schema and in-place migrations
+
+Each entry in :data:`MIGRATIONS` upgrades a catalogue by one version,
+the version reached is recorded in the ``schema_version`` table so
+that existing catalogue files are upgraded the next time they are
+opened by :class:`database.Database`
+
+Catalogues written before versioning was introduced have no
+``schema_version`` table, their tables match version 1 (possibly
+with the signature columns of version 2), so every migration must
+be safe to apply to tables that already exist
+"""
+
+
+def migrate(connection):
+    """Apply outstanding migrations and return the schema version
+
+    Up to date catalogues are not written to, so read-only
+    connections can be passed to this function
+    """
+    current = version(connection)
+    if current == VERSION:
+        return current
+    cursor = connection.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL)
+    """)
+    if current > VERSION:
+        raise RuntimeError(
+            "catalogue schema version {} is newer than {}".format(
+                current, VERSION))
+    for number, step in enumerate(MIGRATIONS[current:], current + 1):
+        step(cursor)
+        cursor.execute("DELETE FROM schema_version")
+        cursor.execute(
+            "INSERT INTO schema_version (version) VALUES (:version)",
+            dict(version=number))
+    connection.commit()
+    return VERSION
+
+
+def check(connection):
+    """Schema version of a catalogue that is opened read-only
+
+    :raises RuntimeError: if the catalogue needs migrating, which
+                          only a writer such as main.py can do
+    """
+    current = version(connection)
+    if current > VERSION:
+        raise RuntimeError(
+            "catalogue schema version {} is newer than {}".format(
+                current, VERSION))
+    if current < VERSION:
+        raise RuntimeError(
+            "catalogue schema version {} is older than {}, "
+            "open it for writing, e.g. with main.py, to migrate".format(
+                current, VERSION))
+    return current
+
+
+def version(connection):
+    """Schema version of a catalogue, 0 if unversioned"""
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT name FROM sqlite_master
+         WHERE type = 'table' AND name = 'schema_version'
+    """)
+    if cursor.fetchone() is None:
+        return 0
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    value, = cursor.fetchone()
+    return 0 if value is None else value
+
+
+def add_columns(cursor, table, columns):
+    """ALTER TABLE for each (name, type) not already in table"""
+    cursor.execute("PRAGMA table_info({})".format(table))
+    existing = [row[1] for row in cursor.fetchall()]
+    for name, kind in columns:
+        if name not in existing:
+            cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table, name, kind))
+
+
+def _create_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS file (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                reference TEXT,
+                UNIQUE(name))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS variable (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                time_axis INTEGER,
+                pressure_axis INTEGER,
+                file_id INTEGER,
+                FOREIGN KEY(file_id) REFERENCES file(id),
+                UNIQUE(name, file_id))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pressure (
+                id INTEGER PRIMARY KEY,
+                i INTEGER,
+                value REAL,
+                UNIQUE(i, value)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS variable_to_pressure (
+                variable_id INTEGER,
+                pressure_id INTEGER,
+                PRIMARY KEY(variable_id, pressure_id),
+                FOREIGN KEY(variable_id) REFERENCES variable(id),
+                FOREIGN KEY(pressure_id) REFERENCES pressure(id))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS time (
+                id INTEGER PRIMARY KEY,
+                i INTEGER,
+                value TEXT,
+                UNIQUE(i, value))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS variable_to_time (
+                variable_id INTEGER,
+                time_id INTEGER,
+                PRIMARY KEY(variable_id, time_id),
+                FOREIGN KEY(variable_id) REFERENCES variable(id),
+                FOREIGN KEY(time_id) REFERENCES time(id))
+    """)
+
+
+def _add_file_signature(cursor):
+    add_columns(cursor, "file", [
+        ("size", "INTEGER"),
+        ("mtime", "REAL"),
+        ("checksum", "TEXT")])
+
+
+def _create_indexes(cursor):
+    """Indexes for the menu and Locator query shapes
+
+    UNIQUE constraints already index variable(name, file_id),
+    time(i, value), pressure(i, value) and the junction tables by
+    variable_id, the indexes below cover the remaining lookups
+    """
+    # file.reference = :initial_time, covering file.name GLOB :pattern
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS file_reference
+            ON file (reference, name)
+    """)
+    # file -> variable joins, covering the Locator axis columns
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS variable_file_id
+            ON variable (file_id, name, time_axis, pressure_axis)
+    """)
+    # time.value = :valid_time
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS time_value
+            ON time (value, i)
+    """)
+    # pressure ordering and nearest value lookups
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS pressure_value
+            ON pressure (value, i)
+    """)
+    # Reverse junction joins, time/pressure -> variable
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS variable_to_time_time_id
+            ON variable_to_time (time_id, variable_id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS variable_to_pressure_pressure_id
+            ON variable_to_pressure (pressure_id, variable_id)
+    """)
+
+
+def _create_generation(cursor):
+    """Counter bumped by ingest so readers can invalidate caches"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS generation (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                value INTEGER NOT NULL)
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO generation (id, value) VALUES (1, 0)
+    """)
+
+
+def _create_models(cursor):
+    """Model patterns and precomputed file membership"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS model (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                pattern TEXT NOT NULL,
+                UNIQUE(pattern))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS file_model (
+                model_id INTEGER,
+                file_id INTEGER,
+                PRIMARY KEY(model_id, file_id),
+                FOREIGN KEY(model_id) REFERENCES model(id),
+                FOREIGN KEY(file_id) REFERENCES file(id))
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS file_model_file_id
+            ON file_model (file_id, model_id)
+    """)
+
+
+def _epoch_times(cursor):
+    """Store time.value and file.reference as integer seconds
+
+    SQLite cannot change the type of a column and TEXT affinity would
+    turn integers back into text, so both tables are rebuilt, values
+    that do not look like str(datetime) are copied unchanged
+    """
+    epoch = """
+        CASE WHEN {0} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+             THEN CAST(strftime('%s', {0}) AS INTEGER)
+             ELSE {0}
+         END"""
+    cursor.execute("""
+        CREATE TABLE time_epoch (
+                id INTEGER PRIMARY KEY,
+                i INTEGER,
+                value INTEGER,
+                UNIQUE(i, value))
+    """)
+    cursor.execute("""
+        INSERT INTO time_epoch (id, i, value)
+        SELECT id, i, {} FROM time
+    """.format(epoch.format("value")))
+    cursor.execute("DROP TABLE time")
+    cursor.execute("ALTER TABLE time_epoch RENAME TO time")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS time_value
+            ON time (value, i)
+    """)
+    cursor.execute("""
+        CREATE TABLE file_epoch (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                reference INTEGER,
+                size INTEGER,
+                mtime REAL,
+                checksum TEXT,
+                UNIQUE(name))
+    """)
+    cursor.execute("""
+        INSERT INTO file_epoch (id, name, reference, size, mtime, checksum)
+        SELECT id, name, {}, size, mtime, checksum FROM file
+    """.format(epoch.format("reference")))
+    cursor.execute("DROP TABLE file")
+    cursor.execute("ALTER TABLE file_epoch RENAME TO file")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS file_reference
+            ON file (reference, name)
+    """)
+
+
+def _create_axes(cursor):
+    """Coordinate axes packed into BLOBs and shared by content
+
+    Variables written by Database(packed=True) reference an axis row
+    instead of per-point time/pressure and junction rows, identical
+    axes are stored once under their digest, see database.pack_axis
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS axis (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                digest BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                UNIQUE(digest))
+    """)
+    add_columns(cursor, "variable", [
+        ("time_axis_id", "INTEGER REFERENCES axis(id)"),
+        ("pressure_axis_id", "INTEGER REFERENCES axis(id)")])
+
+
+def _create_templates(cursor):
+    """A catalogued file for each structural fingerprint
+
+    Files sharing a fingerprint, see extract.read_layout, are cloned
+    from the template file by Database.clone_template
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS template (
+                fingerprint BLOB PRIMARY KEY,
+                file_id INTEGER NOT NULL,
+                FOREIGN KEY(file_id) REFERENCES file(id))
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS template_file_id
+            ON template (file_id)
+    """)
+
+
+def _create_axis_indexes(cursor):
+    """Reverse lookups used to find unreferenced packed axes"""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS variable_time_axis_id
+            ON variable (time_axis_id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS variable_pressure_axis_id
+            ON variable (pressure_axis_id)
+    """)
+
+
+MIGRATIONS = [
+    _create_tables,
+    _add_file_signature,
+    _create_indexes,
+    _create_generation,
+    _create_models,
+    _epoch_times,
+    _create_axes,
+    _create_templates,
+    _create_axis_indexes,
+]
+VERSION = len(MIGRATIONS)
@@ -0,0 +1,687 @@
+"""Catalogues split into shards, one file per month or per model
+
+:class:`ShardedDatabase` routes ingest to the shard of each file and
+keeps a small index of what every shard holds: the range of reference
+times, the model patterns of its files and the shard of every file.
+:class:`Federation` answers the Database and Locator queries used by
+the app by ATTACHing only the shards that the pattern and initial
+time of a query can match, so readers never scan old or unrelated
+runs and ingest only ever writes to the shards it is extending
+"""
+import collections
+import fnmatch
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import urllib.request
+import database as db
+
+
+# File in the shard directory listing shards and their contents
+INDEX = "index.db"
+
+# Shards holding files without a reference time or matching no model
+UNDATED = "undated"
+OTHER = "other"
+
+# Pattern under which the index records menus of every file
+ALL = ""
+
+# Generation of a shard committed after the index, see Index.mark
+PENDING = -1
+
+# Catalogue tables qualified with the shard schema by SchemaCursor
+TABLES = (
+    "file",
+    "variable",
+    "time",
+    "pressure",
+    "variable_to_time",
+    "variable_to_pressure",
+    "axis",
+    "model",
+    "file_model",
+    "template",
+    "generation")
+
+
+def by_month(metadata, models):
+    """Shard name of a file, e.g. 2019-01 for runs in January 2019"""
+    if metadata.reference_time is None:
+        return UNDATED
+    return "{:%Y-%m}".format(metadata.reference_time)
+
+
+def by_model(metadata, models):
+    """Shard name of a file, the first model whose pattern matches"""
+    for name, pattern in models:
+        if fnmatch.fnmatchcase(metadata.path, pattern):
+            return name
+    return OTHER
+
+
+SHARD_KEYS = {
+    "month": by_month,
+    "model": by_model
+}
+
+
+def shard_file(name):
+    """File name of a shard, unsafe characters replaced"""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name) + ".db"
+
+
+class Index(object):
+    """Shards of a directory, their reference times and models"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    @classmethod
+    def create(cls, path):
+        connection = sqlite3.connect(path, timeout=db.BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard (
+                    name TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    first_reference INTEGER,
+                    last_reference INTEGER,
+                    generation INTEGER NOT NULL DEFAULT 0)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_model (
+                    shard TEXT NOT NULL,
+                    pattern TEXT NOT NULL,
+                    PRIMARY KEY(shard, pattern))
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_file (
+                    name TEXT PRIMARY KEY,
+                    shard TEXT NOT NULL)
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS model (
+                    name TEXT NOT NULL,
+                    pattern TEXT NOT NULL,
+                    PRIMARY KEY(name, pattern))
+        """)
+        # Menus of each shard by registered model pattern, or ALL
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_variable (
+                    shard TEXT NOT NULL,
+                    pattern TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    PRIMARY KEY(pattern, name, shard))
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS shard_initial_time (
+                    shard TEXT NOT NULL,
+                    pattern TEXT NOT NULL,
+                    reference INTEGER NOT NULL,
+                    PRIMARY KEY(pattern, reference, shard))
+        """)
+        connection.commit()
+        return cls(connection)
+
+    def has_model(self, name, pattern):
+        """True if every shard has already registered a model"""
+        self.cursor.execute("""
+            SELECT 1 FROM model WHERE name = :name AND pattern = :pattern
+        """, dict(name=name, pattern=pattern))
+        return self.cursor.fetchone() is not None
+
+    def add_model(self, name, pattern):
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO model (name, pattern)
+            VALUES (:name, :pattern)
+        """, dict(name=name, pattern=pattern))
+
+    def names(self):
+        self.cursor.execute("SELECT name FROM shard ORDER BY name")
+        return [name for name, in self.cursor.fetchall()]
+
+    def shard_of(self, path):
+        """Name of the shard holding path, None if not catalogued"""
+        self.cursor.execute("""
+            SELECT shard FROM shard_file WHERE name = :path
+        """, dict(path=path))
+        row = self.cursor.fetchone()
+        return None if row is None else row[0]
+
+    def assign(self, path, name):
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO shard_file (name, shard)
+            VALUES (:path, :name)
+        """, dict(path=path, name=name))
+
+    def forget(self, path):
+        self.cursor.execute("""
+            DELETE FROM shard_file WHERE name = :path
+        """, dict(path=path))
+
+    def mark(self, names):
+        """Flag shards about to be committed as PENDING
+
+        Committed before the shards, so that a crash between the
+        shard and index commits is repaired by :meth:`pending` and
+        :meth:`reindex` instead of hiding the shard's new rows
+        """
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO shard (name, path) VALUES (:name, :path)
+        """, [dict(name=name, path=shard_file(name)) for name in names])
+        self.cursor.executemany("""
+            UPDATE shard SET generation = :pending WHERE name = :name
+        """, [dict(name=name, pending=PENDING) for name in names])
+
+    def pending(self):
+        """Shards marked by :meth:`mark` that were never updated"""
+        self.cursor.execute("""
+            SELECT name FROM shard WHERE generation = :pending ORDER BY name
+        """, dict(pending=PENDING))
+        return [name for name, in self.cursor.fetchall()]
+
+    def reindex(self, name, database):
+        """Rebuild every index entry of a shard from its catalogue"""
+        self.cursor.execute("""
+            DELETE FROM shard_file WHERE shard = :name
+        """, dict(name=name))
+        self.cursor.executemany("""
+            INSERT OR REPLACE INTO shard_file (name, shard)
+            VALUES (:path, :name)
+        """, [dict(path=path, name=name) for path in database.files()])
+        self.update(name, database)
+
+    def update(self, name, database):
+        """Record reference times, models, menus and generation of a shard
+
+        Variables and initial times are stored for every registered
+        model pattern and for ALL files, so that Federation can
+        answer those menus without attaching the shard
+        """
+        database.cursor.execute("""
+            SELECT MIN(reference), MAX(reference) FROM file
+        """)
+        first, last = database.cursor.fetchone()
+        database.cursor.execute("""
+            SELECT DISTINCT model.pattern
+              FROM model
+              JOIN file_model
+                ON file_model.model_id = model.id
+        """)
+        patterns = [pattern for pattern, in database.cursor.fetchall()]
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO shard (
+                   name, path, first_reference, last_reference, generation)
+            VALUES (:name, :path, :first, :last, :generation)
+        """, dict(
+            name=name,
+            path=shard_file(name),
+            first=first,
+            last=last,
+            generation=database.generation()))
+        self.cursor.execute("""
+            DELETE FROM shard_model WHERE shard = :name
+        """, dict(name=name))
+        self.cursor.executemany("""
+            INSERT INTO shard_model (shard, pattern) VALUES (:name, :pattern)
+        """, [dict(name=name, pattern=pattern) for pattern in patterns])
+        database.cursor.execute("SELECT pattern FROM model")
+        variables, initial_times = [], []
+        for pattern, in [(ALL,)] + database.cursor.fetchall():
+            variables += [
+                dict(name=name, pattern=pattern, value=value)
+                for value in database.variables(pattern=pattern or None)]
+            initial_times += [
+                dict(name=name, pattern=pattern, value=db.to_epoch(value))
+                for value in database.initial_times(
+                    pattern=pattern or None)]
+        for table, column, data in [
+                ("shard_variable", "name", variables),
+                ("shard_initial_time", "reference", initial_times)]:
+            self.cursor.execute("""
+                DELETE FROM {} WHERE shard = :name
+            """.format(table), dict(name=name))
+            self.cursor.executemany("""
+                INSERT OR IGNORE INTO {} (shard, pattern, {})
+                VALUES (:name, :pattern, :value)
+            """.format(table, column), data)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class ShardedDatabase(object):
+    """Ingest side of a sharded catalogue
+
+    Provides the subset of :class:`database.Database` used by
+    main.ingest, every file is written to the shard named by
+    ``SHARD_KEYS[by](metadata, models)`` and the index is brought
+    up to date whenever the shards are committed
+
+    :param directory: location of the shards and their index
+    :param by: key of :data:`SHARD_KEYS`
+    :param packed: passed to every shard, see database.Database
+    """
+    def __init__(self, directory, by="month", packed=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.key = SHARD_KEYS[by]
+        self.packed = packed
+        self.index = Index.create(os.path.join(directory, INDEX))
+        self.shards = {}
+        self.models = []
+        self.touched = set()
+        self.recover()
+
+    def recover(self):
+        """Re-index shards left PENDING by an interrupted commit"""
+        for name in self.index.pending():
+            print("re-indexing: {}".format(name))
+            self.index.reindex(name, self.shard(name))
+        self.index.commit()
+
+    @property
+    def connection(self):
+        """Commits go through the sharded database, see commit()"""
+        return self
+
+    def shard(self, name):
+        """Catalogue of a shard, created on first use"""
+        if name not in self.shards:
+            database = db.Database.connect(
+                os.path.join(self.directory, shard_file(name)))
+            database.packed = self.packed
+            self.shards[name] = database
+            self.register(name)
+        return self.shards[name]
+
+    def register(self, name):
+        """Add models missing from a shard, touching it if any were"""
+        database = self.shards[name]
+        database.cursor.execute("SELECT name, pattern FROM model")
+        known = set(database.cursor.fetchall())
+        for model, pattern in self.models:
+            if (model, pattern) not in known:
+                database.insert_model(model, pattern)
+                self.touched.add(name)
+
+    def insert_model(self, name, pattern):
+        """Register a model pattern
+
+        Shards are only opened and written if the index has not seen
+        the model before, so that repeated runs with the same config
+        file leave shards they do not extend untouched
+        """
+        self.models.append((name, pattern))
+        names = set(self.shards)
+        if not self.index.has_model(name, pattern):
+            names.update(self.index.names())
+        for shard in sorted(names):
+            self.shard(shard)
+            self.register(shard)
+        self.index.add_model(name, pattern)
+
+    def insert_metadata(self, metadata):
+        name = self.key(metadata, self.models)
+        self.shard(name).insert_metadata(metadata)
+        self.index.assign(metadata.path, name)
+        self.touched.add(name)
+
+    def signature(self, path):
+        name = self.index.shard_of(path)
+        if name is None:
+            return None
+        return self.shard(name).signature(path)
+
+    def update_signature(self, path, signature):
+        name = self.index.shard_of(path)
+        if name is not None:
+            self.shard(name).update_signature(path, signature)
+            self.touched.add(name)
+
+    def delete_file(self, path):
+        name = self.index.shard_of(path)
+        if name is None:
+            return
+        self.shard(name).delete_file(path)
+        self.index.forget(path)
+        self.touched.add(name)
+
+    def bump_generation(self):
+        for name in self.touched:
+            self.shard(name).bump_generation()
+
+    def commit(self):
+        """Commit modified shards, then record them in the index
+
+        The shards are marked PENDING in the index first, so that
+        whatever step is interrupted, the next ShardedDatabase opened
+        on the directory re-indexes them, see :meth:`recover`
+        """
+        names = sorted(self.touched)
+        if len(names) > 0:
+            self.index.mark(names)
+            self.index.commit()
+        for name in names:
+            self.shard(name).connection.commit()
+        for name in names:
+            self.index.update(name, self.shard(name))
+        self.index.commit()
+        self.touched = set()
+
+    def rollback(self):
+        """Discard uncommitted changes to every shard and the index"""
+        for database in self.shards.values():
+            database.connection.rollback()
+        self.index.rollback()
+        self.touched = set()
+
+    def close(self):
+        self.commit()
+        for database in self.shards.values():
+            database.close()
+        self.shards = {}
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.rollback()
+        self.close()
+
+
+class SchemaCursor(object):
+    """Cursor that runs catalogue SQL against one attached schema"""
+    def __init__(self, connection, schema, statements):
+        self.connection = connection
+        self.schema = schema
+        self.statements = statements
+        self.cursor = None
+
+    def execute(self, sql, parameters=()):
+        # A fresh cursor per statement, so that no statement is left
+        # open on a schema that Federation may DETACH
+        self.cursor = self.connection.cursor()
+        return self.cursor.execute(self.qualify(sql), parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.cursor = self.connection.cursor()
+        return self.cursor.executemany(self.qualify(sql), seq_of_parameters)
+
+    def qualify(self, sql):
+        key = (self.schema, sql)
+        if key not in self.statements:
+            self.statements[key] = _QUALIFY.sub(
+                r"\1 {}.\2".format(self.schema), sql)
+        return self.statements[key]
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["cursor"], name)
+
+
+_QUALIFY = re.compile(r"\b(FROM|JOIN)\s+({})\b".format("|".join(TABLES)))
+
+
+class SchemaConnection(object):
+    """Connection-like view of one schema of a shared connection"""
+    def __init__(self, connection, schema, statements):
+        self.connection = connection
+        self.schema = schema
+        self.statements = statements
+
+    def cursor(self):
+        return SchemaCursor(self.connection, self.schema, self.statements)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ShardView(db.Database, db.Locator):
+    """Database and Locator queries against one attached shard
+
+    Shards are migrated by the writer, so unlike Database the
+    schema is not checked
+    """
+    def __init__(self, connection):
+        db.Connection.__init__(self, connection)
+        self.packed = False
+
+
+class Federation(object):
+    """Read-only Database and Locator over the shards of a directory
+
+    Each query reads the index, ATTACHes the shards that the pattern
+    and initial time can match and merges their answers. Shards are
+    detached least recently used first once SQLite's limit on
+    attached databases is reached. Calls are serialised by a lock,
+    so one instance can be shared by the threads of the app
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.connection = sqlite3.connect(
+            ":memory:",
+            uri=True,
+            timeout=db.BUSY_TIMEOUT,
+            check_same_thread=False)
+        self.lock = threading.RLock()
+        self.attached = collections.OrderedDict()
+        self.statements = {}
+        self.views = {}
+        self.schemas = itertools.count()
+        self.connection.execute(
+            "ATTACH DATABASE :uri AS idx",
+            dict(uri=_read_only(os.path.join(directory, INDEX))))
+        try:
+            limit = self.connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        except AttributeError:
+            limit = 10  # SQLite default before Python 3.11
+        self.max_shards = limit - 1  # one slot holds the index
+        self.stats = None
+
+    def shards(self, pattern=None, initial_time=None):
+        """Names of shards that may hold files matching a query
+
+        Shards are pruned by reference time range and, for patterns
+        registered as models, by the models of their files
+        """
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT name FROM idx.shard
+                 WHERE (:initial_time IS NULL
+                        OR :initial_time BETWEEN first_reference
+                                             AND last_reference)
+                   AND (:pattern IS NULL
+                        OR NOT EXISTS (
+                           SELECT 1 FROM idx.shard_model
+                            WHERE pattern = :pattern)
+                        OR name IN (
+                           SELECT shard FROM idx.shard_model
+                            WHERE pattern = :pattern))
+                 ORDER BY name
+            """, dict(
+                pattern=pattern,
+                initial_time=db.to_epoch(initial_time)))
+            return [name for name, in cursor.fetchall()]
+
+    def view(self, name):
+        """ShardView of an attached shard"""
+        with self.lock:
+            if name in self.attached:
+                self.attached.move_to_end(name)
+                return self.views[name]
+            while len(self.attached) >= self.max_shards:
+                old, schema = self.attached.popitem(last=False)
+                self.connection.execute("DETACH DATABASE {}".format(schema))
+                del self.views[old]
+                self.statements = {
+                    key: sql for key, sql in self.statements.items()
+                    if key[0] != schema}
+            schema = "shard_{}".format(next(self.schemas))
+            self.connection.execute(
+                "ATTACH DATABASE :uri AS {}".format(schema),
+                dict(uri=_read_only(
+                    os.path.join(self.directory, shard_file(name)))))
+            self.attached[name] = schema
+            self.views[name] = ShardView(SchemaConnection(
+                self.connection, schema, self.statements))
+            self.views[name].instrument(self.stats)
+            return self.views[name]
+
+    def instrument(self, stats):
+        """Report latency of shard queries, see Connection.instrument"""
+        with self.lock:
+            self.stats = stats
+            for view in self.views.values():
+                view.instrument(stats)
+        return self
+
+    def generation(self):
+        """Changes whenever ingest commits to any shard"""
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT COALESCE(SUM(generation), 0) FROM idx.shard
+            """)
+            value, = cursor.fetchone()
+            return value
+
+    def files(self, pattern=None):
+        return self._union("files", pattern=pattern)
+
+    def variables(self, pattern=None):
+        values = self._indexed("shard_variable", "name", pattern)
+        if values is None:
+            return self._union("variables", pattern=pattern)
+        return values
+
+    def initial_times(self, pattern=None):
+        values = self._indexed("shard_initial_time", "reference", pattern)
+        if values is None:
+            return self._union("initial_times", pattern=pattern)
+        return [db.from_epoch(value) for value in values]
+
+    def valid_times(self, variable=None, pattern=None, initial_time=None):
+        return self._union(
+            "valid_times",
+            variable=variable,
+            pattern=pattern,
+            initial_time=initial_time)
+
+    def pressures(self, variable=None, pattern=None, initial_time=None):
+        return self._union(
+            "pressures",
+            variable=variable,
+            pattern=pattern,
+            initial_time=initial_time)
+
+    def menus(self, state):
+        """Menus merged from shards, see Database.menus
+
+        Variables and initial times come from the index, only the
+        shards that can hold state.initial_time are attached to find
+        pressures and valid times
+        """
+        with self.lock:
+            menus = dict(
+                variables=self.variables(state.pattern),
+                initial_times=self.initial_times(state.pattern),
+                pressures=None,
+                valid_times=None)
+            if state.initial_time is not None:
+                pressures, valid_times = set(), set()
+                for name in self.shards(state.pattern, state.initial_time):
+                    result = self.view(name).menus(state)
+                    pressures.update(result.pressures)
+                    valid_times.update(result.valid_times)
+                menus["pressures"] = sorted(pressures)
+                menus["valid_times"] = sorted(valid_times)
+            return db.Menus(**menus)
+
+    def path_points(
+            self,
+            pattern,
+            variable,
+            initial_time,
+            valid_time,
+            pressure):
+        """Closest field in any shard, see Locator.path_points"""
+        with self.lock:
+            best = None
+            for name in self.shards(pattern, initial_time):
+                candidate = self.view(name).nearest(
+                    pattern, variable, initial_time, valid_time, pressure)
+                if (candidate is not None) and (
+                        (best is None) or (candidate[0] < best[0])):
+                    best = candidate
+            if best is None:
+                return None
+            return db._points(*best[1])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _indexed(self, table, column, pattern):
+        """Distinct menu values recorded by Index.update
+
+        :returns: sorted values or None if pattern is not a
+                  registered model, which has to ask every shard
+        """
+        with self.lock:
+            cursor = self.connection.cursor()
+            if pattern is not None:
+                cursor.execute("""
+                    SELECT 1 FROM idx.model WHERE pattern = :pattern
+                """, dict(pattern=pattern))
+                if cursor.fetchone() is None:
+                    return None
+            cursor.execute("""
+                SELECT DISTINCT {1} FROM idx.{0}
+                 WHERE pattern = :pattern
+                 ORDER BY {1}
+            """.format(table, column), dict(
+                pattern=ALL if pattern is None else pattern))
+            return [value for value, in cursor.fetchall()]
+
+    def _union(self, method, **kwargs):
+        """Sorted distinct values of a Database method over shards"""
+        with self.lock:
+            values = set()
+            for name in self.shards(
+                    kwargs.get("pattern"), kwargs.get("initial_time")):
+                values.update(getattr(self.view(name), method)(**kwargs))
+            return sorted(values)
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared(directory):
+    """Process-wide Federation of directory shared by every bokeh session"""
+    with _SHARED_LOCK:
+        if directory not in _SHARED:
+            _SHARED[directory] = Federation(directory)
+        return _SHARED[directory]
+
+
+def _read_only(path):
+    return "file:{}?mode=ro".format(
+        urllib.request.pathname2url(os.path.abspath(path)))
@@ -0,0 +1,149 @@
+"""Immutable catalogue snapshots served from memory
+
+Ingest publishes a snapshot with :func:`publish`, a compacted and
+ANALYZEd copy of the catalogue that is atomically renamed into
+place. The app reads it through :class:`Snapshot`, which copies
+the file into an in-memory database with the SQLite backup API
+and swaps to a newer copy whenever the file is replaced, so menu
+queries never touch the disk or wait for ingest
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.request
+
+
+# Seconds between checks for a newer snapshot file
+CHECK_INTERVAL = 10.
+
+
+def publish(connection, path):
+    """Atomically replace path with an analysed copy of connection"""
+    connection.commit()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(
+        dir=directory, prefix=".snapshot-", suffix=".db")
+    os.close(fd)
+    try:
+        target = sqlite3.connect(tmp)
+        try:
+            connection.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+            target.execute("ANALYZE")
+            target.commit()
+            target.execute("VACUUM")
+        finally:
+            target.close()
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load(path):
+    """In-memory copy of a snapshot file"""
+    uri = "file:{}?mode=ro&immutable=1".format(
+        urllib.request.pathname2url(os.path.abspath(path)))
+    source = sqlite3.connect(uri, uri=True)
+    try:
+        memory = sqlite3.connect(":memory:", check_same_thread=False)
+        source.backup(memory)
+        memory.execute("PRAGMA query_only=1")
+    finally:
+        source.close()
+    return memory
+
+
+class Snapshot(object):
+    """Behaves like a sqlite3.Connection to the latest snapshot
+
+    Cursors execute each statement against the in-memory copy that
+    is current at that moment, so Database, Locator and ArrayLocator
+    instances keep working after a newer snapshot is swapped in.
+    The file is checked at most every check_interval seconds
+
+    .. note:: queries share one in-memory connection, made
+              read-only with PRAGMA query_only, which SQLite
+              serialises between threads
+    """
+    read_only = True
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.memory = None
+        self.stat = None
+        self.checked = None
+        self.refresh()
+
+    def refresh(self):
+        """Load the snapshot file if it has been replaced
+
+        :returns: True if a newer copy was loaded
+        """
+        with self.lock:
+            self.checked = time.monotonic()
+            stat = _identity(self.path)
+            if stat == self.stat:
+                return False
+            self.memory = load(self.path)
+            self.stat = stat
+            return True
+
+    def get(self):
+        """Current in-memory connection"""
+        if (time.monotonic() - self.checked) >= self.check_interval:
+            self.refresh()
+        return self.memory
+
+    def cursor(self):
+        return SnapshotCursor(self)
+
+    def commit(self):
+        self.get().commit()
+
+    def rollback(self):
+        self.get().rollback()
+
+    def close(self):
+        with self.lock:
+            self.memory.close()
+
+
+class SnapshotCursor(object):
+    """Cursor bound to the current snapshot on every execute"""
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.cursor = None
+
+    def execute(self, *args):
+        self.cursor = self.snapshot.get().cursor()
+        return self.cursor.execute(*args)
+
+    def executemany(self, *args):
+        self.cursor = self.snapshot.get().cursor()
+        return self.cursor.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["cursor"], name)
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared(path, check_interval=CHECK_INTERVAL):
+    """Process-wide Snapshot of path shared by every bokeh session"""
+    with _SHARED_LOCK:
+        if path not in _SHARED:
+            _SHARED[path] = Snapshot(path, check_interval=check_interval)
+        return _SHARED[path]
+
+
+def _identity(path):
+    """Changes whenever publish() renames a new file into place"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,253 @@
+"""Opt-in latency statistics for catalogue queries
+
+:meth:`database.Connection.instrument` wraps a connection's cursors
+so that every statement is timed, counted and attributed to the
+method named by :meth:`QueryStats.attribute`, e.g. ``valid_times`` or
+``path_points``, see database.attributed.
+Statements slower than a threshold have their EXPLAIN QUERY PLAN
+captured, see :class:`QueryStats`
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1., 2.5, 5.)
+
+# Statements slower than this many seconds are EXPLAINed
+THRESHOLD = 0.05
+
+# Method of statements executed outside QueryStats.attribute
+UNATTRIBUTED = "(unattributed)"
+
+
+class QueryStats(object):
+    """Thread-safe per-method latency histograms and row counts
+
+    :param threshold: seconds above which a statement's query plan
+                      is captured
+    :param slow_queries: number of slow statements to keep
+    """
+    def __init__(self, threshold=THRESHOLD, slow_queries=100):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.methods = {}
+        self.slow = collections.deque(maxlen=slow_queries)
+
+    def wrap(self, cursor, connection):
+        """Instrumented equivalent of a sqlite3.Cursor"""
+        return InstrumentedCursor(cursor, connection, self)
+
+    def method(self):
+        """Method the calling thread attributes statements to, if any"""
+        return getattr(self.local, "method", None)
+
+    @contextlib.contextmanager
+    def attribute(self, method):
+        """Attribute statements executed by the calling thread to method"""
+        previous = getattr(self.local, "method", None)
+        self.local.method = method
+        try:
+            yield
+        finally:
+            self.local.method = previous
+
+    def timed(self, method, work):
+        """Call work and record its latency, e.g. of in-memory lookups
+
+        :returns: result of work, counted as one row unless None
+        """
+        start = time.perf_counter()
+        result = work()
+        self.record(
+            method, time.perf_counter() - start, int(result is not None))
+        return result
+
+    def record(self, method, seconds, rows, sql=None, plan=None):
+        with self.lock:
+            if method not in self.methods:
+                self.methods[method] = MethodStats()
+            self.methods[method].add(seconds, rows)
+            if plan is not None:
+                self.slow.append({
+                    "method": method,
+                    "seconds": seconds,
+                    "rows": rows,
+                    "sql": " ".join(sql.split()),
+                    "plan": plan})
+
+    def summary(self):
+        """JSON-serialisable view of the statistics"""
+        with self.lock:
+            return {
+                "threshold": self.threshold,
+                "methods": {
+                    name: stats.summary()
+                    for name, stats in sorted(self.methods.items())},
+                "slow": list(self.slow)}
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.slow.clear()
+
+    def format(self):
+        """Plain text table, slowest mean latency first"""
+        summary = self.summary()
+        lines = ["{:<24} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "method", "count", "mean ms", "p95 ms", "max ms", "rows")]
+        methods = sorted(
+            summary["methods"].items(),
+            key=lambda item: item[1]["mean_seconds"],
+            reverse=True)
+        for name, item in methods:
+            lines.append(
+                "{:<24} {:>8} {:>10.3f} {:>10} {:>10.3f} {:>10}".format(
+                    name,
+                    item["count"],
+                    1000 * item["mean_seconds"],
+                    _ms(item["p95_seconds"]),
+                    1000 * item["max_seconds"],
+                    item["rows"]))
+        for query in summary["slow"]:
+            lines.append("")
+            lines.append("{} {:.3f} ms: {}".format(
+                query["method"], 1000 * query["seconds"], query["sql"]))
+            lines += ["    " + detail for detail in query["plan"]]
+        return "\n".join(lines)
+
+
+def _ms(seconds):
+    if seconds is None:
+        return "> {:g}".format(1000 * BUCKETS[-1])
+    return "{:g}".format(1000 * seconds)
+
+
+class MethodStats(object):
+    """Latency histogram, count and rows of a single method"""
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.total = 0.
+        self.max = 0.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.rows += rows
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile
+
+        :returns: seconds, None if it lies beyond the last bucket
+        """
+        target = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            if total >= target:
+                return bound
+        return None
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "rows": self.rows,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count,
+            "max_seconds": self.max,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "histogram": [
+                [bound, count] for bound, count in zip(
+                    list(BUCKETS) + [None], self.buckets)]}
+
+
+class InstrumentedCursor(object):
+    """Cursor that reports each statement to a QueryStats
+
+    A statement is attributed to the method named by
+    QueryStats.attribute or else to UNATTRIBUTED. Its latency
+    includes fetching, it is recorded by fetchall, by the first
+    fetchone or, if its rows are never fetched, when the next
+    statement is executed
+    """
+    def __init__(self, cursor, connection, stats):
+        self.cursor = cursor
+        self.connection = connection
+        self.stats = stats
+        self.pending = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        method = self.stats.method() or UNATTRIBUTED
+        start = time.perf_counter()
+        self.cursor.execute(sql, parameters)
+        seconds = time.perf_counter() - start
+        self.pending = [method, sql, parameters, seconds, 0]
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        method = self.stats.method() or UNATTRIBUTED
+        start = time.perf_counter()
+        self.cursor.executemany(sql, seq_of_parameters)
+        seconds = time.perf_counter() - start
+        self.stats.record(method, seconds, max(self.cursor.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self._finish(time.perf_counter() - start, int(row is not None))
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self._finish(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["cursor"], name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def _finish(self, seconds=0., rows=0):
+        if self.pending is None:
+            return
+        method, sql, parameters, elapsed, count = self.pending
+        self.pending = None
+        elapsed += seconds
+        count += rows
+        if count == 0:
+            count = max(self.cursor.rowcount, 0)
+        plan = None
+        if elapsed > self.stats.threshold:
+            plan = self.explain(sql, parameters)
+        self.stats.record(method, elapsed, count, sql=sql, plan=plan)
+
+    def explain(self, sql, parameters):
+        """EXPLAIN QUERY PLAN detail lines of a SELECT statement"""
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            return ["(not a query)"]
+        cursor = self.connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+# Shared by every instrumented connection in a process
+STATS = QueryStats()
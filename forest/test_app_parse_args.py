@@ -16,3 +16,27 @@ class TestApp(unittest.TestCase):
             "--config-file", "file.yaml"
         ])
         self.assertEqual(args.config_file, "file.yaml")
+
+    def test_parse_args_given_snapshot(self):
+        args = app.main.parse_args([
+            "--snapshot", "snapshot.db",
+            "--config-file", "file.yaml"
+        ])
+        self.assertEqual(args.snapshot, "snapshot.db")
+        self.assertIsNone(args.database)
+
+    def test_parse_args_given_stats(self):
+        args = app.main.parse_args([
+            "--database", "file.db",
+            "--config-file", "file.yaml",
+            "--stats"
+        ])
+        self.assertTrue(args.stats)
+
+    def test_parse_args_given_shards(self):
+        args = app.main.parse_args([
+            "--shards", "shards",
+            "--config-file", "file.yaml"
+        ])
+        self.assertEqual(args.shards, "shards")
+        self.assertIsNone(args.database)
@@ -0,0 +1,54 @@
+import unittest
+import datetime as dt
+import shutil
+import tempfile
+import benchmark
+import extract
+
+
+class TestGenerate(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_generate_given_shared_axes(self):
+        paths = benchmark.generate(
+            self.directory, files=2, variables=3, times=4, pressures=5)
+        metadata = extract.load_netcdf(paths[1])
+        self.assertEqual(2, len(paths))
+        self.assertEqual(dt.datetime(2019, 1, 1, 6), metadata.reference_time)
+        self.assertEqual(3, len(metadata.variables))
+        for variable in metadata.variables:
+            self.assertEqual((0, 1), (
+                variable.time_axis, variable.pressure_axis))
+            self.assertEqual(4, len(variable.times))
+            self.assertEqual(5, len(variable.pressures))
+        self.assertEqual(
+            metadata.variables[0].times, metadata.variables[2].times)
+
+    def test_generate_given_distinct_axes(self):
+        paths = benchmark.generate(
+            self.directory, files=1, variables=2, times=3, pressures=2,
+            shared_axes=False)
+        metadata = extract.load_netcdf(paths[0])
+        first, second = [v.times for v in metadata.variables]
+        self.assertEqual(first[1], second[0])
+
+
+class TestIngestRates(unittest.TestCase):
+    def test_ingest_rates_reports_every_run(self):
+        report = benchmark.ingest_rates(
+            files=2, variables=2, times=3, pressures=2,
+            extractors=["netcdf"], isolate=False)
+        self.assertEqual(
+            [("netcdf", "bulk"),
+             ("netcdf", "packed"),
+             ("netcdf", "per_point"),
+             ("netcdf", "template")],
+            [(run["extractor"], run["mode"]) for run in report["runs"]])
+        for run in report["runs"]:
+            self.assertEqual(2, run["files"])
+            self.assertEqual(2 * 2 * (3 + 2), run["rows"])
+            self.assertGreater(run["peak_rss_kb"], 0)
@@ -0,0 +1,43 @@
+import unittest
+import unittest.mock
+import cache
+
+
+class TestMenuCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.MenuCache(maxsize=2, check_interval=0.)
+
+    def test_get_computes_value_once(self):
+        compute = unittest.mock.Mock(return_value="value")
+        self.cache.get(lambda: 0, "key", compute)
+        result = self.cache.get(lambda: 0, "key", compute)
+        self.assertEqual("value", result)
+        compute.assert_called_once_with()
+
+    def test_get_given_new_generation_recomputes(self):
+        compute = unittest.mock.Mock(side_effect=["old", "new"])
+        self.cache.get(lambda: 0, "key", compute)
+        result = self.cache.get(lambda: 1, "key", compute)
+        self.assertEqual("new", result)
+
+    def test_get_evicts_least_recently_used(self):
+        self.cache.get(lambda: 0, "a", lambda: 1)
+        self.cache.get(lambda: 0, "b", lambda: 2)
+        self.cache.get(lambda: 0, "a", lambda: 1)
+        self.cache.get(lambda: 0, "c", lambda: 3)
+        result = self.cache.get(lambda: 0, "b", lambda: "recomputed")
+        self.assertEqual("recomputed", result)
+        self.assertEqual(2, len(self.cache))
+
+    def test_hits_and_misses(self):
+        self.cache.get(lambda: 0, "a", lambda: 1)
+        self.cache.get(lambda: 0, "a", lambda: 1)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_get_reads_generation_once_per_interval(self):
+        menus = cache.MenuCache(check_interval=60.)
+        generation = unittest.mock.Mock(side_effect=[0, 1])
+        menus.get(generation, "key", lambda: "old")
+        result = menus.get(generation, "key", lambda: "new")
+        self.assertEqual("old", result)
+        generation.assert_called_once_with()
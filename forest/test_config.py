@@ -0,0 +1,18 @@
+import unittest
+import yaml
+import config
+
+
+class TestLoadConfig(unittest.TestCase):
+    def test_load_config_patterns(self):
+        content = yaml.dump({
+            "models": [
+                {"name": "GA6", "pattern": "*global_africa*.nc"},
+                {"name": "Tropical Africa", "pattern": "*os42_ea*.nc"}
+            ]
+        })
+        result = config.load_config(content).patterns
+        expect = [
+            ("GA6", "*global_africa*.nc"),
+            ("Tropical Africa", "*os42_ea*.nc")]
+        self.assertEqual(expect, result)
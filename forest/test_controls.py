@@ -1,8 +1,11 @@
 import unittest
 import unittest.mock
+import concurrent.futures
 import datetime as dt
+import cache
 import control
 import database as db
+import util
 
 
 class TestControls(unittest.TestCase):
@@ -96,6 +99,47 @@ class TestControls(unittest.TestCase):
         expect = ["1000hPa", "950hPa", "850hPa"]
         self.assert_label_equal(expect, result)
 
+    def test_render_given_cache_reuses_menus_until_generation_changes(self):
+        menus = cache.MenuCache(check_interval=0.)
+        controls = control.Controls(self.database, cache=menus)
+        state = control.State(pattern="*.nc")
+        self.database.insert_variable("a.nc", "air_temperature")
+        controls.render(state)
+        self.database.insert_variable("b.nc", "mslp")
+        controls.render(state)
+        result = controls.dropdowns["variable"].menu
+        self.assert_label_equal(["air_temperature"], result)
+        self.database.bump_generation()
+        controls.render(state)
+        result = controls.dropdowns["variable"].menu
+        self.assert_label_equal(["air_temperature", "mslp"], result)
+
+    def test_render_given_cache_hit_does_not_query_database(self):
+        menus = cache.MenuCache(check_interval=60.)
+        controls = control.Controls(self.database, cache=menus)
+        state = control.State(pattern="*.nc")
+        controls.render(state)
+        statements = []
+        self.database.connection.set_trace_callback(statements.append)
+        controls.render(state)
+        self.assertEqual([], statements)
+        self.assertEqual(1, menus.hits)
+
+    def test_render_given_background_applies_menus_on_next_tick(self):
+        ticks = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        controls = control.Controls(
+            db.Database.connect(":memory:", check_same_thread=False),
+            background=util.Background(executor, ticks.append))
+        controls.database.insert_variable("a.nc", "air_temperature")
+        controls.render(control.State())
+        executor.shutdown()
+        self.assertEqual([], controls.dropdowns["variable"].menu)
+        for tick in ticks:
+            tick()
+        result = controls.dropdowns["variable"].menu
+        self.assert_label_equal(["air_temperature"], result)
+
     def test_hpa_given_small_pressures(self):
         result = control.Controls.hpa(0.001)
         expect = "0.001hPa"
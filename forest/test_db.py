@@ -1,7 +1,17 @@
 import unittest
+import unittest.mock
+import os
+import shutil
+import tempfile
+import threading
 import datetime as dt
 import sqlite3
+import numpy as np
+import control
 import database as db
+import extract
+import schema
+import test_extract
 
 
 class TestDatabase(unittest.TestCase):
@@ -39,6 +49,77 @@ class TestDatabase(unittest.TestCase):
         expect = ["a.nc"]
         self.assertEqual(expect, result)
 
+    def test_database_adds_signature_columns_to_existing_file_table(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute("""
+            CREATE TABLE file (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    reference TEXT,
+                    UNIQUE(name))
+        """)
+        database = db.Database(connection)
+        database.insert_file_name("a.nc")
+        result = database.signature("a.nc")
+        expect = (None, None, None)
+        self.assertEqual(expect, result)
+
+    def test_bump_generation(self):
+        before = self.database.generation()
+        self.database.bump_generation()
+        self.assertEqual(before + 1, self.database.generation())
+
+    def test_signature_given_unknown_file_returns_none(self):
+        self.assertIsNone(self.database.signature("a.nc"))
+
+    def test_update_signature(self):
+        signature = extract.Signature(size=1, mtime=2., checksum="abc")
+        self.database.insert_file_name("a.nc")
+        self.database.update_signature("a.nc", signature)
+        result = self.database.signature("a.nc")
+        self.assertEqual(signature, result)
+
+    def test_insert_metadata_writes_signature_last(self):
+        signature = extract.Signature(size=1, mtime=2.)
+        times = [dt.datetime(2019, 1, 1)]
+        metadata = extract.Metadata("a.nc", None, [
+            extract.Variable("x", 0, None, times, None),
+            extract.Variable("y", 0, None, times, None)], signature)
+        with unittest.mock.patch.object(
+                self.database, "insert_times",
+                side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                self.database.insert_metadata(metadata)
+        self.assertEqual((None, None), self.database.signature("a.nc")[:2])
+
+    def test_exit_given_exception_rolls_back(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "file.db")
+        with db.Database.connect(path) as database:
+            database.insert_file_name("a.nc")
+        with self.assertRaises(KeyboardInterrupt):
+            with db.Database.connect(path) as database:
+                database.insert_file_name("b.nc")
+                raise KeyboardInterrupt
+        with db.Database.connect(path) as database:
+            self.assertEqual(["a.nc"], database.file_names())
+
+    def test_delete_file_removes_variables_and_junction_rows(self):
+        time = dt.datetime(2019, 1, 1)
+        self.database.insert_time("a.nc", self.variable, time, 0)
+        self.database.insert_pressure("a.nc", self.variable, 1000., 0)
+        self.database.insert_time("b.nc", self.variable, time, 0)
+        self.database.delete_file("a.nc")
+        self.cursor.execute("""
+            SELECT variable_id, time_id FROM variable_to_time
+             UNION ALL
+            SELECT variable_id, pressure_id FROM variable_to_pressure
+        """)
+        result = self.cursor.fetchall()
+        self.assertEqual([(2, 1)], result)
+        self.assertEqual(["b.nc"], self.database.file_names())
+
     def test_insert_variable(self):
         self.database.insert_variable(self.path, self.variable)
         self.cursor.execute("""
@@ -64,7 +145,7 @@ class TestDatabase(unittest.TestCase):
         self.database.insert_time(self.path, self.variable, time, i)
         self.cursor.execute("SELECT id, i, value FROM time")
         result = self.cursor.fetchall()
-        expect = [(1, i, str(time))]
+        expect = [(1, i, db.to_epoch(time))]
         self.assertEqual(expect, result)
 
     def test_insert_pressure_unique_constraint(self):
@@ -110,7 +191,26 @@ class TestDatabase(unittest.TestCase):
         times = [dt.datetime(2019, 1, 1, 12), dt.datetime(2019, 1, 1, 13)]
         self.database.insert_times(path, variable, times)
         result = self.database.fetch_times(path, variable)
-        expect = ["2019-01-01 12:00:00", "2019-01-01 13:00:00"]
+        expect = [dt.datetime(2019, 1, 1, 12), dt.datetime(2019, 1, 1, 13)]
+        self.assertEqual(expect, result)
+
+    def test_insert_times_links_every_point_to_variable(self):
+        times = [dt.datetime(2019, 1, 1, 12), dt.datetime(2019, 1, 1, 13)]
+        self.database.insert_times("a.nc", "mslp", times)
+        self.database.insert_times("b.nc", "mslp", times)
+        self.cursor.execute("""
+            SELECT variable_id, time_id FROM variable_to_time
+             ORDER BY variable_id, time_id
+        """)
+        result = self.cursor.fetchall()
+        expect = [(1, 1), (1, 2), (2, 1), (2, 2)]
+        self.assertEqual(expect, result)
+
+    def test_insert_pressures(self):
+        pressures = [1000., 950., 850.]
+        self.database.insert_pressures(self.path, self.variable, pressures)
+        result = self.database.pressures(variable=self.variable)
+        expect = [850., 950., 1000.]
         self.assertEqual(expect, result)
 
     def test_valid_times_returns_all_valid_times(self):
@@ -122,10 +222,20 @@ class TestDatabase(unittest.TestCase):
             self.database.insert_time(path, variable, time, i)
         result = self.database.valid_times()
         expect = [
-            "2019-01-01 00:00:00",
-            "2019-01-01 01:00:00",
-            "2019-01-01 02:00:00",
-            "2019-01-01 03:00:00"]
+            dt.datetime(2019, 1, 1),
+            dt.datetime(2019, 1, 1, 1),
+            dt.datetime(2019, 1, 1, 2),
+            dt.datetime(2019, 1, 1, 3)]
+        self.assertEqual(expect, result)
+
+    def test_valid_times_are_distinct_and_ordered(self):
+        for (path, time) in [
+                ("file_0.nc", dt.datetime(2019, 1, 1, 3)),
+                ("file_1.nc", dt.datetime(2019, 1, 1, 3)),
+                ("file_1.nc", dt.datetime(2019, 1, 1, 1))]:
+            self.database.insert_times(path, self.variable, [time])
+        result = self.database.valid_times()
+        expect = [dt.datetime(2019, 1, 1, 1), dt.datetime(2019, 1, 1, 3)]
         self.assertEqual(expect, result)
 
     def test_valid_times_supports_variable_filtering(self):
@@ -136,7 +246,7 @@ class TestDatabase(unittest.TestCase):
                 ("file_2.nc", "var_b", "2019-01-01 03:00:00", 0)]:
             self.database.insert_time(path, variable, time, i)
         result = self.database.valid_times(variable="var_b")
-        expect = ["2019-01-01 02:00:00", "2019-01-01 03:00:00"]
+        expect = [dt.datetime(2019, 1, 1, 2), dt.datetime(2019, 1, 1, 3)]
         self.assertEqual(expect, result)
 
     def test_valid_times_supports_glob_pattern(self):
@@ -147,7 +257,7 @@ class TestDatabase(unittest.TestCase):
                 ("file_2.nc", "2019-01-01 03:00:00", 0)]:
             self.database.insert_time(path, self.variable, time, i)
         result = self.database.valid_times(pattern="*_1.nc")
-        expect = ["2019-01-01 01:00:00", "2019-01-01 02:00:00"]
+        expect = [dt.datetime(2019, 1, 1, 1), dt.datetime(2019, 1, 1, 2)]
         self.assertEqual(expect, result)
 
     def test_valid_times_given_variable_and_pattern(self):
@@ -160,7 +270,7 @@ class TestDatabase(unittest.TestCase):
         result = self.database.valid_times(
             pattern="*_1.nc",
             variable="var_b")
-        expect = ["2019-01-01 02:00:00"]
+        expect = [dt.datetime(2019, 1, 1, 2)]
         self.assertEqual(expect, result)
 
     def test_valid_times_given_initial_time(self):
@@ -179,8 +289,8 @@ class TestDatabase(unittest.TestCase):
                 self.database.insert_time(path, self.variable, time, i)
         result = self.database.valid_times(initial_time="2019-01-01 00:00:00")
         expect = [
-            "2019-01-01 03:00:00",
-            "2019-01-01 06:00:00"]
+            dt.datetime(2019, 1, 1, 3),
+            dt.datetime(2019, 1, 1, 6)]
         self.assertEqual(expect, result)
 
     def test_valid_times_given_initial_time_and_variable(self):
@@ -204,8 +314,8 @@ class TestDatabase(unittest.TestCase):
             variable="y",
             initial_time="2019-01-01 00:00:00")
         expect = [
-            "2019-01-01 06:00:00",
-            "2019-01-01 09:00:00"]
+            dt.datetime(2019, 1, 1, 6),
+            dt.datetime(2019, 1, 1, 9)]
         self.assertEqual(expect, result)
 
     def test_find_all_available_dates(self):
@@ -225,7 +335,7 @@ class TestDatabase(unittest.TestCase):
 
         self.cursor.execute("SELECT reference FROM file")
         result = self.cursor.fetchall()
-        expect = [(str(reference_time),)]
+        expect = [(db.to_epoch(reference_time),)]
         self.assertEqual(expect, result)
 
     def test_variable_to_pressure_junction_table_should_be_unique(self):
@@ -282,14 +392,14 @@ class TestDatabase(unittest.TestCase):
         self.database.insert_file_name("a.nc", time)
         self.database.insert_file_name("b.nc", time)
         result = self.database.initial_times()
-        expect = ["2019-01-01 00:00:00"]
+        expect = [dt.datetime(2019, 1, 1)]
         self.assertEqual(expect, result)
 
     def test_initial_times_supports_glob_pattern(self):
         self.database.insert_file_name("file_0.nc", "2019-01-01 00:00:00")
         self.database.insert_file_name("file_1.nc", "2019-01-02 00:00:00")
         result = self.database.initial_times(pattern="*_0.nc")
-        expect = ["2019-01-01 00:00:00"]
+        expect = [dt.datetime(2019, 1, 1)]
         self.assertEqual(expect, result)
 
     def test_files(self):
@@ -391,6 +501,238 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(expect, result)
 
 
+class TestMenus(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+        for path, initial in [
+                ("a_0.nc", "2019-01-01 00:00:00"),
+                ("a_1.nc", "2019-01-01 12:00:00"),
+                ("b_0.nc", "2019-01-01 00:00:00")]:
+            self.database.insert_file_name(path, initial)
+        for path, variable, time, pressure in [
+                ("a_0.nc", "x", "2019-01-01 03:00:00", 1000.),
+                ("a_0.nc", "x", "2019-01-01 06:00:00", 850.),
+                ("a_0.nc", "y", "2019-01-01 03:00:00", 500.),
+                ("a_1.nc", "x", "2019-01-01 15:00:00", 1000.),
+                ("b_0.nc", "z", "2019-01-01 03:00:00", 250.)]:
+            self.database.insert_time(path, variable, time, 0)
+            self.database.insert_pressure(path, variable, pressure, 0)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_menus_given_pattern(self):
+        result = self.database.menus(control.State(pattern="a_*.nc"))
+        expect = db.Menus(
+            variables=["x", "y"],
+            initial_times=[
+                dt.datetime(2019, 1, 1),
+                dt.datetime(2019, 1, 1, 12)],
+            pressures=None,
+            valid_times=None)
+        self.assertEqual(expect, result)
+
+    def test_menus_given_initial_time_and_variable(self):
+        result = self.database.menus(control.State(
+            pattern="a_*.nc",
+            variable="x",
+            initial_time="2019-01-01 00:00:00"))
+        expect = db.Menus(
+            variables=["x", "y"],
+            initial_times=[
+                dt.datetime(2019, 1, 1),
+                dt.datetime(2019, 1, 1, 12)],
+            pressures=[850., 1000.],
+            valid_times=[
+                dt.datetime(2019, 1, 1, 3),
+                dt.datetime(2019, 1, 1, 6)])
+        self.assertEqual(expect, result)
+
+    def test_menus_executes_single_query(self):
+        state = control.State(
+            pattern="*.nc",
+            variable="x",
+            initial_time="2019-01-01 00:00:00")
+        self.database.menus(state)  # First call reads registered models
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.database.menus(state)
+        self.assertEqual(1, len(statements))
+
+
+class TestModels(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_insert_model_classifies_existing_files(self):
+        self.database.insert_variable("ga6_global_africa.nc", "x")
+        self.database.insert_variable("os42_ea.nc", "y")
+        self.database.insert_model("GA6", "*global_africa*.nc")
+        result = self.database.variables(pattern="*global_africa*.nc")
+        self.assertEqual(["x"], result)
+
+    def test_insert_file_name_classifies_new_files(self):
+        self.database.insert_model("GA6", "*global_africa*.nc")
+        self.database.insert_variable("ga6_global_africa.nc", "x")
+        self.database.insert_variable("os42_ea.nc", "y")
+        result = self.database.variables(pattern="*global_africa*.nc")
+        self.assertEqual(["x"], result)
+
+    def test_known_pattern_queries_file_model(self):
+        self.database.insert_model("GA6", "*global_africa*.nc")
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.database.valid_times(pattern="*global_africa*.nc")
+        self.assertIn("file_model", statements[-1])
+        self.assertNotIn("GLOB", statements[-1])
+
+    def test_unknown_pattern_falls_back_to_glob(self):
+        self.database.insert_model("GA6", "*global_africa*.nc")
+        self.database.insert_variable("a.nc", "x")
+        result = self.database.variables(pattern="a*.nc")
+        self.assertEqual(["x"], result)
+
+    def test_model_registered_by_other_connection_seen_after_bump(self):
+        self.database.insert_variable("ga6_global_africa.nc", "x")
+        self.database.insert_variable("os42_ea.nc", "y")
+        reader = db.Database(self.connection)
+        pattern = "ga6_*.nc"
+        self.assertEqual({}, reader._models())
+        writer = db.Database(self.connection)
+        writer.insert_model("GA6", pattern)
+        writer.bump_generation()
+        with unittest.mock.patch("database.MODELS_INTERVAL", 0.):
+            params = reader._pattern_params(pattern)
+        self.assertIsNone(params["pattern"])
+        self.assertEqual(["x"], reader.variables(pattern=pattern))
+
+    def test_models_cached_between_checks(self):
+        self.database.insert_model("GA6", "ga6_*.nc")
+        self.database.variables(pattern="ga6_*.nc")
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.database.variables(pattern="ga6_*.nc")
+        self.assertEqual(1, len(statements))
+
+    def test_pattern_params_given_catalogue_without_model_table(self):
+        connection = sqlite3.connect(":memory:")
+        cursor = connection.cursor()
+        for step in schema.MIGRATIONS[:4]:
+            step(cursor)
+        result = db.Connection(connection)._pattern_params("*.nc")
+        connection.close()
+        self.assertEqual(dict(pattern="*.nc", model=None), result)
+
+    def test_delete_file_removes_membership(self):
+        self.database.insert_model("GA6", "*.nc")
+        self.database.insert_file_name("a.nc")
+        self.database.delete_file("a.nc")
+        cursor = self.connection.execute("SELECT * FROM file_model")
+        self.assertEqual([], cursor.fetchall())
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.path = "test-connection-manager.db"
+        self.writer = db.Database.connect(self.path)
+        self.writer.insert_file_name("a.nc")
+        self.writer.connection.commit()
+
+    def tearDown(self):
+        self.writer.close()
+        for path in [self.path, self.path + "-wal", self.path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_connect_enables_wal(self):
+        cursor = self.writer.connection.execute("PRAGMA journal_mode")
+        self.assertEqual([("wal",)], cursor.fetchall())
+
+    def test_connect_shared_gives_each_thread_a_connection(self):
+        reader = db.Database.connect_shared(self.path)
+        connections = []
+
+        def work():
+            connections.append(reader.connection.get())
+            self.assertEqual(["a.nc"], reader.file_names())
+
+        threads = [threading.Thread(target=work) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        reader.close()
+        self.assertEqual(2, len(set(map(id, connections))))
+
+    def test_connect_shared_is_read_only(self):
+        reader = db.Database.connect_shared(self.path)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.insert_file_name("b.nc")
+        reader.close()
+
+    def test_connect_shared_given_older_catalogue_raises(self):
+        self.writer.cursor.execute(
+            "UPDATE schema_version SET version = :v",
+            dict(v=schema.VERSION - 1))
+        self.writer.connection.commit()
+        with self.assertRaisesRegex(RuntimeError, "older"):
+            db.Database.connect_shared(self.path)
+        self.assertEqual(
+            schema.VERSION - 1, schema.version(self.writer.connection))
+
+    def test_close_opens_no_connection(self):
+        manager = db.ConnectionManager(self.path)
+        with unittest.mock.patch.object(manager, "open") as open_:
+            db.Locator(manager).close()
+        open_.assert_not_called()
+
+    def test_locator_connect_keeps_journal_mode(self):
+        path = self.path + ".delete"
+        self.addCleanup(os.remove, path)
+        db.Database(sqlite3.connect(path)).close()
+        db.Locator.connect(path).close()
+        connection = sqlite3.connect(path)
+        mode, = connection.execute("PRAGMA journal_mode").fetchone()
+        connection.close()
+        self.assertEqual("delete", mode)
+
+    def test_reader_not_blocked_by_open_write_transaction(self):
+        reader = db.Database.connect_shared(self.path, timeout=0.)
+        self.writer.insert_file_name("b.nc")
+        result = reader.file_names()
+        self.writer.connection.commit()
+        reader.close()
+        self.assertEqual(["a.nc"], result)
+
+
+class TestCompileVariants(unittest.TestCase):
+    def test_compile_variants_renders_every_combination(self):
+        queries = db.compile_variants(" AND ".join, {"a": "A", "b": "B"})
+        expect = {
+            frozenset(): "",
+            frozenset(["a"]): "A",
+            frozenset(["b"]): "B",
+            frozenset(["a", "b"]): "A AND B"}
+        self.assertEqual(expect, queries)
+
+    def test_valid_times_registry_covers_all_filters(self):
+        self.assertEqual(16, len(db.VALID_TIMES))
+        self.assertEqual(16, len(db.PRESSURES))
+        self.assertEqual(4, len(db.VARIABLES))
+        self.assertEqual(16, len(db.MENUS))
+
+    def test_variables_given_pattern_containing_sql(self):
+        database = db.Database.connect(":memory:")
+        database.insert_variable("a.nc", "var_0")
+        result = database.variables(pattern="a.nc' OR '1'='1")
+        self.assertEqual([], result)
+
+
 class TestCoordinateDB(unittest.TestCase):
     def setUp(self):
         self.database = db.CoordinateDB.connect(":memory:")
@@ -539,6 +881,134 @@ class TestCoordinateDB(unittest.TestCase):
         expect = [0]
         self.assertEqual(expect, result)
 
+    def test_time_indices_resolves_values_in_order(self):
+        times = [
+            dt.datetime(2019, 1, 1),
+            dt.datetime(2019, 1, 1, 6),
+            dt.datetime(2019, 1, 1, 12)]
+        self.database.insert_times("a.nc", "mslp", times)
+        self.database.insert_times("b.nc", "mslp", times[1:])
+        values = [times[2], dt.datetime(2020, 1, 1), times[0]]
+        result = self.database.time_indices("*.nc", "mslp", values)
+        expect = [
+            self.database.time_index("*.nc", "mslp", value)
+            for value in values]
+        self.assertEqual([[2, 1], [], [0]], result)
+        self.assertEqual(expect, result)
+
+    def test_pressure_indices_given_pattern(self):
+        self.database.insert_pressures("a.nc", "mslp", [1000., 850.])
+        self.database.insert_pressures("b.nc", "mslp", [850., 500.])
+        result = self.database.pressure_indices(
+            "b.nc", "mslp", [500, 850., 1000.])
+        self.assertEqual([[1], [0], []], result)
+
+    def test_insert_metadata_writes_every_coordinate(self):
+        times = [dt.datetime(2019, 1, 1), dt.datetime(2019, 1, 1, 6)]
+        self.database.insert_metadata(extract.Metadata("file.nc", None, [
+            extract.Variable("mslp", 0, None, times, None),
+            extract.Variable("temperature", 0, 1, times, [1000., 500.])]))
+        self.assertEqual(
+            [("time", 0), ("pressure", 1)],
+            self.database.coordinates("file.nc", "temperature"))
+        self.assertEqual(
+            [("time", 0)], self.database.coordinates("file.nc", "mslp"))
+        self.assertEqual(
+            [[1]], self.database.time_indices("*", "mslp", times[1:]))
+        self.assertEqual(
+            [1], self.database.pressure_index("*", "temperature", 500.))
+
+    def test_insert_metadata_given_reload_replaces_rows(self):
+        times = [dt.datetime(2019, 1, 1), dt.datetime(2019, 1, 1, 6)]
+        metadata = extract.Metadata("file.nc", None, [
+            extract.Variable("mslp", 0, 1, times, [1000., 500.])])
+        self.database.insert_metadata(metadata)
+        self.database.insert_metadata(metadata)
+        self.assertEqual(
+            [[0], [1]], self.database.time_indices("*", "mslp", times))
+        self.assertEqual(
+            [[1]], self.database.pressure_indices("*", "mslp", [500.]))
+        self.assertEqual(
+            [("time", 0), ("pressure", 1)],
+            self.database.coordinates("file.nc", "mslp"))
+
+    def test_insert_times_given_same_axis_twice(self):
+        times = [dt.datetime(2019, 1, 1)]
+        self.database.insert_times("file.nc", "mslp", times)
+        self.database.insert_times("file.nc", "mslp", times)
+        self.database.insert_axis("file.nc", "mslp", "time", 0)
+        self.database.insert_axis("file.nc", "mslp", "time", 0)
+        self.assertEqual(
+            [0], self.database.time_index("*", "mslp", times[0]))
+        self.assertEqual(
+            [("time", 0)], self.database.coordinates("file.nc", "mslp"))
+
+    def test_reopen_existing_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "coordinates.db")
+        with db.CoordinateDB.connect(path) as database:
+            database.insert_axis("file.nc", "mslp", "time", 0)
+        with db.CoordinateDB.connect(path) as database:
+            database.insert_axis("file.nc", "mslp", "pressure", 1)
+            result = database.coordinates("file.nc", "mslp")
+        self.assertEqual([("time", 0), ("pressure", 1)], result)
+
+
+    def test_open_file_created_without_unique_constraints(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute(
+            "CREATE TABLE file (id INTEGER PRIMARY KEY, name TEXT, "
+            "UNIQUE(name))")
+        for table, column in [
+                ("axis", "name TEXT"),
+                ("time", "i INTEGER"),
+                ("pressure", "i INTEGER")]:
+            connection.execute(
+                "CREATE TABLE {} (id INTEGER PRIMARY KEY, variable TEXT, "
+                "{}, value, file_id INTEGER)".format(table, column))
+        connection.execute("INSERT INTO file (name) VALUES ('file.nc')")
+        for value in ["2019-01-01 00:00:00", "2019-01-01 06:00:00"]:
+            connection.execute(
+                "INSERT INTO time (variable, i, value, file_id) "
+                "VALUES ('mslp', 0, :value, 1)", dict(value=value))
+        database = db.CoordinateDB(connection)
+        self.assertEqual(
+            [[0]], database.time_indices(
+                "*", "mslp", [dt.datetime(2019, 1, 1, 6)]))
+        self.assertEqual(
+            [[]], database.time_indices(
+                "*", "mslp", [dt.datetime(2019, 1, 1)]))
+        database.insert_times("file.nc", "mslp", [dt.datetime(2019, 1, 1)])
+        database.insert_times("file.nc", "mslp", [dt.datetime(2019, 1, 1)])
+        cursor = connection.execute("SELECT COUNT(*) FROM time")
+        self.assertEqual((1,), cursor.fetchone())
+        connection.close()
+
+class TestEpoch(unittest.TestCase):
+    def test_to_epoch_given_datetime(self):
+        result = db.to_epoch(dt.datetime(1970, 1, 2))
+        self.assertEqual(86400, result)
+
+    def test_to_epoch_given_menu_label(self):
+        result = db.to_epoch("2019-01-01 12:00:00")
+        self.assertEqual(db.to_epoch(dt.datetime(2019, 1, 1, 12)), result)
+
+    def test_to_epoch_given_iso_format(self):
+        result = db.to_epoch("2019-01-01T12:00:00")
+        self.assertEqual(db.to_epoch(dt.datetime(2019, 1, 1, 12)), result)
+
+    def test_to_epoch_given_datetime64(self):
+        result = db.to_epoch(np.datetime64("2019-01-01T12:00:00"))
+        self.assertEqual(db.to_epoch(dt.datetime(2019, 1, 1, 12)), result)
+
+    def test_to_epoch_given_none(self):
+        self.assertIsNone(db.to_epoch(None))
+
+    def test_from_epoch(self):
+        time = dt.datetime(2019, 1, 1, 12)
+        self.assertEqual(time, db.from_epoch(db.to_epoch(time)))
+
 
 class TestLocator(unittest.TestCase):
     def setUp(self):
@@ -587,3 +1057,319 @@ class TestLocator(unittest.TestCase):
             pressure)
         expect = ("file_000.nc", (0, 0))
         self.assertEqual(expect, result)
+
+    def test_path_points_given_no_match_returns_none(self):
+        result = self.locator.path_points(
+            "*.nc",
+            "temperature",
+            dt.datetime(2019, 1, 1),
+            dt.datetime(2019, 1, 1, 2),
+            1000.)
+        self.assertIsNone(result)
+
+    def test_path_points_given_shared_axis_skips_nearer_mismatched_point(self):
+        path = "file.nc"
+        variable = "relative_humidity"
+        initial_time = dt.datetime(2019, 1, 1)
+        times = [dt.datetime(2019, 1, 1, h) for h in (0, 0, 3)]
+        pressures = [1000., 850., 1000.]
+        self.database.insert_file_name(path, initial_time)
+        self.database.insert_variable(
+            path, variable, time_axis=0, pressure_axis=0)
+        self.database.insert_times(path, variable, times)
+        self.database.insert_pressures(path, variable, pressures)
+        result = self.locator.path_points(
+            "*.nc", variable, initial_time, times[2], 900.)
+        expect = (path, (2,))
+        self.assertEqual(expect, result)
+
+
+class TestPackedAxes(unittest.TestCase):
+    def setUp(self):
+        self.initial_time = dt.datetime(2019, 1, 1)
+        self.times = [dt.datetime(2019, 1, 1, h) for h in range(3)]
+        self.pressures = [1000., 850., 500.]
+        self.per_point = self.catalogue(packed=False)
+        self.packed = self.catalogue(packed=True)
+
+    def tearDown(self):
+        self.per_point.close()
+        self.packed.close()
+
+    def catalogue(self, packed):
+        database = db.Database(sqlite3.connect(":memory:"), packed=packed)
+        for path in ["a_0.nc", "a_1.nc", "b_0.nc"]:
+            database.insert_file_name(path, self.initial_time)
+            for variable in ["x", "y"]:
+                database.insert_variable(
+                    path, variable, time_axis=0, pressure_axis=1)
+                database.insert_times(path, variable, self.times)
+                database.insert_pressures(path, variable, self.pressures)
+        # Time and pressure sharing an axis
+        database.insert_file_name("c_0.nc", self.initial_time)
+        database.insert_variable(
+            "c_0.nc", "z", time_axis=0, pressure_axis=0)
+        database.insert_times("c_0.nc", "z", [self.times[0]] * 2)
+        database.insert_pressures("c_0.nc", "z", [1000., 850.])
+        return database
+
+    def test_pack_axis_round_trip(self):
+        digest, data = db.pack_axis("pressure", self.pressures)
+        result = db.unpack_axis("pressure", data)
+        np.testing.assert_array_equal(self.pressures, result)
+        self.assertEqual(16, len(digest))
+
+    def test_identical_axes_stored_once(self):
+        self.packed.cursor.execute("SELECT kind, size FROM axis ORDER BY id")
+        result = self.packed.cursor.fetchall()
+        expect = [
+            ("time", 3), ("pressure", 3), ("time", 2), ("pressure", 2)]
+        self.assertEqual(expect, result)
+        self.packed.cursor.execute("SELECT COUNT(*) FROM variable_to_time")
+        self.assertEqual((0,), self.packed.cursor.fetchone())
+
+    def test_queries_match_per_point_layout(self):
+        for method, kwargs in [
+                ("valid_times", {}),
+                ("valid_times", dict(variable="z")),
+                ("valid_times", dict(pattern="a_*.nc", variable="x")),
+                ("pressures", {}),
+                ("pressures", dict(
+                    variable="x", initial_time=self.initial_time)),
+                ("pressures", dict(pattern="c_*.nc")),
+                ("fetch_dates", {})]:
+            expect = getattr(self.per_point, method)(**kwargs)
+            result = getattr(self.packed, method)(**kwargs)
+            self.assertEqual(expect, result, msg=(method, kwargs))
+
+    def test_menus_match_per_point_layout(self):
+        state = control.State(
+            pattern="*.nc",
+            variable="x",
+            initial_time=self.initial_time)
+        self.assertEqual(
+            self.per_point.menus(state),
+            self.packed.menus(state))
+
+    def test_path_points_match_per_point_layout(self):
+        expect_locator = db.Locator(self.per_point.connection)
+        result_locator = db.Locator(self.packed.connection)
+        for args in [
+                ("a_*.nc", "x", self.initial_time, self.times[1], 900.),
+                ("*.nc", "y", self.initial_time, self.times[2], 100.),
+                ("*.nc", "z", self.initial_time, self.times[0], 900.),
+                ("*.nc", "z", self.initial_time, self.times[1], 900.),
+                ("b_*.nc", "x", self.initial_time,
+                 dt.datetime(2019, 1, 2), 850.)]:
+            expect = expect_locator.path_points(*args)
+            result = result_locator.path_points(*args)
+            self.assertEqual(expect, result, msg=str(args))
+
+    def test_queries_merge_per_point_and_packed_variables(self):
+        self.packed.insert_time(
+            "d_0.nc", "x", dt.datetime(2019, 1, 1, 12), 0)
+        self.packed.insert_time(
+            "d_0.nc", "x", dt.datetime(2019, 1, 1, 1), 1)
+        result = self.packed.valid_times(variable="x")
+        expect = self.times + [dt.datetime(2019, 1, 1, 12)]
+        self.assertEqual(expect, result)
+
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        self.references = [
+            dt.datetime(2019, 1, 1),
+            dt.datetime(2019, 1, 1, 12),
+            dt.datetime(2019, 1, 2)]
+        self.paths = [
+            "test-template-{}.nc".format(i)
+            for i in range(len(self.references))]
+        for path, reference in zip(self.paths, self.references):
+            test_extract.write_run(path, reference)
+
+    def tearDown(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def catalogue(self, packed=False, templates=True):
+        database = db.Database(sqlite3.connect(":memory:"), packed=packed)
+        for path in self.paths:
+            if templates:
+                database.insert_netcdf(path)
+            else:
+                database.insert_metadata(
+                    extract.load_netcdf(path)._replace(fingerprint=None))
+        return database
+
+    def assert_same_catalogue(self, expect, result):
+        for reference in self.references:
+            for method in ("valid_times", "pressures"):
+                self.assertEqual(
+                    getattr(expect, method)(initial_time=reference),
+                    getattr(result, method)(initial_time=reference))
+            for pressure in (1000., 900.):
+                args = (
+                    "*.nc", "air_temperature", reference,
+                    reference + dt.timedelta(hours=6), pressure)
+                self.assertEqual(
+                    db.Locator(expect.connection).path_points(*args),
+                    db.Locator(result.connection).path_points(*args))
+
+    def test_insert_netcdf_clones_template(self):
+        expect = self.catalogue(templates=False)
+        result = self.catalogue()
+        self.assert_same_catalogue(expect, result)
+        self.assertEqual(
+            [dt.datetime(2019, 1, 2, 3), dt.datetime(2019, 1, 2, 6)],
+            result.valid_times(initial_time=self.references[2]))
+        result.cursor.execute("SELECT COUNT(*) FROM template")
+        self.assertEqual((1,), result.cursor.fetchone())
+
+    def test_insert_netcdf_given_packed_axes_clones_template(self):
+        expect = self.catalogue(templates=False)
+        result = self.catalogue(packed=True)
+        self.assert_same_catalogue(expect, result)
+
+    def test_insert_netcdf_skips_extraction_given_known_layout(self):
+        database = db.Database(sqlite3.connect(":memory:"))
+        database.insert_netcdf(self.paths[0])
+        with unittest.mock.patch("extract.read_dataset") as read_dataset:
+            database.insert_netcdf(self.paths[1])
+        read_dataset.assert_not_called()
+        self.assertEqual(sorted(self.paths[:2]), database.files())
+
+    def test_insert_netcdf_given_templates_off_extracts_every_file(self):
+        expect = self.catalogue(templates=False)
+        result = db.Database(sqlite3.connect(":memory:"), templates=False)
+        with unittest.mock.patch(
+                "extract.read_dataset",
+                wraps=extract.read_dataset) as read_dataset:
+            for path in self.paths:
+                result.insert_netcdf(path)
+        self.assertEqual(len(self.paths), read_dataset.call_count)
+        self.assert_same_catalogue(expect, result)
+        result.cursor.execute("SELECT COUNT(*) FROM template")
+        self.assertEqual((0,), result.cursor.fetchone())
+
+    def test_delete_file_removes_template(self):
+        database = db.Database(sqlite3.connect(":memory:"))
+        database.insert_netcdf(self.paths[0])
+        database.delete_file(self.paths[0])
+        database.insert_netcdf(self.paths[1])
+        self.assertEqual(
+            [dt.datetime(2019, 1, 1, 15), dt.datetime(2019, 1, 1, 18)],
+            database.valid_times(initial_time=self.references[1]))
+
+
+class TestPrune(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+        self.times = [dt.datetime(2019, 1, 1, h) for h in range(3)]
+        for path, reference in [
+                ("a.nc", dt.datetime(2019, 1, 1)),
+                ("b.nc", dt.datetime(2019, 1, 1)),
+                ("c.nc", dt.datetime(2019, 1, 2))]:
+            self.database.insert_file_name(path, reference)
+            self.database.insert_times(path, "x", self.times)
+            self.database.insert_pressures(path, "x", [1000., 850.])
+        self.database.insert_times("c.nc", "y", [dt.datetime(2019, 1, 2)])
+        self.database.insert_pressures("c.nc", "y", [500.])
+
+    def tearDown(self):
+        self.connection.close()
+
+    def count(self, table):
+        self.database.cursor.execute("SELECT COUNT(*) FROM " + table)
+        return self.database.cursor.fetchone()[0]
+
+    def test_files_before(self):
+        result = self.database.files_before(dt.datetime(2019, 1, 2))
+        self.assertEqual(["a.nc", "b.nc"], result)
+
+    def test_collect_garbage_removes_unshared_rows(self):
+        self.database.delete_file("c.nc")
+        removed = self.database.collect_garbage(batch_size=2)
+        self.assertEqual(1, removed["time"])
+        self.assertEqual(1, removed["pressure"])
+        self.assertEqual(3, self.count("time"))
+        self.assertEqual(2, self.count("pressure"))
+        self.assertEqual(
+            self.times, self.database.valid_times(variable="x"))
+
+    def test_collect_garbage_after_deleting_every_file(self):
+        for path in ["a.nc", "b.nc", "c.nc"]:
+            self.database.delete_file(path)
+        self.database.collect_garbage(batch_size=2)
+        for table in ["time", "pressure", "variable_to_time", "variable"]:
+            self.assertEqual(0, self.count(table), msg=table)
+
+    def test_collect_garbage_given_file_row_deleted_by_hand(self):
+        self.database.cursor.execute("DELETE FROM file WHERE name = 'c.nc'")
+        removed = self.database.collect_garbage()
+        self.assertEqual(2, removed["variable"])
+        self.assertEqual(4, removed["variable_to_time"])
+        self.assertEqual(3, removed["variable_to_pressure"])
+        self.assertEqual(1, removed["time"])
+
+    def test_collect_garbage_removes_unreferenced_packed_axes(self):
+        self.database.packed = True
+        self.database.insert_times("d.nc", "x", [dt.datetime(2019, 1, 3)])
+        self.database.insert_times("e.nc", "x", [dt.datetime(2019, 1, 3)])
+        self.database.delete_file("d.nc")
+        self.assertEqual(0, self.database.collect_garbage()["axis"])
+        self.database.delete_file("e.nc")
+        self.assertEqual(1, self.database.collect_garbage()["axis"])
+
+
+class TestIncrementalVacuum(unittest.TestCase):
+    def setUp(self):
+        self.path = "test-vacuum.db"
+
+    def tearDown(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def fill(self, database):
+        for i in range(200):
+            path = "file_{:03d}.nc".format(i)
+            database.insert_file_name(path, dt.datetime(2019, 1, 1))
+            database.insert_pressures(
+                path, "x", [1000. - j - i / 1000. for j in range(50)])
+        database.connection.commit()
+        for i in range(200):
+            database.delete_file("file_{:03d}.nc".format(i))
+        database.collect_garbage()
+
+    def test_connect_enables_incremental_auto_vacuum(self):
+        with db.Database.connect(self.path) as database:
+            database.cursor.execute("PRAGMA auto_vacuum")
+            self.assertEqual((2,), database.cursor.fetchone())
+
+    def test_incremental_vacuum_releases_free_pages(self):
+        with db.Database.connect(self.path) as database:
+            self.fill(database)
+            released = database.incremental_vacuum(pages=10)
+            database.cursor.execute("PRAGMA freelist_count")
+            self.assertEqual((0,), database.cursor.fetchone())
+        self.assertGreater(released, 10)
+
+    def test_incremental_vacuum_converts_catalogue(self):
+        with db.Database(sqlite3.connect(self.path)) as database:
+            self.fill(database)
+            self.assertGreater(database.incremental_vacuum(convert=True), 0)
+            database.cursor.execute("PRAGMA auto_vacuum")
+            self.assertEqual((2,), database.cursor.fetchone())
+
+    def test_incremental_vacuum_given_full_catalogue_does_not_vacuum(self):
+        with db.Database(sqlite3.connect(self.path)) as database:
+            self.fill(database)
+            database.cursor.execute("PRAGMA freelist_count")
+            free = database.cursor.fetchone()
+            self.assertEqual(0, database.incremental_vacuum())
+            database.cursor.execute("PRAGMA freelist_count")
+            self.assertEqual(free, database.cursor.fetchone())
+            database.cursor.execute("PRAGMA auto_vacuum")
+            self.assertEqual((0,), database.cursor.fetchone())
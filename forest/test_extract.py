@@ -0,0 +1,214 @@
+import unittest
+import os
+import pickle
+import datetime as dt
+import netCDF4
+import extract
+
+
+class TestLoadIris(unittest.TestCase):
+    def setUp(self):
+        self.path = "test-extract.nc"
+        self.units = "hours since 1970-01-01 00:00:00"
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_load_iris_returns_picklable_metadata(self):
+        times = [dt.datetime(2019, 1, 1, 12), dt.datetime(2019, 1, 1, 13)]
+        with netCDF4.Dataset(self.path, "w") as dataset:
+            dataset.createDimension("time", len(times))
+            obj = dataset.createVariable("time", "d", ("time",))
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(times, self.units)
+            obj = dataset.createVariable("forecast_reference_time", "d", ())
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(dt.datetime(2019, 1, 1), self.units)
+            obj = dataset.createVariable("air_temperature", "f", ("time",))
+            obj.um_stash_source = "m01s16i203"
+            obj.coordinates = "forecast_reference_time"
+        metadata = extract.load_iris(self.path)
+        result = pickle.loads(pickle.dumps(metadata))
+        expect = extract.Metadata(
+            path=self.path,
+            reference_time=dt.datetime(2019, 1, 1),
+            variables=[
+                extract.Variable(
+                    name="air_temperature",
+                    time_axis=0,
+                    pressure_axis=None,
+                    times=times,
+                    pressures=None)])
+        self.assertEqual(expect, result)
+
+
+class TestToDatetime(unittest.TestCase):
+    def test_to_datetime_given_cftime(self):
+        time = netCDF4.num2date(0, "hours since 2019-01-01 00:00:00")
+        result = extract.to_datetime(time)
+        expect = dt.datetime(2019, 1, 1)
+        self.assertEqual(expect, result)
+        self.assertIs(type(result), dt.datetime)
+
+
+class TestLoadNetCDF(unittest.TestCase):
+    """load_netcdf should agree with load_iris"""
+    def setUp(self):
+        self.path = "test-extract-netcdf.nc"
+        self.units = "hours since 1970-01-01 00:00:00"
+        self.times = [dt.datetime(2019, 1, 1, 12), dt.datetime(2019, 1, 1, 15)]
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_dimension_coordinates(self):
+        with netCDF4.Dataset(self.path, "w") as dataset:
+            self.reference_time(dataset)
+            dataset.createDimension("time", len(self.times))
+            dataset.createDimension("pressure", 3)
+            obj = dataset.createVariable("time", "d", ("time",))
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(self.times, self.units)
+            obj = dataset.createVariable("pressure", "d", ("pressure",))
+            obj[:] = [1000., 950., 850.]
+            obj = dataset.createVariable(
+                "air_temperature", "f", ("time", "pressure"))
+            obj.um_stash_source = "m01s16i203"
+            obj.coordinates = "forecast_reference_time"
+            obj = dataset.createVariable("mslp", "f", ("time",))
+            obj.um_stash_source = "m01s16i222"
+            obj.coordinates = "forecast_reference_time"
+        self.assert_same_metadata(self.path)
+
+    def test_auxiliary_coordinates_on_shared_dimension(self):
+        with netCDF4.Dataset(self.path, "w") as dataset:
+            dataset.createDimension("dim0", len(self.times))
+            obj = dataset.createVariable("time", "d", ("dim0",))
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(self.times, self.units)
+            obj = dataset.createVariable("pressure", "d", ("dim0",))
+            obj[:] = [950., 950.]
+            obj = dataset.createVariable("air_temperature", "f", ("dim0",))
+            obj.um_stash_source = "m01s16i203"
+            obj.coordinates = "pressure time"
+        self.assert_same_metadata(self.path)
+
+    def test_scalar_time_coordinate(self):
+        with netCDF4.Dataset(self.path, "w") as dataset:
+            dataset.createDimension("x", 2)
+            dataset.createDimension("y", 2)
+            obj = dataset.createVariable("time", "d", ())
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(self.times[0], self.units)
+            obj = dataset.createVariable("x", "f", ("x",))
+            obj[:] = [0, 10]
+            obj = dataset.createVariable("y", "f", ("y",))
+            obj[:] = [0, 10]
+            obj = dataset.createVariable("air_temperature", "f", ("y", "x"))
+            obj.um_stash_source = "m01s16i203"
+            obj.coordinates = "time"
+        self.assert_same_metadata(self.path)
+
+    def test_standard_name_identifies_coordinate(self):
+        with netCDF4.Dataset(self.path, "w") as dataset:
+            dataset.createDimension("t", len(self.times))
+            obj = dataset.createVariable("t", "d", ("t",))
+            obj.standard_name = "time"
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(self.times, self.units)
+            obj = dataset.createVariable("air_temperature", "f", ("t",))
+            obj.um_stash_source = "m01s16i203"
+        self.assert_same_metadata(self.path)
+
+    def reference_time(self, dataset):
+        obj = dataset.createVariable("forecast_reference_time", "d", ())
+        obj.units = self.units
+        obj[:] = netCDF4.date2num(dt.datetime(2019, 1, 1), self.units)
+
+    def assert_same_metadata(self, path):
+        expect = extract.load_iris(path)
+        result = extract.load_netcdf(path)
+        self.assertEqual(expect.reference_time, result.reference_time)
+        self.assertEqual(
+            sorted(expect.variables),
+            sorted(result.variables))
+
+
+def write_run(path, reference_time, units=None, pressures=(1000., 850.)):
+    """Forecast file with times 3 and 6 hours after reference_time"""
+    if units is None:
+        units = "hours since {:%Y-%m-%d %H:%M:%S}".format(reference_time)
+    times = [reference_time + dt.timedelta(hours=h) for h in (3, 6)]
+    with netCDF4.Dataset(path, "w") as dataset:
+        dataset.createDimension("time", len(times))
+        dataset.createDimension("pressure", len(pressures))
+        obj = dataset.createVariable("forecast_reference_time", "d", ())
+        obj.units = units
+        obj[:] = netCDF4.date2num(reference_time, units)
+        obj = dataset.createVariable("time", "d", ("time",))
+        obj.units = units
+        obj[:] = netCDF4.date2num(times, units)
+        obj = dataset.createVariable("pressure", "d", ("pressure",))
+        obj[:] = pressures
+        obj = dataset.createVariable(
+            "air_temperature", "f", ("time", "pressure"))
+        obj.um_stash_source = "m01s16i203"
+        obj.coordinates = "forecast_reference_time"
+
+
+class TestReadLayout(unittest.TestCase):
+    def setUp(self):
+        self.paths = ["test-layout-0.nc", "test-layout-1.nc"]
+
+    def tearDown(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def fingerprints(self):
+        result = []
+        for path in self.paths:
+            with netCDF4.Dataset(path) as dataset:
+                result.append(extract.read_layout(dataset)[1])
+        return result
+
+    def test_runs_share_fingerprint(self):
+        write_run(self.paths[0], dt.datetime(2019, 1, 1))
+        write_run(self.paths[1], dt.datetime(2019, 1, 1, 12))
+        first, second = self.fingerprints()
+        self.assertEqual(first, second)
+
+    def test_runs_share_fingerprint_given_fixed_time_units(self):
+        units = "hours since 1970-01-01 00:00:00"
+        write_run(self.paths[0], dt.datetime(2019, 1, 1), units=units)
+        write_run(self.paths[1], dt.datetime(2019, 1, 2), units=units)
+        first, second = self.fingerprints()
+        self.assertEqual(first, second)
+
+    def test_different_pressures_change_fingerprint(self):
+        write_run(self.paths[0], dt.datetime(2019, 1, 1))
+        write_run(
+            self.paths[1], dt.datetime(2019, 1, 1), pressures=(1000., 500.))
+        first, second = self.fingerprints()
+        self.assertNotEqual(first, second)
+
+    def test_load_netcdf_returns_fingerprint(self):
+        write_run(self.paths[0], dt.datetime(2019, 1, 1))
+        with netCDF4.Dataset(self.paths[0]) as dataset:
+            _, expect = extract.read_layout(dataset)
+        result = extract.load_netcdf(self.paths[0])
+        self.assertEqual(expect, result.fingerprint)
+
+    def test_read_dataset_reuses_coordinates_read_by_layout(self):
+        write_run(self.paths[0], dt.datetime(2019, 1, 1))
+        cache = {}
+        with netCDF4.Dataset(self.paths[0]) as dataset:
+            extract.read_layout(dataset, cache=cache)
+            self.assertEqual({"time", "pressure"}, set(cache))
+            cache["pressure"] = cache["pressure"] + 1.
+            result = extract.read_dataset(
+                self.paths[0], dataset, cache=cache)
+        variable, = result.variables
+        self.assertEqual([1001., 851.], variable.pressures)
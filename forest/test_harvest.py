@@ -0,0 +1,349 @@
+import unittest
+import asyncio
+import collections
+import datetime as dt
+import functools
+import http.server
+import io
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest.mock
+import netCDF4
+import numpy as np
+import database as db
+import extract
+import harvest
+
+
+def write_file(path, format="NETCDF3_CLASSIC", unlimited=False):
+    """UM-like file with a time/pressure field and a large data array"""
+    units = "hours since 1970-01-01 00:00:00"
+    times = [dt.datetime(2019, 1, 1, h) for h in (3, 6)]
+    with netCDF4.Dataset(path, "w", format=format) as dataset:
+        dataset.createDimension("time", None if unlimited else len(times))
+        dataset.createDimension("pressure", 3)
+        dataset.createDimension("longitude", 100)
+        obj = dataset.createVariable("time", "d", ("time",))
+        obj.units = units
+        obj[:] = netCDF4.date2num(times, units)
+        obj = dataset.createVariable("pressure", "f", ("pressure",))
+        obj.long_name = "pressure"
+        obj[:] = [1000., 850., 500.]
+        obj = dataset.createVariable("forecast_reference_time", "d", ())
+        obj.units = units
+        obj[:] = netCDF4.date2num(dt.datetime(2019, 1, 1), units)
+        obj = dataset.createVariable(
+            "air_temperature", "f", ("time", "pressure", "longitude"))
+        obj.um_stash_source = "m01s16i203"
+        obj.coordinates = "forecast_reference_time"
+        obj[:] = np.zeros((len(times), 3, 100))
+        obj = dataset.createVariable("orography", "f", ("longitude",))
+        obj[:] = np.arange(100)
+
+
+class CountingFetcher(harvest.Fetcher):
+    """Local fetcher recording bytes read and files being read"""
+    def __init__(self, delay=0.):
+        self.fetcher = harvest.LocalFetcher()
+        self.delay = delay
+        self.nbytes = 0
+        self.reading = collections.Counter()
+        self.max_files = 0
+
+    async def read(self, url, start=0, stop=None):
+        self.reading[url] += 1
+        self.max_files = max(self.max_files, len(+self.reading))
+        try:
+            await asyncio.sleep(self.delay)
+            content = await self.fetcher.read(url, start, stop)
+        finally:
+            self.reading[url] -= 1
+        self.nbytes += len(content)
+        return content
+
+
+class TestLoad(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "file.nc")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, fetcher=None, **kwargs):
+        if fetcher is None:
+            fetcher = harvest.LocalFetcher()
+        return asyncio.run(harvest.load(self.path, fetcher, **kwargs))
+
+    def test_load_given_classic_file_matches_load_netcdf(self):
+        write_file(self.path)
+        self.assertEqual(extract.load_netcdf(self.path), self.load())
+
+    def test_load_given_64bit_offset_file_matches_load_netcdf(self):
+        write_file(self.path, format="NETCDF3_64BIT_OFFSET")
+        self.assertEqual(extract.load_netcdf(self.path), self.load())
+
+    def test_load_given_cdf5_file_matches_load_netcdf(self):
+        write_file(self.path, format="NETCDF3_64BIT_DATA")
+        self.assertEqual(extract.load_netcdf(self.path), self.load())
+
+    def test_load_given_record_dimension_matches_load_netcdf(self):
+        write_file(self.path, unlimited=True)
+        self.assertEqual(extract.load_netcdf(self.path), self.load())
+
+    def test_load_given_netcdf4_file_matches_load_netcdf(self):
+        write_file(self.path, format="NETCDF4")
+        self.assertEqual(extract.load_netcdf(self.path), self.load())
+
+    def test_load_given_small_header_size_reads_more(self):
+        write_file(self.path)
+        result = self.load(header_size=16)
+        self.assertEqual(extract.load_netcdf(self.path), result)
+
+    def test_load_reads_header_and_coordinates_only(self):
+        write_file(self.path)
+        fetcher = CountingFetcher()
+        self.load(fetcher, header_size=1024)
+        self.assertLess(fetcher.nbytes, 2048)
+        self.assertGreater(os.path.getsize(self.path), 2400)
+
+
+class TestParseHeader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "file.nc")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_header_given_partial_header_raises_truncated(self):
+        write_file(self.path)
+        with open(self.path, "rb") as stream:
+            data = stream.read(32)
+        with self.assertRaises(harvest.Truncated):
+            harvest.parse_header(data)
+
+    def test_parse_header_offsets_match_netcdf4(self):
+        write_file(self.path)
+        with open(self.path, "rb") as stream:
+            content = stream.read()
+        header = harvest.parse_header(content)
+        variable = header.variables["pressure"]
+        values = np.frombuffer(
+            content[variable.begin:variable.begin + 12],
+            dtype=variable.dtype)
+        np.testing.assert_array_equal([1000., 850., 500.], values)
+
+    def test_parse_header_given_hdf5_raises_value_error(self):
+        write_file(self.path, format="NETCDF4")
+        with open(self.path, "rb") as stream:
+            data = stream.read(64)
+        with self.assertRaises(ValueError):
+            harvest.parse_header(data)
+
+
+class TestHarvest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [
+            os.path.join(self.directory, "file_{}.nc".format(i))
+            for i in range(6)]
+        for path in self.paths:
+            write_file(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_harvest_limits_concurrency(self):
+        fetcher = CountingFetcher(delay=0.01)
+
+        async def run():
+            result = []
+            async for metadata in harvest.harvest(
+                    self.paths, fetcher, concurrency=2):
+                result.append(metadata.path)
+            return result
+
+        result = asyncio.run(run())
+        self.assertEqual(sorted(self.paths), sorted(result))
+        self.assertEqual(2, fetcher.max_files)
+
+    def test_harvest_given_missing_file_skips_it(self):
+        async def run():
+            result = []
+            async for metadata in harvest.harvest(
+                    ["missing.nc"] + self.paths, concurrency=2):
+                result.append(metadata.path)
+            return result
+
+        stderr = io.StringIO()
+        with unittest.mock.patch("sys.stderr", stderr):
+            result = asyncio.run(run())
+        self.assertEqual(sorted(self.paths), sorted(result))
+        self.assertIn("failed: missing.nc", stderr.getvalue())
+
+    def test_harvest_closes_default_fetcher(self):
+        fetcher = harvest.SchemeFetcher(concurrency=3)
+        self.assertEqual(3, fetcher.fetchers["http"].executor._max_workers)
+
+        async def run():
+            async for _ in harvest.harvest(self.paths, concurrency=3):
+                pass
+
+        with unittest.mock.patch.object(
+                harvest, "SchemeFetcher", return_value=fetcher):
+            asyncio.run(run())
+        with self.assertRaises(RuntimeError):
+            fetcher.fetchers["http"].executor.submit(print)
+
+    def test_ingest_given_incremental_skips_unchanged_files(self):
+        database = db.Database(sqlite3.connect(":memory:"))
+        with unittest.mock.patch("sys.stdout", io.StringIO()):
+            harvest.ingest(database, self.paths, incremental=True)
+        fetcher = CountingFetcher()
+        fetcher.signature = harvest.LocalFetcher().signature
+        stdout = io.StringIO()
+        with unittest.mock.patch("sys.stdout", stdout):
+            harvest.ingest(
+                database, self.paths, fetcher=fetcher, incremental=True)
+        self.assertEqual(0, fetcher.nbytes)
+        self.assertEqual(
+            len(self.paths), stdout.getvalue().count("unchanged:"))
+        self.assertEqual(
+            extract.signature(self.paths[0]),
+            database.signature(self.paths[0]))
+        database.close()
+
+    def test_coalesce_merges_nearby_ranges(self):
+        result = harvest._coalesce([0, 100, 5000], 10, gap=1000)
+        expect = [(0, 110, [0, 100]), (5000, 5010, [5000])]
+        self.assertEqual(expect, result)
+
+    def test_load_reads_record_coordinate_in_one_range(self):
+        path = os.path.join(self.directory, "records.nc")
+        write_file(path, unlimited=True)
+        with netCDF4.Dataset(path, "a") as dataset:
+            times = dataset.variables["time"]
+            times[:] = np.arange(100.)
+            dataset.variables["air_temperature"][:] = np.zeros((100, 3, 100))
+        fetcher = CountingFetcher()
+        reads = []
+        read = fetcher.read
+
+        async def counted(url, start=0, stop=None):
+            reads.append((start, stop))
+            return await read(url, start, stop)
+
+        fetcher.read = counted
+        result = asyncio.run(harvest.load(path, fetcher))
+        self.assertEqual(extract.load_netcdf(path), result)
+        self.assertLess(len(reads), 10)
+
+    def test_fetcher_requires_read(self):
+        with self.assertRaises(TypeError):
+            harvest.Fetcher()
+
+    def test_ingest_inserts_metadata_into_database(self):
+        database = db.Database(sqlite3.connect(":memory:"))
+        harvest.ingest(database, self.paths, concurrency=3, batch_size=4)
+        self.assertEqual(sorted(self.paths), database.files())
+        self.assertEqual(2, database.generation())
+        self.assertEqual(
+            [dt.datetime(2019, 1, 1)], database.initial_times())
+        database.close()
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file server that honours single Range headers"""
+    def send_head(self):
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match is None:
+            return super().send_head()
+        path = self.translate_path(self.path)
+        try:
+            stream = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return None
+        size = os.fstat(stream.fileno()).st_size
+        start = int(match.group(1))
+        stop = int(match.group(2)) + 1 if match.group(2) else size
+        stop = min(stop, size)
+        if start >= size:
+            stream.close()
+            self.send_error(416)
+            return None
+        stream.seek(start)
+        self.range_length = stop - start
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(
+            start, stop - 1, size))
+        self.send_header("Content-Length", str(stop - start))
+        self.end_headers()
+        return stream
+
+    def copyfile(self, source, destination):
+        length = getattr(self, "range_length", None)
+        if length is None:
+            return super().copyfile(source, destination)
+        destination.write(source.read(length))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPFetcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [
+            os.path.join(self.directory, "file_{}.nc".format(i))
+            for i in range(3)]
+        for i, path in enumerate(self.paths):
+            write_file(path, format="NETCDF4" if i == 0 else "NETCDF3_CLASSIC")
+        handler = functools.partial(RangeHandler, directory=self.directory)
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def test_read_returns_byte_range(self):
+        url = self.url + "file_1.nc"
+        with open(self.paths[1], "rb") as stream:
+            content = stream.read()
+        result = asyncio.run(harvest.HTTPFetcher().read(url, 4, 20))
+        self.assertEqual(content[4:20], result)
+
+    def test_read_beyond_end_of_file_returns_empty_bytes(self):
+        url = self.url + "file_1.nc"
+        size = os.path.getsize(self.paths[1])
+        result = asyncio.run(harvest.HTTPFetcher().read(url, size + 10))
+        self.assertEqual(b"", result)
+
+    def test_signature_uses_content_length_and_last_modified(self):
+        url = self.url + "file_1.nc"
+        result = asyncio.run(harvest.HTTPFetcher().signature(url))
+        self.assertEqual(os.path.getsize(self.paths[1]), result.size)
+        self.assertAlmostEqual(
+            os.path.getmtime(self.paths[1]), result.mtime, delta=1.)
+
+    def test_ingest_given_urls_matches_local_ingest(self):
+        urls = [self.url + os.path.basename(path) for path in self.paths]
+        database = db.Database(sqlite3.connect(":memory:"))
+        harvest.ingest(database, urls, concurrency=2)
+        for url, path in zip(urls, self.paths):
+            expect = extract.load_netcdf(path)._replace(path=url)
+            result = asyncio.run(harvest.load(url, harvest.SchemeFetcher()))
+            self.assertEqual(expect, result)
+        self.assertEqual(sorted(urls), database.files())
+        database.close()
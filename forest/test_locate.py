@@ -0,0 +1,167 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import datetime as dt
+import database as db
+import locate
+import stats
+
+
+class TestArrayLocator(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+        self.initial_time = dt.datetime(2019, 1, 1)
+        self.times = [dt.datetime(2019, 1, 1, h) for h in range(3)]
+        self.pressures = [1000., 850., 500.]
+        for path in ["ga6_000.nc", "ga6_001.nc", "ea_000.nc"]:
+            self.database.insert_file_name(path, self.initial_time)
+            self.database.insert_variable(
+                path, "temperature", time_axis=0, pressure_axis=1)
+            self.database.insert_times(path, "temperature", self.times)
+            self.database.insert_pressures(
+                path, "temperature", self.pressures)
+        # dim0 format, time and pressure share an axis
+        path = "ga6_dim0.nc"
+        self.database.insert_file_name(path, self.initial_time)
+        self.database.insert_variable(
+            path, "relative_humidity", time_axis=0, pressure_axis=0)
+        self.database.insert_times(
+            path, "relative_humidity", [self.times[0]] * 2 + [self.times[1]])
+        self.database.insert_pressures(
+            path, "relative_humidity", [1000., 850., 1000.])
+        self.database.insert_model("GA6", "ga6_*.nc")
+        self.locator = locate.ArrayLocator(self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_path_points_matches_sql_locator(self):
+        sql_locator = db.Locator(self.connection)
+        for args in [
+                ("ga6_*.nc", "temperature", self.initial_time,
+                 self.times[1], 900.),
+                ("ea_*.nc", "temperature", self.initial_time,
+                 self.times[2], 400.),
+                ("*.nc", "temperature", "2019-01-01 00:00:00",
+                 "2019-01-01 02:00:00", 1100.),
+                ("*.nc", "relative_humidity", self.initial_time,
+                 self.times[1], 850.),
+                ("*.nc", "relative_humidity", self.initial_time,
+                 self.times[0], 900.),
+                ("*.nc", "temperature", self.initial_time,
+                 dt.datetime(2019, 1, 2), 850.),
+                ("*.nc", "humidity", self.initial_time,
+                 self.times[0], 850.)]:
+            expect = sql_locator.path_points(*args)
+            result = self.locator.path_points(*args)
+            self.assertEqual(expect, result, msg=str(args))
+
+    def test_path_points_given_glob_class_matches_sql_locator(self):
+        sql_locator = db.Locator(self.connection)
+        for pattern in ["[^g]*.nc", "[!e]*.nc", "ga6_00[1-9].nc"]:
+            args = (pattern, "temperature", self.initial_time,
+                    self.times[1], 850.)
+            expect = sql_locator.path_points(*args)
+            result = self.locator.path_points(*args)
+            self.assertEqual(expect, result, msg=pattern)
+        result = self.locator.path_points(
+            "[^g]*.nc", "temperature", self.initial_time,
+            self.times[1], 850.)
+        self.assertEqual(("ea_000.nc", (1, 1)), result)
+
+    def test_path_points_given_registered_model(self):
+        result = self.locator.path_points(
+            "ga6_*.nc",
+            "relative_humidity",
+            self.initial_time,
+            self.times[1],
+            500.)
+        expect = ("ga6_dim0.nc", (2,))
+        self.assertEqual(expect, result)
+
+    def test_path_points_given_pattern_excluding_file(self):
+        result = self.locator.path_points(
+            "ea_*.nc",
+            "relative_humidity",
+            self.initial_time,
+            self.times[1],
+            500.)
+        self.assertIsNone(result)
+
+    def test_refresh_given_same_generation_keeps_arrays(self):
+        self.locator.refresh()
+        self.assertFalse(self.locator.refresh())
+
+    def test_refresh_given_new_generation_loads_new_files(self):
+        path = "ga6_002.nc"
+        initial_time = dt.datetime(2019, 1, 2)
+        self.locator.refresh()
+        self.database.insert_file_name(path, initial_time)
+        self.database.insert_variable(
+            path, "temperature", time_axis=0, pressure_axis=1)
+        self.database.insert_times(path, "temperature", [initial_time])
+        self.database.insert_pressures(path, "temperature", [850.])
+        self.database.bump_generation()
+        self.assertTrue(self.locator.refresh())
+        result = self.locator.path_points(
+            "ga6_*.nc", "temperature", initial_time, initial_time, 850.)
+        expect = (path, (0, 0))
+        self.assertEqual(expect, result)
+
+    def test_path_points_given_check_interval_refreshes(self):
+        self.locator.check_interval = 0.
+        self.locator.refresh()
+        self.database.bump_generation()
+        self.locator.path_points(
+            "*.nc", "temperature", self.initial_time, self.times[0], 850.)
+        self.assertEqual(self.database.generation(), self.locator.generation)
+
+    def test_path_points_given_packed_axes(self):
+        path = "ga6_packed.nc"
+        initial_time = dt.datetime(2019, 1, 3)
+        self.database.packed = True
+        self.database.insert_file_name(path, initial_time)
+        self.database.insert_variable(
+            path, "temperature", time_axis=0, pressure_axis=1)
+        self.database.insert_times(path, "temperature", self.times)
+        self.database.insert_pressures(path, "temperature", self.pressures)
+        sql_locator = db.Locator(self.connection)
+        args = ("ga6_*.nc", "temperature", initial_time, self.times[2], 800.)
+        expect = (path, (2, 1))
+        self.assertEqual(expect, sql_locator.path_points(*args))
+        self.assertEqual(expect, self.locator.path_points(*args))
+
+    def test_instrumented_path_points_recorded(self):
+        query_stats = stats.QueryStats()
+        self.locator.instrument(query_stats)
+        for _ in range(2):
+            self.locator.path_points(
+                "*.nc", "temperature", self.initial_time,
+                self.times[0], 850.)
+        methods = query_stats.summary()["methods"]
+        self.assertEqual(2, methods["path_points"]["count"])
+        self.assertEqual(2, methods["path_points"]["rows"])
+        self.assertIn("refresh", methods)
+        self.assertNotIn("_load", methods)
+
+
+class TestShared(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "file.db")
+        with db.Database.connect(self.path) as database:
+            database.insert_file_name("a.nc", dt.datetime(2019, 1, 1))
+
+    def tearDown(self):
+        for locator in locate._SHARED.values():
+            locator.connection.close()
+        locate._SHARED.clear()
+        shutil.rmtree(self.directory)
+
+    def test_shared_returns_one_locator_per_catalogue(self):
+        locator = locate.shared(self.path, check_interval=30.)
+        self.assertIs(locator, locate.shared(self.path))
+        self.assertEqual(30., locator.check_interval)
@@ -1,9 +1,18 @@
 import unittest
+import unittest.mock
+import concurrent.futures
+import io
+import itertools
 import datetime as dt
 import os
+import shutil
+import tempfile
 import sqlite3
 import netCDF4
 import main
+import database as db
+import extract
+import shard
 
 
 class TestMain(unittest.TestCase):
@@ -17,7 +26,9 @@ class TestMain(unittest.TestCase):
         ]
 
     def tearDown(self):
-        for path in self._paths:
+        for path in self._paths + [
+                self.database_file + "-wal",
+                self.database_file + "-shm"]:
             if os.path.exists(path):
                 os.remove(path)
 
@@ -81,7 +92,9 @@ class TestMain(unittest.TestCase):
         cursor = connection.cursor()
         cursor.execute("SELECT DISTINCT value FROM time")
         result = cursor.fetchall()
-        expect = [("2019-01-01 12:00:00",), ("2019-01-01 13:00:00",)]
+        expect = [
+            (db.to_epoch(dt.datetime(2019, 1, 1, 12)),),
+            (db.to_epoch(dt.datetime(2019, 1, 1, 13)),)]
         self.assertEqual(expect, result)
 
     def test_main_saves_pressure_coordinate(self):
@@ -102,7 +115,7 @@ class TestMain(unittest.TestCase):
 
         connection = sqlite3.connect(self.database_file)
         cursor = connection.cursor()
-        cursor.execute("SELECT DISTINCT value FROM pressure")
+        cursor.execute("SELECT DISTINCT value FROM pressure ORDER BY id")
         result = cursor.fetchall()
         expect = [(p,) for p in pressures]
         self.assertEqual(expect, result)
@@ -124,7 +137,7 @@ class TestMain(unittest.TestCase):
         cursor = connection.cursor()
         cursor.execute("SELECT reference FROM file")
         result = cursor.fetchall()
-        expect = [(str(reference_time),)]
+        expect = [(db.to_epoch(reference_time),)]
         self.assertEqual(expect, result)
 
     def test_main_saves_axis_information(self):
@@ -152,3 +165,403 @@ class TestMain(unittest.TestCase):
         result = cursor.fetchall()
         expect = [(0, 0)]
         self.assertEqual(expect, result)
+
+    def test_main_given_workers_saves_variables_from_every_file(self):
+        paths = ["test_file_0.nc", "test_file_1.nc", "test_file_2.nc"]
+        self._paths += paths
+        for i, path in enumerate(paths):
+            with netCDF4.Dataset(path, "w") as dataset:
+                dataset.createDimension("x", 1)
+                dataset.createVariable("x", "f", ("x",))
+                var = dataset.createVariable("var_{}".format(i), "f", ("x",))
+                var.um_stash_source = "m01s16i203"
+
+        main.main([
+            "--database", self.database_file,
+            "--workers", "2"
+        ] + paths)
+
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("""
+                SELECT file.name, variable.name FROM variable
+                  JOIN file ON file.id = variable.file_id
+                 ORDER BY file.name
+        """)
+        result = cursor.fetchall()
+        expect = [
+            ("test_file_0.nc", "var_0"),
+            ("test_file_1.nc", "var_1"),
+            ("test_file_2.nc", "var_2")]
+        self.assertEqual(expect, result)
+
+    def test_main_incremental_skips_unchanged_files(self):
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        argv = ["--database", self.database_file, "--incremental",
+                self.netcdf_file]
+        main.main(argv)
+        with unittest.mock.patch("extract.load") as load:
+            main.main(argv)
+        load.assert_not_called()
+
+    def test_main_incremental_reindexes_changed_files(self):
+        self.define_variable("air_temperature")
+        argv = ["--database", self.database_file, "--incremental",
+                self.netcdf_file]
+        main.main(argv)
+        self.define_variable("relative_humidity")
+        os.utime(self.netcdf_file, (0, 0))
+        main.main(argv)
+
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM variable")
+        result = cursor.fetchall()
+        expect = [("relative_humidity",)]
+        self.assertEqual(expect, result)
+
+    def test_main_records_file_signature(self):
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        main.main([
+            "--database", self.database_file,
+            "--checksum",
+            self.netcdf_file
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT size, mtime, checksum FROM file")
+        result = cursor.fetchall()
+        expect = [tuple(extract.signature(self.netcdf_file, checksum=True))]
+        self.assertEqual(expect, result)
+
+    def define_variable(self, name):
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            dataset.createDimension("x", 1)
+            dataset.createVariable("x", "f", ("x",))
+            var = dataset.createVariable(name, "f", ("x",))
+            var.um_stash_source = "m01s16i203"
+
+    def test_main_watch_ingests_files_in_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "file.nc")
+        with netCDF4.Dataset(path, "w") as dataset:
+            pass
+        main.main([
+            "watch", directory,
+            "--database", self.database_file,
+            "--interval", "0",
+            "--polls", "2"
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM file")
+        result = cursor.fetchall()
+        expect = [(path,)]
+        self.assertEqual(expect, result)
+
+    def test_main_watch_skips_unreadable_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "file.nc")
+        with netCDF4.Dataset(path, "w") as dataset:
+            pass
+        with open(os.path.join(directory, "bad.nc"), "wb") as stream:
+            stream.write(b"CDF\x01 truncated")
+        stderr = io.StringIO()
+        with unittest.mock.patch("sys.stderr", stderr):
+            main.main([
+                "watch", directory,
+                "--database", self.database_file,
+                "--interval", "0",
+                "--polls", "2"
+            ])
+        self.assertIn("failed: {}".format(
+            os.path.join(directory, "bad.nc")), stderr.getvalue())
+        with db.Database.connect(self.database_file) as database:
+            self.assertEqual([path], database.files())
+
+    def test_main_watch_retries_failed_file_without_change(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "file.nc")
+        with netCDF4.Dataset(path, "w") as dataset:
+            pass
+        ingest = main.ingest
+        calls = []
+
+        def flaky(database, paths, **kwargs):
+            calls.append(paths)
+            if len(calls) <= 2:
+                raise OSError("temporarily unavailable")
+            return ingest(database, paths, **kwargs)
+
+        with unittest.mock.patch("main.ingest", flaky), \
+                unittest.mock.patch("sys.stderr", io.StringIO()):
+            main.main([
+                "watch", directory,
+                "--database", self.database_file,
+                "--interval", "0",
+                "--retry-delay", "0",
+                "--polls", "3"
+            ])
+        self.assertEqual([[path], [path], [path]], calls)
+        with db.Database.connect(self.database_file) as database:
+            self.assertEqual([path], database.files())
+
+    def test_main_bumps_catalogue_generation(self):
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        main.main(["--database", self.database_file, self.netcdf_file])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT value FROM generation")
+        result = cursor.fetchall()
+        expect = [(1,)]
+        self.assertEqual(expect, result)
+
+    def test_main_given_config_file_registers_models(self):
+        config_file = "test_main.yaml"
+        self._paths.append(config_file)
+        with open(config_file, "w") as stream:
+            stream.write("models:\n  - name: Test\n    pattern: 'test_*.nc'\n")
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        main.main([
+            "--database", self.database_file,
+            "--config-file", config_file,
+            self.netcdf_file
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT model.name, file.name FROM file_model
+              JOIN model ON model.id = file_model.model_id
+              JOIN file ON file.id = file_model.file_id
+        """)
+        result = cursor.fetchall()
+        expect = [("Test", self.netcdf_file)]
+        self.assertEqual(expect, result)
+
+    def test_main_prune_deletes_old_runs(self):
+        recent = dt.datetime.now(dt.timezone.utc).replace(
+            tzinfo=None, microsecond=0) - dt.timedelta(days=1)
+        with db.Database.connect(self.database_file) as database:
+            for path, reference in [
+                    ("old.nc", dt.datetime(2019, 1, 1)),
+                    ("new.nc", recent)]:
+                database.insert_file_name(path, reference)
+                database.insert_times(path, "x", [reference])
+        main.main([
+            "prune",
+            "--database", self.database_file,
+            "--older-than", "7"
+        ])
+        with db.Database.connect(self.database_file) as database:
+            self.assertEqual(["new.nc"], database.files())
+            self.assertEqual([recent], database.fetch_dates())
+            self.assertEqual(1, database.generation())
+
+    def test_main_prune_given_shard_directory_exits(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with unittest.mock.patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                main.parse_prune_args([
+                    "--database", directory,
+                    "--older-than", "7"])
+
+    def test_main_given_manifest_ingests_listed_files(self):
+        manifest = "test_main.txt"
+        self._paths.append(manifest)
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        with open(manifest, "w") as stream:
+            stream.write("# files to ingest\n\n{}\n".format(self.netcdf_file))
+        main.main([
+            "--database", self.database_file,
+            "--manifest", manifest
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM file")
+        result = cursor.fetchall()
+        expect = [(self.netcdf_file,)]
+        self.assertEqual(expect, result)
+
+    def test_main_given_manifest_dash_reads_stdin(self):
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        stdin = io.StringIO(self.netcdf_file + "\n")
+        with unittest.mock.patch("sys.stdin", stdin):
+            main.main([
+                "--database", self.database_file,
+                "--manifest", "-"
+            ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM file")
+        result = cursor.fetchall()
+        expect = [(self.netcdf_file,)]
+        self.assertEqual(expect, result)
+
+    def test_main_without_paths_or_manifest_exits(self):
+        with unittest.mock.patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                main.parse_args(["--database", self.database_file])
+
+    def test_main_commits_completed_batches(self):
+        paths = ["test_file_0.nc", "test_file_1.nc"]
+        self._paths += paths
+        for path in paths:
+            with netCDF4.Dataset(path, "w") as dataset:
+                pass
+
+        def fail_on_second_file(path):
+            if path == paths[1]:
+                raise IOError("unreadable")
+            return extract.load_netcdf(path)
+
+        extractors = {"netcdf": fail_on_second_file}
+        with unittest.mock.patch.dict("extract.EXTRACTORS", extractors):
+            with self.assertRaises(IOError):
+                main.main([
+                    "--database", self.database_file,
+                    "--batch-size", "1"
+                ] + paths)
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM file")
+        result = cursor.fetchall()
+        expect = [(paths[0],)]
+        self.assertEqual(expect, result)
+
+
+    def test_main_harvest_ingests_files(self):
+        with netCDF4.Dataset(
+                self.netcdf_file, "w", format="NETCDF3_CLASSIC") as dataset:
+            dataset.createDimension("x", 1)
+            dataset.createVariable("x", "f", ("x",))
+            var = dataset.createVariable("air_temperature", "f", ("x",))
+            var.um_stash_source = "m01s16i203"
+        main.main([
+            "harvest",
+            "--database", self.database_file,
+            "--concurrency", "2",
+            self.netcdf_file
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT file.name, variable.name FROM variable
+              JOIN file ON file.id = variable.file_id
+        """)
+        result = cursor.fetchall()
+        expect = [(self.netcdf_file, "air_temperature")]
+        self.assertEqual(expect, result)
+
+    def test_main_given_snapshot_publishes_catalogue(self):
+        snapshot_file = "test_main_snapshot.db"
+        self._paths.append(snapshot_file)
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            pass
+        main.main([
+            "--database", self.database_file,
+            "--snapshot", snapshot_file,
+            self.netcdf_file
+        ])
+        connection = sqlite3.connect(snapshot_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM file")
+        result = cursor.fetchall()
+        connection.close()
+        expect = [(self.netcdf_file,)]
+        self.assertEqual(expect, result)
+
+    def test_main_given_packed_axes_stores_axes_once(self):
+        times = [
+            dt.datetime(2019, 1, 1, 12),
+            dt.datetime(2019, 1, 1, 13)]
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            dataset.createDimension("time", len(times))
+            obj = dataset.createVariable("time", "d", ("time",))
+            obj.units = self.units
+            obj[:] = netCDF4.date2num(times, self.units)
+            for name, stash in [
+                    ("air_temperature", "m01s16i203"),
+                    ("relative_humidity", "m01s16i256")]:
+                obj = dataset.createVariable(name, "f", ("time",))
+                obj.um_stash_source = stash
+        main.main([
+            "--database", self.database_file,
+            "--packed-axes",
+            self.netcdf_file
+        ])
+        connection = sqlite3.connect(self.database_file)
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM time")
+        self.assertEqual((0,), cursor.fetchone())
+        cursor.execute("SELECT kind, size FROM axis")
+        self.assertEqual([("time", 2)], cursor.fetchall())
+        connection.close()
+        database = db.Database.connect(self.database_file)
+        self.assertEqual(times, database.valid_times())
+        database.close()
+
+    def test_main_given_shard_by_writes_monthly_shard(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        reference_time = dt.datetime(2019, 1, 1)
+        with netCDF4.Dataset(self.netcdf_file, "w") as dataset:
+            obj = dataset.createVariable("forecast_reference_time", "d", ())
+            obj[:] = netCDF4.date2num(reference_time, self.units)
+            obj.units = self.units
+        main.main([
+            "--database", directory,
+            "--shard-by", "month",
+            self.netcdf_file
+        ])
+        federation = shard.Federation(directory)
+        self.assertEqual(["2019-01"], federation.shards())
+        self.assertEqual([self.netcdf_file], federation.files())
+        federation.close()
+
+    def test_main_given_shard_by_and_snapshot_exits(self):
+        with unittest.mock.patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                main.parse_args([
+                    "--database", "shards",
+                    "--shard-by", "month",
+                    "--snapshot", "snapshot.db",
+                    self.netcdf_file])
+
+
+class TestPipeline(unittest.TestCase):
+    def test_batches(self):
+        result = list(main.batches(range(5), 2))
+        expect = [[0, 1], [2, 3], [4]]
+        self.assertEqual(expect, result)
+
+    def test_batches_given_no_size_yields_single_batch(self):
+        result = list(main.batches(range(3)))
+        expect = [[0, 1, 2]]
+        self.assertEqual(expect, result)
+
+    def test_batches_given_empty_iterable(self):
+        self.assertEqual([], list(main.batches([], 2)))
+
+    def test_read_manifest_skips_blank_lines_and_comments(self):
+        lines = ["# comment\n", "a.nc\n", "\n", "  b.nc  \n"]
+        result = list(main.read_manifest(lines))
+        expect = ["a.nc", "b.nc"]
+        self.assertEqual(expect, result)
+
+    def test_bounded_map_consumes_input_lazily(self):
+        items = itertools.count()
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = main.bounded_map(executor, lambda x: 2 * x, items, 3)
+            result = list(itertools.islice(results, 4))
+        self.assertEqual([0, 2, 4, 6], result)
+        self.assertEqual(7, next(items))
@@ -0,0 +1,147 @@
+import unittest
+import sqlite3
+import datetime as dt
+import control
+import database as db
+import schema
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_migrate_records_version(self):
+        schema.migrate(self.connection)
+        result = schema.version(self.connection)
+        self.assertEqual(schema.VERSION, result)
+
+    def test_migrate_is_idempotent(self):
+        schema.migrate(self.connection)
+        schema.migrate(self.connection)
+        cursor = self.connection.execute("SELECT version FROM schema_version")
+        self.assertEqual([(schema.VERSION,)], cursor.fetchall())
+
+    def test_migrate_upgrades_unversioned_catalogue(self):
+        self.connection.execute("""
+            CREATE TABLE file (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    reference TEXT,
+                    UNIQUE(name))
+        """)
+        self.connection.execute(
+            "INSERT INTO file (name, reference) VALUES ('a.nc', 'x')")
+        database = db.Database(self.connection)
+        self.assertEqual(schema.VERSION, schema.version(self.connection))
+        self.assertEqual(["a.nc"], database.file_names())
+
+    def test_migrate_converts_text_times_to_epoch_seconds(self):
+        cursor = self.connection.cursor()
+        for step in schema.MIGRATIONS[:5]:
+            step(cursor)
+        cursor.execute("""
+            INSERT INTO file (name, reference)
+            VALUES ('a.nc', '2019-01-01 12:00:00')
+        """)
+        cursor.execute("""
+            INSERT INTO time (i, value) VALUES (0, '2019-01-01 15:00:00')
+        """)
+        database = db.Database(self.connection)
+        self.assertEqual(
+            [dt.datetime(2019, 1, 1, 12)], database.initial_times())
+        self.assertEqual(
+            [dt.datetime(2019, 1, 1, 15)], database.fetch_dates())
+        cursor.execute("SELECT typeof(value) FROM time")
+        self.assertEqual([("integer",)], cursor.fetchall())
+
+    def test_migrate_given_newer_catalogue_raises(self):
+        schema.migrate(self.connection)
+        self.connection.execute(
+            "UPDATE schema_version SET version = :v",
+            dict(v=schema.VERSION + 1))
+        with self.assertRaises(RuntimeError):
+            schema.migrate(self.connection)
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Hot queries should be answered by index searches"""
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+        self.locator = db.Locator(self.connection)
+        self.statements = []
+        self.connection.set_trace_callback(self.statements.append)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_valid_times(self):
+        self.database.valid_times(
+            variable="v", pattern="*.nc", initial_time="2019-01-01 00:00:00")
+        self.assert_no_table_scans()
+
+    def test_valid_times_given_variable_and_pattern(self):
+        self.database.valid_times(variable="v", pattern="*.nc")
+        self.assert_no_table_scans()
+
+    def test_pressures(self):
+        self.database.pressures(
+            variable="v", pattern="*.nc", initial_time="2019-01-01 00:00:00")
+        self.assert_no_table_scans()
+
+    def test_initial_times(self):
+        self.database.initial_times(pattern="*.nc")
+        self.assert_no_table_scans()
+
+    def test_menus(self):
+        self.database.menus(control.State(
+            pattern="*.nc",
+            variable="v",
+            initial_time="2019-01-01 00:00:00"))
+        # GLOB with a leading wildcard can not search file.name
+        self.assert_no_table_scans("variable")
+
+    def test_valid_times_given_registered_model(self):
+        self.database.insert_model("GA6", "*global_africa*.nc")
+        self.database.valid_times(pattern="*global_africa*.nc")
+        self.assert_no_table_scans()
+
+    def test_path_points(self):
+        self.locator.path_points(
+            "*.nc", "v", "2019-01-01 00:00:00", "2019-01-01 03:00:00", 850.)
+        self.assert_no_table_scans()
+
+    def test_path_points_does_not_sort_candidates(self):
+        self.locator.path_points(
+            "*.nc", "v", "2019-01-01 00:00:00", "2019-01-01 03:00:00", 850.)
+        for query, detail in self.query_plans():
+            self.assertNotIn("TEMP B-TREE", detail, msg=query)
+
+    def query_plans(self):
+        """(query, detail) of every SELECT issued by the test"""
+        self.connection.set_trace_callback(None)
+        queries = [s for s in self.statements
+                   if s.strip().upper().startswith("SELECT")]
+        self.assertNotEqual([], queries)
+        plans = []
+        for query in queries:
+            cursor = self.connection.execute("EXPLAIN QUERY PLAN " + query)
+            plans += [(query, row[-1]) for row in cursor.fetchall()]
+        return plans
+
+    def assert_no_table_scans(self, *expected):
+        """Fail on any SCAN, even of an index, except of subqueries,
+        the model table, which is read whole once, and expected"""
+        expected = ("model",) + expected
+        for query, detail in self.query_plans():
+            if not detail.startswith("SCAN"):
+                continue
+            words = detail.split()
+            if words[1] == "TABLE":
+                words.pop(1)
+            if words[1].startswith("(subquery"):
+                continue
+            self.assertIn(words[1], expected, msg=detail + ": " + query)
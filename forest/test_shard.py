@@ -0,0 +1,304 @@
+import unittest
+import unittest.mock
+import datetime as dt
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import control
+import database as db
+import extract
+import shard
+
+
+def metadata(path, reference_time):
+    """File with a 2D time/pressure field and a 1D time series"""
+    times = [reference_time + dt.timedelta(hours=h) for h in (3, 6)]
+    return extract.Metadata(path, reference_time, [
+        extract.Variable("air_temperature", 0, 1, times, [1000., 850.]),
+        extract.Variable("precipitation", 0, None, times, None)])
+
+
+RUNS = [
+    ("/data/global_20190101.nc", dt.datetime(2019, 1, 1)),
+    ("/data/global_20190201.nc", dt.datetime(2019, 2, 1)),
+    ("/data/ukv_20190101.nc", dt.datetime(2019, 1, 1, 12)),
+    ("/data/ukv_20190215.nc", dt.datetime(2019, 2, 15))]
+
+MODELS = [
+    ("Global", "/data/global_*"),
+    ("UKV", "/data/ukv_*")]
+
+
+class TestShardKeys(unittest.TestCase):
+    def test_by_month(self):
+        result = shard.by_month(
+            metadata("file.nc", dt.datetime(2019, 3, 4)), [])
+        self.assertEqual("2019-03", result)
+
+    def test_by_month_given_no_reference_time(self):
+        result = shard.by_month(extract.Metadata("file.nc", None, []), [])
+        self.assertEqual(shard.UNDATED, result)
+
+    def test_by_model(self):
+        result = shard.by_model(
+            metadata("/data/ukv_1.nc", dt.datetime(2019, 1, 1)), MODELS)
+        self.assertEqual("UKV", result)
+
+    def test_by_model_given_unknown_file(self):
+        result = shard.by_model(
+            metadata("/tmp/x.nc", dt.datetime(2019, 1, 1)), MODELS)
+        self.assertEqual(shard.OTHER, result)
+
+    def test_shard_file_replaces_unsafe_characters(self):
+        self.assertEqual("a_b_c.db", shard.shard_file("a/b c"))
+
+
+class ShardTestCase(unittest.TestCase):
+    by = "month"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with shard.ShardedDatabase(self.directory, by=self.by) as sharded:
+            for name, pattern in MODELS:
+                sharded.insert_model(name, pattern)
+            for path, reference_time in RUNS:
+                sharded.insert_metadata(metadata(path, reference_time))
+            sharded.bump_generation()
+        self.database = db.Database(sqlite3.connect(":memory:"))
+        for name, pattern in MODELS:
+            self.database.insert_model(name, pattern)
+        for path, reference_time in RUNS:
+            self.database.insert_metadata(metadata(path, reference_time))
+        self.federation = shard.Federation(self.directory)
+
+    def tearDown(self):
+        self.federation.close()
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+
+class TestShardedDatabase(ShardTestCase):
+    def test_files_are_routed_by_month(self):
+        result = sorted(os.listdir(self.directory))
+        self.assertIn("2019-01.db", result)
+        self.assertIn("2019-02.db", result)
+        database = db.Database.connect(
+            os.path.join(self.directory, "2019-01.db"))
+        self.assertEqual(
+            ["/data/global_20190101.nc", "/data/ukv_20190101.nc"],
+            database.files())
+        database.close()
+
+    def test_signature_and_delete_file_find_shard(self):
+        path, reference_time = RUNS[1]
+        signature = extract.Signature(10, 20.)
+        with shard.ShardedDatabase(self.directory) as sharded:
+            sharded.update_signature(path, signature)
+            self.assertEqual(signature, sharded.signature(path))
+            sharded.delete_file(path)
+            self.assertIsNone(sharded.signature(path))
+        federation = shard.Federation(self.directory)
+        self.assertNotIn(path, federation.files())
+        federation.close()
+
+    def generations(self):
+        connection = sqlite3.connect(
+            os.path.join(self.directory, shard.INDEX))
+        cursor = connection.execute("SELECT name, generation FROM shard")
+        result = dict(cursor.fetchall())
+        connection.close()
+        return result
+
+    def test_insert_writes_only_extended_shard(self):
+        before = self.generations()
+        with shard.ShardedDatabase(self.directory) as sharded:
+            for name, pattern in MODELS:
+                sharded.insert_model(name, pattern)
+            sharded.insert_metadata(metadata(
+                "/data/global_20190216.nc", dt.datetime(2019, 2, 16)))
+            sharded.bump_generation()
+            self.assertEqual(["2019-02"], sorted(sharded.shards))
+        after = self.generations()
+        self.assertEqual(before["2019-01"], after["2019-01"])
+        self.assertEqual(before["2019-02"] + 1, after["2019-02"])
+
+    def test_insert_model_given_new_model_registers_every_shard(self):
+        with shard.ShardedDatabase(self.directory) as sharded:
+            sharded.insert_model("Global", "/data/global_2019*")
+        federation = shard.Federation(self.directory)
+        self.assertEqual(
+            ["2019-01", "2019-02"],
+            federation.shards(pattern="/data/global_2019*"))
+        self.assertEqual(
+            ["/data/global_20190101.nc", "/data/global_20190201.nc"],
+            federation.files(pattern="/data/global_2019*"))
+        federation.close()
+
+    def test_exit_given_exception_rolls_back(self):
+        path = "/data/global_20190301.nc"
+        with self.assertRaises(KeyboardInterrupt):
+            with shard.ShardedDatabase(self.directory) as sharded:
+                sharded.insert_metadata(
+                    metadata(path, dt.datetime(2019, 3, 1)))
+                raise KeyboardInterrupt
+        with shard.ShardedDatabase(self.directory) as sharded:
+            self.assertIsNone(sharded.signature(path))
+
+    def test_reopen_reindexes_shard_committed_before_crash(self):
+        path = "/data/global_20190301.nc"
+        with unittest.mock.patch.object(
+                shard.Index, "update", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                with shard.ShardedDatabase(self.directory) as sharded:
+                    sharded.insert_metadata(
+                        metadata(path, dt.datetime(2019, 3, 1)))
+                    sharded.bump_generation()
+        stdout = io.StringIO()
+        with unittest.mock.patch("sys.stdout", stdout):
+            with shard.ShardedDatabase(self.directory) as sharded:
+                self.assertEqual("2019-03", sharded.index.shard_of(path))
+                self.assertEqual([], sharded.index.pending())
+        self.assertIn("re-indexing: 2019-03", stdout.getvalue())
+        federation = shard.Federation(self.directory)
+        self.assertIn(
+            dt.datetime(2019, 3, 1), federation.initial_times())
+        self.assertEqual(
+            ["2019-03"],
+            federation.shards(initial_time=dt.datetime(2019, 3, 1)))
+        federation.close()
+
+    def test_index_records_reference_range(self):
+        connection = sqlite3.connect(
+            os.path.join(self.directory, shard.INDEX))
+        cursor = connection.execute("""
+            SELECT name, first_reference, last_reference FROM shard
+        """)
+        result = cursor.fetchall()
+        connection.close()
+        expect = [
+            ("2019-01",
+             db.to_epoch(dt.datetime(2019, 1, 1)),
+             db.to_epoch(dt.datetime(2019, 1, 1, 12))),
+            ("2019-02",
+             db.to_epoch(dt.datetime(2019, 2, 1)),
+             db.to_epoch(dt.datetime(2019, 2, 15)))]
+        self.assertEqual(expect, sorted(result))
+
+
+class TestFederation(ShardTestCase):
+    def test_shards_pruned_by_initial_time(self):
+        result = self.federation.shards(
+            initial_time=dt.datetime(2019, 2, 15))
+        self.assertEqual(["2019-02"], result)
+
+    def test_shards_given_time_between_runs(self):
+        result = self.federation.shards(
+            initial_time=dt.datetime(2019, 1, 20))
+        self.assertEqual([], result)
+
+    def test_queries_match_single_database(self):
+        for pattern in [None, "/data/ukv_*", "/data/*2019020*"]:
+            for method in ["files", "variables", "initial_times"]:
+                self.assertEqual(
+                    getattr(self.database, method)(pattern=pattern),
+                    getattr(self.federation, method)(pattern=pattern))
+            for _, reference_time in RUNS:
+                for method in ["valid_times", "pressures"]:
+                    kwargs = dict(
+                        variable="air_temperature",
+                        pattern=pattern,
+                        initial_time=reference_time)
+                    self.assertEqual(
+                        getattr(self.database, method)(**kwargs),
+                        getattr(self.federation, method)(**kwargs))
+
+    def test_menus_match_single_database(self):
+        for pattern in [None, "/data/global_*", "/data/*_2019020*"]:
+            for initial_time in [None, dt.datetime(2019, 2, 1)]:
+                state = control.State(
+                    pattern=pattern,
+                    variable="air_temperature",
+                    initial_time=initial_time)
+                self.assertEqual(
+                    self.database.menus(state),
+                    self.federation.menus(state))
+
+    def test_menus_attach_only_shards_holding_initial_time(self):
+        state = control.State(
+            pattern="/data/global_*", variable="air_temperature")
+        self.federation.menus(state)
+        self.assertEqual([], list(self.federation.attached))
+        self.federation.menus(
+            state._replace(initial_time=dt.datetime(2019, 2, 1)))
+        self.assertEqual(["2019-02"], list(self.federation.attached))
+
+    def test_shared_returns_one_instance_per_directory(self):
+        federation = shard.shared(self.directory)
+        self.addCleanup(shard._SHARED.pop, self.directory)
+        self.addCleanup(federation.close)
+        self.assertIs(federation, shard.shared(self.directory))
+
+    def test_path_points_match_single_database(self):
+        locator = db.Locator(self.database.connection)
+        for path, reference_time in RUNS:
+            for variable, pressure in [
+                    ("air_temperature", 900.),
+                    ("precipitation", 1000.)]:
+                args = (
+                    "/data/*",
+                    variable,
+                    reference_time,
+                    reference_time + dt.timedelta(hours=6),
+                    pressure)
+                self.assertEqual(
+                    locator.path_points(*args),
+                    self.federation.path_points(*args))
+
+    def test_path_points_given_no_match_returns_none(self):
+        result = self.federation.path_points(
+            "/data/*", "air_temperature", dt.datetime(2020, 1, 1),
+            dt.datetime(2020, 1, 1), 1000.)
+        self.assertIsNone(result)
+
+    def test_generation_changes_when_shard_is_committed(self):
+        before = self.federation.generation()
+        with shard.ShardedDatabase(self.directory) as sharded:
+            sharded.insert_metadata(
+                metadata("/data/global_20190301.nc",
+                         dt.datetime(2019, 3, 1)))
+            sharded.bump_generation()
+        self.assertNotEqual(before, self.federation.generation())
+        self.assertIn(
+            "/data/global_20190301.nc", self.federation.files())
+
+    def test_view_detaches_least_recently_used_shard(self):
+        self.federation.max_shards = 1
+        self.assertEqual(
+            self.database.files(), self.federation.files())
+        self.assertEqual(1, len(self.federation.attached))
+        cursor = self.federation.connection.execute(
+            "PRAGMA database_list")
+        self.assertEqual(3, len(cursor.fetchall()))
+
+
+class TestFederationByModel(ShardTestCase):
+    by = "model"
+
+    def test_shards_pruned_by_model_pattern(self):
+        self.assertEqual(
+            ["UKV"], self.federation.shards(pattern="/data/ukv_*"))
+
+    def test_shards_given_unregistered_pattern(self):
+        self.assertEqual(
+            ["Global", "UKV"], self.federation.shards(pattern="/data/*"))
+
+    def test_valid_times_match_single_database(self):
+        kwargs = dict(
+            variable="air_temperature",
+            pattern="/data/ukv_*",
+            initial_time=dt.datetime(2019, 2, 15))
+        self.assertEqual(
+            self.database.valid_times(**kwargs),
+            self.federation.valid_times(**kwargs))
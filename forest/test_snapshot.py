@@ -0,0 +1,87 @@
+import unittest
+import datetime as dt
+import os
+import shutil
+import sqlite3
+import tempfile
+import database as db
+import locate
+import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.db")
+        self.database = db.Database(sqlite3.connect(":memory:"))
+        self.insert("a.nc", dt.datetime(2019, 1, 1))
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def insert(self, path, initial_time):
+        self.database.insert_file_name(path, initial_time)
+        self.database.insert_variable(
+            path, "temperature", time_axis=0, pressure_axis=1)
+        self.database.insert_times(path, "temperature", [initial_time])
+        self.database.insert_pressures(path, "temperature", [850.])
+        self.database.bump_generation()
+
+    def test_publish_writes_analysed_catalogue(self):
+        snapshot.publish(self.database.connection, self.path)
+        connection = sqlite3.connect(self.path)
+        cursor = connection.execute("SELECT COUNT(*) FROM sqlite_stat1")
+        count, = cursor.fetchone()
+        mode, = connection.execute("PRAGMA journal_mode").fetchone()
+        connection.close()
+        self.assertGreater(count, 0)
+        self.assertEqual("delete", mode)
+
+    def test_publish_leaves_no_temporary_files(self):
+        snapshot.publish(self.database.connection, self.path)
+        self.assertEqual(["snapshot.db"], os.listdir(self.directory))
+
+    def test_snapshot_serves_queries_from_memory(self):
+        snapshot.publish(self.database.connection, self.path)
+        catalogue = snapshot.Snapshot(self.path)
+        os.remove(self.path)
+        database = db.Database(catalogue)
+        self.assertEqual(["a.nc"], database.files())
+        self.assertEqual([dt.datetime(2019, 1, 1)], database.initial_times())
+
+    def test_snapshot_swaps_to_newer_file(self):
+        snapshot.publish(self.database.connection, self.path)
+        catalogue = snapshot.Snapshot(self.path, check_interval=0.)
+        database = db.Database(catalogue)
+        self.assertEqual(["a.nc"], database.files())
+        self.insert("b.nc", dt.datetime(2019, 1, 2))
+        snapshot.publish(self.database.connection, self.path)
+        self.assertEqual(["a.nc", "b.nc"], database.files())
+        self.assertEqual(2, database.generation())
+
+    def test_snapshot_given_unchanged_file_keeps_copy(self):
+        snapshot.publish(self.database.connection, self.path)
+        catalogue = snapshot.Snapshot(self.path, check_interval=0.)
+        self.assertFalse(catalogue.refresh())
+
+    def test_snapshot_refuses_writes(self):
+        snapshot.publish(self.database.connection, self.path)
+        catalogue = snapshot.Snapshot(self.path)
+        with self.assertRaises(sqlite3.OperationalError):
+            db.Database(catalogue).insert_file_name(
+                "b.nc", dt.datetime(2019, 1, 2))
+
+    def test_snapshot_supports_locators(self):
+        snapshot.publish(self.database.connection, self.path)
+        catalogue = snapshot.Snapshot(self.path)
+        args = ("*.nc", "temperature", dt.datetime(2019, 1, 1),
+                dt.datetime(2019, 1, 1), 850.)
+        expect = ("a.nc", (0, 0))
+        self.assertEqual(expect, db.Locator(catalogue).path_points(*args))
+        self.assertEqual(
+            expect, locate.ArrayLocator(catalogue).path_points(*args))
+
+    def test_shared_returns_one_snapshot_per_path(self):
+        snapshot.publish(self.database.connection, self.path)
+        self.assertIs(snapshot.shared(self.path), snapshot.shared(self.path))
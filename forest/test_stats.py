@@ -0,0 +1,108 @@
+import unittest
+import sqlite3
+import datetime as dt
+import database as db
+import stats
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.database = db.Database(self.connection)
+        self.initial_time = dt.datetime(2019, 1, 1)
+        self.times = [dt.datetime(2019, 1, 1, h) for h in range(3)]
+        path = "file.nc"
+        self.database.insert_file_name(path, self.initial_time)
+        self.database.insert_variable(
+            path, "temperature", time_axis=0, pressure_axis=1)
+        self.database.insert_times(path, "temperature", self.times)
+        self.database.insert_pressures(
+            path, "temperature", [1000., 850., 500.])
+        self.stats = stats.QueryStats()
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_queries_recorded_by_method(self):
+        self.database.instrument(self.stats)
+        self.database.valid_times()
+        self.database.valid_times()
+        self.database.pressures()
+        methods = self.stats.summary()["methods"]
+        self.assertEqual(2, methods["valid_times"]["count"])
+        self.assertEqual(6, methods["valid_times"]["rows"])
+        self.assertEqual(1, methods["pressures"]["count"])
+        self.assertEqual(3, methods["pressures"]["rows"])
+
+    def test_locator_path_points_recorded(self):
+        locator = db.Locator(self.connection).instrument(self.stats)
+        locator.path_points(
+            "*.nc", "temperature", self.initial_time, self.times[1], 850.)
+        methods = self.stats.summary()["methods"]
+        self.assertGreater(methods["path_points"]["count"], 0)
+        self.assertEqual(1, methods["path_points"]["rows"])
+
+    def test_helpers_count_towards_public_method(self):
+        locator = db.Locator(self.connection).instrument(self.stats)
+        locator.path_points(
+            "*.nc", "temperature", self.initial_time, self.times[1], 850.)
+        self.assertNotIn("nearest", self.stats.summary()["methods"])
+
+    def test_direct_cursor_use_recorded_as_unattributed(self):
+        self.database.instrument(self.stats)
+        self.database.cursor.execute("SELECT 1")
+        self.database.cursor.fetchall()
+        self.assertEqual(
+            [stats.UNATTRIBUTED], list(self.stats.summary()["methods"]))
+
+    def test_executemany_recorded(self):
+        self.database.instrument(self.stats)
+        self.database.insert_times("file.nc", "temperature", self.times)
+        self.assertIn("insert_times", self.stats.summary()["methods"])
+
+    def test_instrument_none_stops_recording(self):
+        self.database.instrument(self.stats)
+        self.database.instrument(None)
+        self.database.valid_times()
+        self.assertEqual({}, self.stats.summary()["methods"])
+
+    def test_threshold_zero_captures_query_plan(self):
+        self.stats.threshold = 0.
+        self.database.instrument(self.stats)
+        self.database.valid_times(variable="temperature")
+        slow, = self.stats.summary()["slow"]
+        self.assertEqual("valid_times", slow["method"])
+        self.assertTrue(slow["sql"].startswith("SELECT"))
+        self.assertGreater(len(slow["plan"]), 0)
+        self.assertIn(slow["sql"], self.stats.format())
+
+    def test_reset(self):
+        self.database.instrument(self.stats)
+        self.database.valid_times()
+        self.stats.reset()
+        self.assertEqual({}, self.stats.summary()["methods"])
+
+
+class TestMethodStats(unittest.TestCase):
+    def test_histogram_counts_each_bucket(self):
+        method = stats.MethodStats()
+        for seconds in [0.00005, 0.003, 0.003, 10.]:
+            method.add(seconds, 1)
+        histogram = dict(
+            (bound, count) for bound, count in method.summary()["histogram"])
+        self.assertEqual(1, histogram[0.0001])
+        self.assertEqual(2, histogram[0.005])
+        self.assertEqual(1, histogram[None])
+
+    def test_quantile_returns_bucket_upper_bound(self):
+        method = stats.MethodStats()
+        for seconds in [0.002] * 19 + [0.2]:
+            method.add(seconds, 1)
+        self.assertEqual(0.0025, method.quantile(0.5))
+        self.assertEqual(0.0025, method.quantile(0.95))
+        self.assertEqual(0.25, method.quantile(1.))
+
+    def test_quantile_beyond_last_bucket_returns_none(self):
+        method = stats.MethodStats()
+        method.add(10., 0)
+        self.assertIsNone(method.quantile(0.5))
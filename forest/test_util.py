@@ -1,4 +1,8 @@
 import unittest
+import unittest.mock
+import concurrent.futures
+import io
+import threading
 import bokeh
 import util
 
@@ -31,3 +35,68 @@ class TestDropdown(unittest.TestCase):
         result = util.pluck_label(menu)
         expect = ["A", "B", "C"]
         self.assertEqual(expect, result)
+
+
+class TestBackground(unittest.TestCase):
+    def setUp(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.ticks = []
+        self.background = util.Background(self.executor, self.ticks.append)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_submit_given_error_schedules_error_handler(self):
+        apply, error = unittest.mock.Mock(), unittest.mock.Mock()
+        exception = ValueError("failed")
+
+        def work():
+            raise exception
+
+        self.background.submit(work, apply, error).exception()
+        self.executor.shutdown()
+        for tick in self.ticks:
+            tick()
+        apply.assert_not_called()
+        error.assert_called_once_with(exception)
+
+    def test_submit_given_error_reports_to_stderr_by_default(self):
+        def work():
+            raise ValueError("failed")
+
+        self.background.submit(work, unittest.mock.Mock()).exception()
+        self.executor.shutdown()
+        stderr = io.StringIO()
+        with unittest.mock.patch("sys.stderr", stderr):
+            for tick in self.ticks:
+                tick()
+        self.assertIn("ValueError: failed", stderr.getvalue())
+
+    def test_submit_schedules_apply_with_result(self):
+        apply = unittest.mock.Mock()
+        self.background.submit(lambda: "result", apply).result()
+        self.executor.shutdown()
+        for tick in self.ticks:
+            tick()
+        apply.assert_called_once_with("result")
+
+    def test_submit_drops_superseded_results(self):
+        event = threading.Event()
+        old, new = unittest.mock.Mock(), unittest.mock.Mock()
+        self.background.submit(lambda: event.wait() and "old", old)
+        self.background.submit(lambda: "new", new)
+        event.set()
+        self.executor.shutdown()
+        for tick in self.ticks:
+            tick()
+        old.assert_not_called()
+        new.assert_called_once_with("new")
+
+    def test_apply_skipped_if_superseded_before_tick(self):
+        apply = unittest.mock.Mock()
+        self.background.submit(lambda: "old", apply).result()
+        self.executor.shutdown()
+        self.background.token += 1
+        for tick in self.ticks:
+            tick()
+        apply.assert_not_called()
@@ -0,0 +1,97 @@
+import unittest
+import unittest.mock
+import os
+import shutil
+import tempfile
+import watch
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.watcher = watch.Watcher(self.directory, pattern="*.nc")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, name, content=b""):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as stream:
+            stream.write(content)
+        return path
+
+    def test_poll_waits_for_file_to_stop_changing(self):
+        path = self.touch("a.nc")
+        self.assertEqual([], self.watcher.poll())
+        self.assertEqual([path], self.watcher.poll())
+
+    def test_poll_reports_each_version_once(self):
+        path = self.touch("a.nc")
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertEqual([], self.watcher.poll())
+
+    def test_poll_reports_updated_file(self):
+        path = self.touch("a.nc")
+        self.watcher.poll()
+        self.watcher.poll()
+        self.touch("a.nc", b"more")
+        self.assertEqual([], self.watcher.poll())
+        self.assertEqual([path], self.watcher.poll())
+
+    def test_scan_skips_file_deleted_while_listing(self):
+        entry = unittest.mock.Mock(path="a.nc")
+        entry.name = "a.nc"
+        entry.is_file.return_value = True
+        entry.stat.side_effect = FileNotFoundError
+        with unittest.mock.patch("os.scandir", return_value=[entry]):
+            self.assertEqual({}, self.watcher.scan())
+
+    def test_poll_ignores_names_not_matching_pattern(self):
+        self.touch("a.txt")
+        self.watcher.poll()
+        self.assertEqual([], self.watcher.poll())
+
+    def test_batches_given_polls(self):
+        path = self.touch("a.nc")
+        result = list(self.watcher.batches(0, polls=3))
+        expect = [[path]]
+        self.assertEqual(expect, result)
+
+    def test_poll_reports_failed_file_again_once_retry_is_due(self):
+        watcher = watch.Watcher(self.directory, retry_delay=0)
+        path = self.touch("a.nc")
+        watcher.poll()
+        watcher.poll()
+        watcher.retry(path)
+        self.assertEqual([path], watcher.poll())
+        self.assertEqual([], watcher.poll())
+
+    def test_retry_doubles_delay_up_to_maximum(self):
+        watcher = watch.Watcher(
+            self.directory, retry_delay=1., retry_max=3.)
+        with unittest.mock.patch("time.monotonic", return_value=100.):
+            dues = []
+            for _ in range(4):
+                watcher.retry("a.nc")
+                dues.append(watcher.retries["a.nc"][1])
+        self.assertEqual([101., 102., 103., 103.], dues)
+
+    def test_poll_given_changed_file_drops_retry(self):
+        path = self.touch("a.nc")
+        self.watcher.poll()
+        self.watcher.poll()
+        self.watcher.retry(path)
+        self.touch("a.nc", b"more")
+        self.watcher.poll()
+        self.assertEqual([path], self.watcher.poll())
+        self.assertEqual({}, self.watcher.retries)
+
+    def test_poll_given_deleted_file_drops_retry(self):
+        path = self.touch("a.nc")
+        self.watcher.poll()
+        self.watcher.poll()
+        self.watcher.retry(path)
+        os.remove(path)
+        self.watcher.poll()
+        self.assertEqual({}, self.watcher.retries)
@@ -1,4 +1,7 @@
 """Utility functions, decorators and classes"""
+import functools
+import sys
+import traceback
 
 
 def autolabel(dropdown):
@@ -39,3 +42,52 @@ def find_label(menu, value):
 
 def pluck_label(menu):
     return [l for l, _ in menu]
+
+
+class Background(object):
+    """Run blocking work on an executor and apply the latest result
+
+    Intended for bokeh callbacks, schedule is usually
+    document.add_next_tick_callback so that apply runs on the
+    document thread. Results of work superseded by a later call
+    to submit are dropped
+    """
+    def __init__(self, executor, schedule):
+        self.executor = executor
+        self.schedule = schedule
+        self.token = 0
+
+    def submit(self, work, apply, error=None):
+        """Run work on the executor, then apply(result) on schedule
+
+        :param error: called on schedule with the exception raised by
+                      work, by default the traceback is printed to
+                      stderr along with the work that failed
+        """
+        self.token += 1
+        token = self.token
+        if error is None:
+            error = functools.partial(_report, work)
+
+        def on_tick(result):
+            if token == self.token:
+                apply(result)
+
+        def on_done(future):
+            if token != self.token:
+                return
+            exception = future.exception()
+            if exception is not None:
+                self.schedule(functools.partial(error, exception))
+            else:
+                self.schedule(functools.partial(on_tick, future.result()))
+
+        future = self.executor.submit(work)
+        future.add_done_callback(on_done)
+        return future
+
+
+def _report(work, exception):
+    print("background work failed: {!r}".format(work), file=sys.stderr)
+    traceback.print_exception(
+        type(exception), exception, exception.__traceback__)
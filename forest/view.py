@@ -1,3 +1,4 @@
+import functools
 import bokeh.models
 from collections import namedtuple
 
@@ -6,11 +7,21 @@ Image = namedtuple("Image", ("path", "variable", "pts"))
 
 
 class View(object):
-    def __init__(self, text, locator=None):
+    def __init__(self, text, locator=None, background=None):
         self.div = bokeh.models.Div(text=text)
         self.locator = locator
+        self.background = background
 
     def on_state(self, state):
+        if self.background is None:
+            self.render(state, self.image(state))
+        else:
+            self.background.submit(
+                functools.partial(self.image, state),
+                functools.partial(self.render, state))
+
+    def image(self, state):
+        """Search for path and indices related to state"""
         image = Image(path=None, variable=state.variable, pts=None)
         if (
                 (state.pattern is not None) and
@@ -27,6 +38,9 @@ class View(object):
                 state.valid_time,
                 p)
             image = Image(path=path, variable=state.variable, pts=pts)
+        return image
+
+    def render(self, state, image):
         self.div.text = "<ul><li>{}</li><li>{}</li></ul>".format(
             str(state),
             str(image))
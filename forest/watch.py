@@ -0,0 +1,88 @@
+"""Poll a directory for new or updated files
+
+A file is only reported once its size and modification time are
+unchanged between two consecutive polls, so files that are still
+being written are picked up on a later poll. Files that could not
+be processed can be handed back with :meth:`Watcher.retry` to be
+reported again after a delay that doubles with every failure
+"""
+import fnmatch
+import os
+import time
+
+
+# Seconds before a failed file is first reported again
+RETRY_DELAY = 2.
+
+# Upper bound of the delay between retries in seconds
+RETRY_MAX = 300.
+
+
+class Watcher(object):
+    def __init__(self, directory, pattern="*", retry_delay=RETRY_DELAY,
+                 retry_max=RETRY_MAX):
+        self.directory = directory
+        self.pattern = pattern
+        self.retry_delay = retry_delay
+        self.retry_max = retry_max
+        self.pending = {}
+        self.reported = {}
+        self.retries = {}
+
+    def poll(self):
+        """Paths that are new or changed and have stopped changing
+
+        Unchanged paths whose retry is due are included, a changed
+        path starts again without a retry delay
+        """
+        current = self.scan()
+        now = time.monotonic()
+        ready = []
+        for path, stat in current.items():
+            if self.reported.get(path) == stat:
+                attempts, due = self.retries.get(path, (0, None))
+                if (due is not None) and (due <= now):
+                    ready.append(path)
+                    self.retries[path] = (attempts, None)
+                continue
+            if self.pending.get(path) == stat:
+                ready.append(path)
+                self.reported[path] = stat
+                self.retries.pop(path, None)
+        self.pending = current
+        self.retries = {
+            path: retry for path, retry in self.retries.items()
+            if path in current}
+        return sorted(ready)
+
+    def retry(self, path):
+        """Report a path that failed again after a backoff delay"""
+        attempts, _ = self.retries.get(path, (0, None))
+        delay = min(self.retry_max, self.retry_delay * 2 ** attempts)
+        self.retries[path] = (attempts + 1, time.monotonic() + delay)
+
+    def scan(self):
+        result = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if not fnmatch.fnmatch(entry.name, self.pattern):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Deleted since the directory was listed
+                continue
+            result[entry.path] = (stat.st_size, stat.st_mtime)
+        return result
+
+    def batches(self, interval, polls=None):
+        """Generate non-empty lists of paths every interval seconds"""
+        count = 0
+        while (polls is None) or (count < polls):
+            if count > 0:
+                time.sleep(interval)
+            paths = self.poll()
+            count += 1
+            if len(paths) > 0:
+                yield paths